@@ -23,11 +23,35 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 from tkinter import scrolledtext
+from tkinter import filedialog
+from tkinter import simpledialog
+import argparse
 import os
-import csv
+import queue
 import sqlite3
+import sys
+import time
 from datetime import date
-from datetime import date
+from datetime import datetime
+
+from application.database import get_database
+from application.database import is_busy
+from application.resources import license_text
+from application.resources import window_icon
+from application.schema import migrate
+from application.settings import get_settings
+from application.store import INCOMING
+from application.store import OUTGOING
+from application.store import get_store
+from application.worker import BatchInserter
+from application.worker import get_worker
+from application.worker import start_worker
+from application.worker import stop_worker
+
+# The modules used only by the secondary windows and the long tasks, the
+# type-ahead, the virtual tree, the batch entry, backup, export, import,
+# tracing and query plans, are imported where they are used so that the
+# main window shows up sooner.
 
 __appname__ = "Tarsier Stock"
 __description__ = "A simple inventory software for small business."
@@ -41,6 +65,56 @@ __maintainer__ = "Jesus Vedasto Olazo"
 __copyright__ = "Copyright (c) 2015 - Jesus Vedasto Olazo"
 
 
+def errormessage(error):
+    """
+    Return the message shown to the user when saving has failed, error
+    is the exception or its text.
+    """
+    if is_busy(error):
+        return 'The database is in use by another terminal, please try again.'
+    return 'An Error Occured.'
+
+
+def submitwrite(window, function, callback, title='Save'):
+    """
+    Save function(store) on the database worker and call callback with
+    its result on the tkinter thread. The worker tries the write again
+    while another terminal keeps the database locked, the window keeps
+    responding meanwhile. If the write fails a warning is shown and the
+    callback is given None.
+    """
+    def done(result):
+        # The window may have been closed while the worker was saving.
+        if window.winfo_exists():
+            callback(result)
+
+    def failed(message):
+        if window.winfo_exists():
+            messagebox.showwarning(title, errormessage(message), parent=window)
+            callback(None)
+
+    return get_worker().submit(function, callback=done, error=failed)
+
+
+def transactionrow(row):
+    """
+    Return the treeview iid, text and column values of a row from the
+    incoming or outgoing table.
+    """
+    return (str(row[0]),
+            str(row[0]),
+            [str(row[6]),
+             str(row[1]),
+             str(row[2]),
+             str(row[3]),
+             str(row[5]),
+             str(row[4]),
+             str(row[4] * row[5]),
+             str(row[7])
+             ]
+            )
+
+
 class ItemOut(tk.Toplevel):
 
     def __init__(self, parent):
@@ -55,15 +129,10 @@ class ItemOut(tk.Toplevel):
         self.protocol('WM_DELETE_WINDOW', self.quitApp)
 
         # Set the window icon.
-        try:
-            icon = tk.PhotoImage(file='tsicon.gif')
-            self.tk.call('wm', 'iconphoto', self._w, icon)
-        except:
-            print('Sorry an error occured setting the icon.')
+        window_icon(self)
 
-        # Initialize the database and the cursor.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
+        # Get the inventory store of the shared database.
+        self.store = get_store()
 
         # Add to labelframe for select item and insert item.
         self.selectframe = ttk.LabelFrame(self, text='Select Item')
@@ -75,6 +144,12 @@ class ItemOut(tk.Toplevel):
         self.displayframe = ttk.LabelFrame(self, text='Details')
         self.displayframe.pack(side='bottom', expand=True, fill='both')
 
+        # The lines of a delivery note can be queued in the batch and
+        # posted together in one transaction.
+        from application.batchentry import BatchEntry
+        self.batch = BatchEntry(self, self.postbatch)
+        self.batch.pack(anchor='n', fill='both')
+
         # Add a ttk treeview for the display of transaction.
         self.display_tree = ttk.Treeview(self.displayframe)
         self.display_tree.pack(side='left', expand=True, fill='both')
@@ -127,6 +202,16 @@ class ItemOut(tk.Toplevel):
         self.display_tree.tag_configure('evenrow', background='#FFB586')
         self.display_tree.tag_configure('oddrow', background='#FDA46A')
 
+        # Show the transactions in virtual list mode, only the rows near
+        # the viewport are read from the database and kept in the tree.
+        from application.virtualtree import VirtualTree
+        self.virtual = VirtualTree(self.display_tree,
+                                   self.disyscroll,
+                                   self.countdetails,
+                                   self.fetchdetails,
+                                   transactionrow
+                                   )
+
         # Add a delete and edit button for under tree view for
         # database manipulation and editing.
         self.delete_btn = ttk.Button(self.displayframe, text='Delete')
@@ -145,6 +230,10 @@ class ItemOut(tk.Toplevel):
         self.yscroll.pack(side='left', fill='y')
         self.itemlistbox.config(yscrollcommand=self.yscroll.set)
         self.itemlistbox.bind('<Double-Button-1>', self.selectitem)
+        # Filter the list of items as the user types.
+        from application.typeahead import TypeAhead
+        self.typeahead = TypeAhead(self.searchitem_entry, self.itemlistbox,
+                                   self.store.item_index)
 
         # Insert item list into the listbox.
         self.insertitemlist()
@@ -174,6 +263,9 @@ class ItemOut(tk.Toplevel):
         self.descp_entry.grid(row=2, column=1, sticky='w')
         self.unit_entry = ttk.Entry(self.insertframe, width=10)
         self.unit_entry.grid(row=3, column=1, sticky='w')
+        # Look the item up once the code has been typed, not on every key.
+        self.itemcode_entry.bind('<FocusOut>', self.autofill)
+        self.itemcode_entry.bind('<Return>', self.autofill)
         self.rate_entry = ttk.Entry(self.insertframe, width=20)
         self.rate_entry.grid(row=4, column=1, sticky='w')
         self.quantity_entry = ttk.Entry(self.insertframe, width=20)
@@ -192,6 +284,11 @@ class ItemOut(tk.Toplevel):
                                    command=self.saveentry
                                    )
         self.save_btn.grid(row=8, column=1, sticky='e')
+        self.add_btn = ttk.Button(self.insertframe,
+                                  text='Add to Batch',
+                                  command=self.addbatch
+                                  )
+        self.add_btn.grid(row=9, column=1, sticky='e')
         self.insertdetails()
 
         # Insert today's date.
@@ -200,36 +297,51 @@ class ItemOut(tk.Toplevel):
         self.itemcode_entry.focus_set()
 
     def selectitem(self, event):
-        print(event)
         self.itemcode_entry.delete(0, 'end')
         self.descp_entry.delete(0, 'end')
         self.unit_entry.delete(0, 'end')
         searchvalue = self.itemlistbox.get('active')
-        forquery = "SELECT description, unit FROM item WHERE itemcode='" + str(searchvalue) + "'"
-        descpquery = self.cur.execute(forquery)
-        insertvalue = descpquery.fetchone()
-        dvalue = insertvalue[0]
-        uvalue = insertvalue[1]
-        print(dvalue)
-        print(uvalue)
-        self.itemcode_entry.insert('end', str(searchvalue))
-        self.descp_entry.insert('end', str(dvalue))
-        self.unit_entry.insert('end', str(uvalue))
+        item = self.store.find_item(searchvalue)
+        if item is None:
+            return
+        self.itemcode_entry.insert('end', str(item.itemcode))
+        self.descp_entry.insert('end', str(item.description))
+        self.unit_entry.insert('end', str(item.unit))
+
+    def autofill(self, event):
+        # Fill the description and unit once the item code is known.
+        item = self.store.find_item(self.itemcode_entry.get().strip())
+        if item is None:
+            return
+        self.descp_entry.delete(0, 'end')
+        self.descp_entry.insert('end', str(item.description))
+        self.unit_entry.delete(0, 'end')
+        self.unit_entry.insert('end', str(item.unit))
 
     def saveentry(self):
         itemcode = str(self.itemcode_entry.get())
         description = str(self.descp_entry.get())
         unit = str(self.unit_entry.get())
         rate = float(self.rate_entry.get())
-        quantity = float(self.quantity_entry.get()) * -1
-        sdate = datetime.strptime(self.date_entry.get(), '%Y-%m-%d')
+        quantity = float(self.quantity_entry.get())
         remarks = str(self.remarks_entry.get())
-        self.cur.execute("""
-                         INSERT INTO outgoing VALUES(null, ?, ?, ?, ?, ?, ?, ?)""",
-                         (itemcode, description, unit, quantity, rate, sdate, remarks)
-                         )
-        self.insertdetails()
-
+        tdate = self.date_entry.get()
+        self.save_btn.config(state='disabled')
+        submitwrite(self, lambda store: store.record_outgoing(itemcode, description, unit,
+                                                              quantity, rate, tdate,
+                                                              remarks),
+                    self.saved)
+
+    def saved(self, row):
+        self.save_btn.config(state='normal')
+        if row is None:
+            return
+        # Only append the saved row to the treeview instead of
+        # loading the whole table again.
+        self.virtual.append(row)
+        self.clearentries()
+
+    def clearentries(self):
         # Clear the entries on save except date.
         self.itemcode_entry.delete('0', 'end')
         self.descp_entry.delete('0', 'end')
@@ -238,67 +350,88 @@ class ItemOut(tk.Toplevel):
         self.quantity_entry.delete('0', 'end')
         self.remarks_entry.delete('0', 'end')
 
+    def addbatch(self):
+        # Queue the line as it is typed, the whole batch is checked
+        # when it is posted.
+        self.batch.add((self.itemcode_entry.get().strip(),
+                        self.descp_entry.get(),
+                        self.unit_entry.get(),
+                        self.quantity_entry.get().strip(),
+                        self.rate_entry.get().strip(),
+                        self.date_entry.get().strip(),
+                        self.remarks_entry.get()
+                        ))
+        self.clearentries()
+        self.itemcode_entry.focus_set()
+        autopost = get_settings()['entry'].getint('autopost')
+        if autopost > 0 and len(self.batch) >= autopost:
+            self.postbatch()
+
+    def postbatch(self):
+        # A batch is being saved, an automatic post waits for the next line.
+        if self.batch.post_btn.instate(['disabled']):
+            return
+        lines = self.batch.batch()
+        if not lines:
+            return
+        errors = self.store.check_batch(lines)
+        if errors:
+            messagebox.showwarning('Post', self.batch.mark(errors), parent=self)
+            return
+        synchronous = get_settings()['entry'].get('synchronous')
+        posted = self.batch.keys()
+        self.batch.post_btn.config(state='disabled')
+        submitwrite(self, lambda store: store.post_batch(OUTGOING, lines, synchronous),
+                    lambda rows: self.posted(posted, rows), 'Post')
+
+    def posted(self, posted, rows):
+        self.batch.post_btn.config(state='normal')
+        if rows is None:
+            return
+        for row in rows:
+            self.virtual.append(row)
+        # Lines queued while the batch was saved stay in the batch.
+        self.batch.discard(posted)
+
     def refreshlist(self, event):
-        print(event.char)
         if event.keysym == 'Return':
+            # Return runs the ranked full text search instead of
+            # waiting for the type-ahead filter.
+            self.typeahead.cancel()
             if self.searchitem_entry.get() == '':
                 self.insertitemlist()
             else:
-                item = self.searchitem_entry.get()
-                # test = "SELECT itemcode FROM item WHERE itemcode MATCH :?", (item)
-                model = "SELECT itemcode FROM item WHERE itemcode=" + item
-                dataquery = self.cur.execute(model)
-                datafetch = dataquery.fetchall()
-                for data in datafetch:
-                    print(data[0])
-                    self.itemlistbox.delete('0', 'end')
-                    self.itemlistbox.insert('end', data[0])
+                items = self.store.search_items(self.searchitem_entry.get(),
+                                                self.typeahead.limit)
+                self.itemlistbox.delete('0', 'end')
+                for item in items:
+                    self.itemlistbox.insert('end', item.itemcode)
 
     def insertitemlist(self):
-        # Insert item list into the listbox.
-        dataquery = self.cur.execute("Select * FROM item")
-        rows = dataquery.fetchall()
-        for row in rows:
-            self.itemlistbox.insert('end', row[1])
+        # Insert the first items into the listbox, the others are
+        # reached by typing in the search entry.
+        self.typeahead.show(self.store.first_itemcodes(self.typeahead.limit))
 
-    def insertdetails(self):
-        # Check if there is any data in the treeview
-        # if so delete and load the list again.
-        if len(self.display_tree.get_children()) != 0:
-            child = self.display_tree.get_children()
-            for item in child:
-                self.display_tree.delete(item)
+    def countdetails(self):
+        return self.store.count_transactions(OUTGOING)
 
-        # Initialize the database.
-        data = self.cur.execute("""SELECT * FROM outgoing""")
-        rows = data.fetchall()
+    def fetchdetails(self, offset, limit, after):
+        # Continue from the last rowid of the previous page when it is
+        # known, otherwise skip to the offset of the page.
+        if after is not None:
+            after = after.rowid
+        return self.store.list_transactions(OUTGOING, offset, limit, after)
 
-        # insert the report into the tree.
-        counter = 1
-        for row in rows:
-            if counter % 2 == 0:
-                self.display_tree.insert('', 'end', str(row[0]), text=str(row[0]), tag=('evenrow',))
-            else:
-                self.display_tree.insert('', 'end', str(row[0]), text=str(row[0]), tag=('oddrow',))
-            self.display_tree.set(str(row[0]), self.column[0], str(row[6]))
-            self.display_tree.set(str(row[0]), self.column[1], str(row[1]))
-            self.display_tree.set(str(row[0]), self.column[2], str(row[2]))
-            self.display_tree.set(str(row[0]), self.column[3], str(row[3]))
-            self.display_tree.set(str(row[0]), self.column[4], str(row[5]))
-            self.display_tree.set(str(row[0]), self.column[5], str(row[4]))
-            self.display_tree.set(str(row[0]), self.column[6], str(row[4]*row[5]))
-            self.display_tree.set(str(row[0]), self.column[7], str(row[7]))
-            counter += 1
+    def insertdetails(self):
+        # Count the transactions again and load the rows of the
+        # current view into the treeview.
+        self.virtual.refresh()
 
     def quitApp(self):
-        # Check first if the database is open, if so close it.
-        if self.database:
-            try:
-                self.database.commit()
-            except sqlite3.Error:
-                self.database.rollback()
-            self.cur.close()
-            self.database.close()
+        if len(self.batch) != 0:
+            if not messagebox.askyesno('Quit', 'The batch has not been posted.\n\n'
+                                       'Discard its lines?', parent=self):
+                return
         self.destroy()
 
 
@@ -316,15 +449,10 @@ class ItemIn(tk.Toplevel):
         self.protocol('WM_DELETE_WINDOW', self.quitApp)
 
         # Set the window icon.
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        try:
-            self.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self)
 
-        # Initialize the database and the cursor.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
+        # Get the inventory store of the shared database.
+        self.store = get_store()
 
         # Add to labelframe for select item and insert item.
         self.selectframe = ttk.LabelFrame(self, text='Select Item')
@@ -336,6 +464,12 @@ class ItemIn(tk.Toplevel):
         self.displayframe = ttk.LabelFrame(self, text='Details')
         self.displayframe.pack(side='bottom', expand=True, fill='both')
 
+        # The lines of a delivery note can be queued in the batch and
+        # posted together in one transaction.
+        from application.batchentry import BatchEntry
+        self.batch = BatchEntry(self, self.postbatch)
+        self.batch.pack(anchor='n', fill='both')
+
         # Add a ttk treeview for the display of transaction.
         self.display_tree = ttk.Treeview(self.displayframe)
         self.display_tree.pack(side='left', expand=True, fill='both')
@@ -378,6 +512,16 @@ class ItemIn(tk.Toplevel):
         self.display_tree.tag_configure('evenrow', background='#FFB586')
         self.display_tree.tag_configure('oddrow', background='#FDA46A')
 
+        # Show the transactions in virtual list mode, only the rows near
+        # the viewport are read from the database and kept in the tree.
+        from application.virtualtree import VirtualTree
+        self.virtual = VirtualTree(self.display_tree,
+                                   self.disyscroll,
+                                   self.countdetails,
+                                   self.fetchdetails,
+                                   transactionrow
+                                   )
+
         # Add a delete and edit button for under tree view for
         # database manipulation and editing.
         self.delete_btn = ttk.Button(self.displayframe, text='Delete')
@@ -395,6 +539,10 @@ class ItemIn(tk.Toplevel):
         self.yscroll.pack(side='left', fill='y')
         self.itemlistbox.config(yscrollcommand=self.yscroll.set)
         self.itemlistbox.bind('<Double-Button-1>', self.selectitem)
+        # Filter the list of items as the user types.
+        from application.typeahead import TypeAhead
+        self.typeahead = TypeAhead(self.searchitem_entry, self.itemlistbox,
+                                   self.store.item_index)
 
         # Insert item list into the listbox.
         self.insertitemlist()
@@ -424,6 +572,9 @@ class ItemIn(tk.Toplevel):
         self.descp_entry.grid(row=2, column=1, sticky='w')
         self.unit_entry = ttk.Entry(self.insertframe, width=10)
         self.unit_entry.grid(row=3, column=1, sticky='w')
+        # Look the item up once the code has been typed, not on every key.
+        self.itemcode_entry.bind('<FocusOut>', self.autofill)
+        self.itemcode_entry.bind('<Return>', self.autofill)
         self.rate_entry = ttk.Entry(self.insertframe, width=20)
         self.rate_entry.grid(row=4, column=1, sticky='w')
         self.quantity_entry = ttk.Entry(self.insertframe, width=20)
@@ -442,6 +593,11 @@ class ItemIn(tk.Toplevel):
                                    command=self.saveentry
                                    )
         self.save_btn.grid(row=8, column=1, sticky='e')
+        self.add_btn = ttk.Button(self.insertframe,
+                                  text='Add to Batch',
+                                  command=self.addbatch
+                                  )
+        self.add_btn.grid(row=9, column=1, sticky='e')
         self.insertdetails()
 
         # Insert today's date.
@@ -450,28 +606,31 @@ class ItemIn(tk.Toplevel):
         self.itemcode_entry.focus_set()
 
     def insertitemlist(self):
-        # Insert item list into the listbox.
-        dataquery = self.cur.execute("Select * FROM item")
-        rows = dataquery.fetchall()
-        for row in rows:
-            self.itemlistbox.insert('end', row[1])
+        # Insert the first items into the listbox, the others are
+        # reached by typing in the search entry.
+        self.typeahead.show(self.store.first_itemcodes(self.typeahead.limit))
 
     def selectitem(self, event):
-        print(event)
         self.itemcode_entry.delete(0, 'end')
         self.descp_entry.delete(0, 'end')
         self.unit_entry.delete(0, 'end')
         searchvalue = self.itemlistbox.get('active')
-        forquery = "SELECT description, unit FROM item WHERE itemcode='" + str(searchvalue) + "'"
-        descpquery = self.cur.execute(forquery)
-        insertvalue = descpquery.fetchone()
-        dvalue = insertvalue[0]
-        uvalue = insertvalue[1]
-        print(dvalue)
-        print(uvalue)
-        self.itemcode_entry.insert('end', str(searchvalue))
-        self.descp_entry.insert('end', str(dvalue))
-        self.unit_entry.insert('end', str(uvalue))
+        item = self.store.find_item(searchvalue)
+        if item is None:
+            return
+        self.itemcode_entry.insert('end', str(item.itemcode))
+        self.descp_entry.insert('end', str(item.description))
+        self.unit_entry.insert('end', str(item.unit))
+
+    def autofill(self, event):
+        # Fill the description and unit once the item code is known.
+        item = self.store.find_item(self.itemcode_entry.get().strip())
+        if item is None:
+            return
+        self.descp_entry.delete(0, 'end')
+        self.descp_entry.insert('end', str(item.description))
+        self.unit_entry.delete(0, 'end')
+        self.unit_entry.insert('end', str(item.unit))
 
     def saveentry(self):
         itemcode = str(self.itemcode_entry.get())
@@ -479,14 +638,24 @@ class ItemIn(tk.Toplevel):
         unit = str(self.unit_entry.get())
         rate = float(self.rate_entry.get())
         quantity = float(self.quantity_entry.get())
-        sdate = datetime.strptime(self.date_entry.get(), '%Y-%m-%d')
         remarks = str(self.remarks_entry.get())
-        self.cur.execute("""
-            INSERT INTO incoming VALUES(null, ?, ?, ?, ?, ?, ?, ?)""",
-                         (itemcode, description, unit, quantity, rate, sdate, remarks)
-                         )
-        self.insertdetails()
-
+        tdate = self.date_entry.get()
+        self.save_btn.config(state='disabled')
+        submitwrite(self, lambda store: store.record_incoming(itemcode, description, unit,
+                                                              quantity, rate, tdate,
+                                                              remarks),
+                    self.saved)
+
+    def saved(self, row):
+        self.save_btn.config(state='normal')
+        if row is None:
+            return
+        # Only append the saved row to the treeview instead of
+        # loading the whole table again.
+        self.virtual.append(row)
+        self.clearentries()
+
+    def clearentries(self):
         # Clear the entries on save except date.
         self.itemcode_entry.delete('0', 'end')
         self.descp_entry.delete('0', 'end')
@@ -495,60 +664,83 @@ class ItemIn(tk.Toplevel):
         self.quantity_entry.delete('0', 'end')
         self.remarks_entry.delete('0', 'end')
 
+    def addbatch(self):
+        # Queue the line as it is typed, the whole batch is checked
+        # when it is posted.
+        self.batch.add((self.itemcode_entry.get().strip(),
+                        self.descp_entry.get(),
+                        self.unit_entry.get(),
+                        self.quantity_entry.get().strip(),
+                        self.rate_entry.get().strip(),
+                        self.date_entry.get().strip(),
+                        self.remarks_entry.get()
+                        ))
+        self.clearentries()
+        self.itemcode_entry.focus_set()
+        autopost = get_settings()['entry'].getint('autopost')
+        if autopost > 0 and len(self.batch) >= autopost:
+            self.postbatch()
+
+    def postbatch(self):
+        # A batch is being saved, an automatic post waits for the next line.
+        if self.batch.post_btn.instate(['disabled']):
+            return
+        lines = self.batch.batch()
+        if not lines:
+            return
+        errors = self.store.check_batch(lines)
+        if errors:
+            messagebox.showwarning('Post', self.batch.mark(errors), parent=self)
+            return
+        synchronous = get_settings()['entry'].get('synchronous')
+        posted = self.batch.keys()
+        self.batch.post_btn.config(state='disabled')
+        submitwrite(self, lambda store: store.post_batch(INCOMING, lines, synchronous),
+                    lambda rows: self.posted(posted, rows), 'Post')
+
+    def posted(self, posted, rows):
+        self.batch.post_btn.config(state='normal')
+        if rows is None:
+            return
+        for row in rows:
+            self.virtual.append(row)
+        # Lines queued while the batch was saved stay in the batch.
+        self.batch.discard(posted)
+
     def refreshlist(self, event):
-        print(event.char)
         if event.keysym == 'Return':
+            # Return runs the ranked full text search instead of
+            # waiting for the type-ahead filter.
+            self.typeahead.cancel()
             if self.searchitem_entry.get() == '':
                 self.insertitemlist()
             else:
-                item = self.searchitem_entry.get()
-                # test = "SELECT itemcode FROM item WHERE itemcode MATCH :?", (item)
-                model = "SELECT itemcode FROM item WHERE itemcode=" + item
-                dataquery = self.cur.execute(model)
-                datafetch = dataquery.fetchall()
-                for data in datafetch:
-                    print(data[0])
-                    self.itemlistbox.delete('0', 'end')
-                    self.itemlistbox.insert('end', data[0])
+                items = self.store.search_items(self.searchitem_entry.get(),
+                                                self.typeahead.limit)
+                self.itemlistbox.delete('0', 'end')
+                for item in items:
+                    self.itemlistbox.insert('end', item.itemcode)
+
+    def countdetails(self):
+        return self.store.count_transactions(INCOMING)
+
+    def fetchdetails(self, offset, limit, after):
+        # Continue from the last rowid of the previous page when it is
+        # known, otherwise skip to the offset of the page.
+        if after is not None:
+            after = after.rowid
+        return self.store.list_transactions(INCOMING, offset, limit, after)
 
     def insertdetails(self):
-        # Check if there is any data in the treeview
-        # if so delete and load the list again.
-        if len(self.display_tree.get_children()) != 0:
-            child = self.display_tree.get_children()
-            for item in child:
-                self.display_tree.delete(item)
-
-        # Initialize the database.
-        data = self.cur.execute("""SELECT * FROM incoming""")
-        rows = data.fetchall()
-
-        # insert the report into the tree.
-        counter = 1
-        for row in rows:
-            if counter % 2 == 0:
-                self.display_tree.insert('', 'end', str(row[0]), text=str(row[0]), tag=('evenrow',))
-            else:
-                self.display_tree.insert('', 'end', str(row[0]), text=str(row[0]), tag=('oddrow',))
-            self.display_tree.set(str(row[0]), self.column[0], str(row[6]))
-            self.display_tree.set(str(row[0]), self.column[1], str(row[1]))
-            self.display_tree.set(str(row[0]), self.column[2], str(row[2]))
-            self.display_tree.set(str(row[0]), self.column[3], str(row[3]))
-            self.display_tree.set(str(row[0]), self.column[4], str(row[5]))
-            self.display_tree.set(str(row[0]), self.column[5], str(row[4]))
-            self.display_tree.set(str(row[0]), self.column[6], str(row[4] * row[5]))
-            self.display_tree.set(str(row[0]), self.column[7], str(row[7]))
-            counter += 1
+        # Count the transactions again and load the rows of the
+        # current view into the treeview.
+        self.virtual.refresh()
 
     def quitApp(self):
-        # Check first if the database is open, if so close it.
-        if self.database:
-            try:
-                self.database.commit()
-            except sqlite3.Error:
-                self.database.rollback()
-            self.cur.close()
-            self.database.close()
+        if len(self.batch) != 0:
+            if not messagebox.askyesno('Quit', 'The batch has not been posted.\n\n'
+                                       'Discard its lines?', parent=self):
+                return
         self.destroy()
 
 
@@ -561,15 +753,10 @@ class ItemMaster(tk.Toplevel):
         self.grab_set()
 
         # Set the icon of the window.
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        try:
-            self.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self)
 
-        # Initialize the database.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
+        # Get the inventory store of the shared database.
+        self.store = get_store()
 
         # Create 3 main container of the window.
         self.upperframe = tk.Frame(self)
@@ -633,6 +820,10 @@ class ItemMaster(tk.Toplevel):
                                     command=self.quitApp
                                     )
         self.close_btn.pack(anchor='e', pady=5)
+        self.status_label = ttk.Label(self.buttonframe)
+        self.status_label.pack(side='left', padx=5)
+        self.load_job = None
+        self.inserter = None
 
         # Create the heading of the treeview.
         column = ('itemcode', 'description', 'unit')
@@ -659,17 +850,20 @@ class ItemMaster(tk.Toplevel):
         self.displayitem()
 
     def additem(self):
-        self.cur.execute("INSERT INTO item VALUES(null, ?, ?, ?)",
-                         (self.item_code_entry.get(),
-                          self.item_desc_entry.get(),
-                          self.item_unit_entry.get())
-                         )
-        try:
-            self.database.commit()
-            tk.messagebox.showinfo('Save', 'Saving complete.', parent=self.master)
-        except sqlite3.Error:
-            self.database.rollback()
-            tk.messagebox.showwarning('Save', 'An Error Occured.', parent=self.master)
+        itemcode = self.item_code_entry.get()
+        description = self.item_desc_entry.get()
+        unit = self.item_unit_entry.get()
+        self.add_btn.config(state='disabled')
+        submitwrite(self, lambda store: store.add_item(itemcode, description, unit),
+                    self.itemadded)
+
+    def itemadded(self, rowid):
+        self.add_btn.config(state='normal')
+        if rowid is None:
+            return
+        # The item master has changed behind the shared store.
+        self.store.forget_items()
+        tk.messagebox.showinfo('Save', 'Saving complete.', parent=self.master)
 
         # Clear the entries.
         self.item_code_entry.delete(0, 'end')
@@ -685,29 +879,7 @@ class ItemMaster(tk.Toplevel):
 
     def additem_event(self, event):
         if event.keysym == 'Return':
-            print('item added')
-            self.cur.execute("INSERT INTO item VALUES(null, ?, ?, ?)",
-                             (self.item_code_entry.get(),
-                              self.item_desc_entry.get(),
-                              self.item_unit_entry.get())
-                             )
-            try:
-                self.database.commit()
-                tk.messagebox.showinfo('Save', 'Saving complete.', parent=self.master)
-            except sqlite3.Error:
-                self.database.rollback()
-
-            # Clear the entries.
-            self.item_code_entry.delete(0, 'end')
-            self.item_code_entry.insert(0, '')
-            self.item_desc_entry.delete(0, 'end')
-            self.item_desc_entry.insert(0, '')
-            self.item_unit_entry.delete(0, 'end')
-            self.item_unit_entry.insert(0, '')
-
-            # Refresh the list of items.
-            self.displayitem()
-            self.item_code_entry.focus_set()
+            self.additem()
 
     def deleteitem(self):
         try:
@@ -719,17 +891,11 @@ class ItemMaster(tk.Toplevel):
 
             # If answer from askifsure variable is True, delete the item.
             if askifsure is True:
-                self.cur.execute("DELETE FROM item WHERE rowid = ?",
-                                 (self.item_display.selection()[0]))
-                try:
-                    self.database.commit()
-                except sqlite3.Error:
-                    self.database.rollback()
-                # Show if the item has been remove from the database.
-                tk.messagebox.showinfo('Information',
-                                       "Item deleted from the database.",
-                                       parent=self.master
-                                       )
+                rowid = self.item_display.selection()[0]
+                self.delete_btn.config(state='disabled')
+                submitwrite(self, lambda store: store.delete_item(rowid),
+                            self.itemdeleted, 'Warning')
+                return
             # Else do nothing and prompt an info that no item was deleted.
             else:
                 tk.messagebox.showinfo('Information',
@@ -747,55 +913,100 @@ class ItemMaster(tk.Toplevel):
         self.displayitem()
         self.item_code_entry.focus_set()
 
+    def itemdeleted(self, deleted):
+        self.delete_btn.config(state='normal')
+        if deleted is not None:
+            self.store.forget_items()
+            # Show if the item has been remove from the database.
+            tk.messagebox.showinfo('Information',
+                                   "Item deleted from the database.",
+                                   parent=self.master
+                                   )
+        # Refresh the table and set the focus to item code entry.
+        self.displayitem()
+        self.item_code_entry.focus_set()
+
     def searchitem(self):
-        print('item search')
-        hello = tk.messagebox.askokcancel('Warning',
-                                          'This is a test.',
-                                          parent=self.master
-                                          )
-        print(hello)
+        """
+        This method is for finding items by the start of any word of
+        their item code or description, the best matches are listed
+        first. An empty search shows all the items again.
+        """
+        text = simpledialog.askstring('Search', 'Item code or description:',
+                                      parent=self)
+        if text is None:
+            return
+        if text.strip() == '':
+            self.displayitem()
+        else:
+            self.displayitem(text)
 
-    def displayitem(self):
+    def displayitem(self, text=None):
+        """
+        This method is for loading the items, or the items matching the
+        search text, on the database worker and showing them once they
+        have been read. The window keeps responding in the meantime.
+        """
+        self.cancelload()
+        if text is None:
+            function = lambda store: list(store.items())
+        else:
+            function = lambda store: store.search_items(text)
+        self.status_label.config(text='Loading...')
+        self.load_job = get_worker().submit(function,
+                                            callback=self.showitems,
+                                            error=self.loaderror)
+
+    def showitems(self, items):
+        self.load_job = None
         # Check if there is any data in the treeview
         # if so delete and load the list again.
-        if len(self.item_display.get_children()) != 0:
-            child = self.item_display.get_children()
-            for item in child:
-                self.item_display.delete(item)
-
-        # Initialize the database.
-        data = self.cur.execute("SELECT * FROM item")
-        data_list = data.fetchall()
-        column = ('itemcode', 'description', 'unit')
-        counter = 1
-        if len(data_list) > 0:
-            for num in data_list:
-                if counter % 2 == 0:
-                    self.item_display.insert('',
-                                             'end',
-                                             str(num[0]),
-                                             text=str(num[0]),
-                                             tag='evenrow'
-                                             )
-                else:
-                    self.item_display.insert('',
-                                             'end',
-                                             str(num[0]),
-                                             text=str(num[0]),
-                                             tag='oddrow'
-                                             )
-                self.item_display.set(str(num[0]), column[0], str(num[1]))
-                self.item_display.set(str(num[0]), column[1], str(num[2]))
-                self.item_display.set(str(num[0]), column[2], str(num[3]))
-                counter += 1
+        children = self.item_display.get_children()
+        if len(children) != 0:
+            self.item_display.delete(*children)
+
+        # Insert the items with one call for each row.
+        self.counter = 1
+        self.inserter = BatchInserter(self.item_display, items,
+                                      self.insertitem, self.loaded).start()
         self.item_code_entry.focus_set()
 
+    def insertitem(self, item):
+        if self.counter % 2 == 0:
+            tag = 'evenrow'
+        else:
+            tag = 'oddrow'
+        self.item_display.insert('',
+                                 'end',
+                                 str(item.rowid),
+                                 text=str(item.rowid),
+                                 values=[str(item.itemcode),
+                                         str(item.description),
+                                         str(item.unit)
+                                         ],
+                                 tag=tag
+                                 )
+        self.counter += 1
+
+    def loaded(self):
+        self.inserter = None
+        self.status_label.config(text='')
+
+    def loaderror(self, message):
+        self.load_job = None
+        self.status_label.config(text='')
+        messagebox.showwarning('Warning', 'An Error Occured.\n\n' + message,
+                               parent=self)
+
+    def cancelload(self):
+        get_worker().cancel(self.load_job)
+        self.load_job = None
+        if self.inserter is not None:
+            self.inserter.cancel()
+            self.inserter = None
+
     def quitApp(self):
-        # Check whether the database is open, if so close it.
-        if self.database:
-            self.cur.close()
-            self.database.close()
-            print('Database successfully closed.')
+        self.cancelload()
         self.grab_release()
         self.destroy()
 
@@ -808,11 +1019,7 @@ class CompanyDetails(tk.Toplevel):
         self.protocol('WM_DELETE_WINDOW', self.quitApp)
         self.grab_set()
         self.resizable(0, 0)
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        try:
-            self.master.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self)
 
         # Create a header label for the company details.
         self.company_details = ttk.Label(self, text='COMPANY DETAILS',
@@ -825,27 +1032,22 @@ class CompanyDetails(tk.Toplevel):
         self.mainframe = tk.Frame(self, bd=1, relief='sunken')
         self.mainframe.pack(expand=True, fill='both', padx=5, pady=5)
 
-        # Initialize the database.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
+        # Get the inventory store of the shared database.
+        self.store = get_store()
 
         # Select the details.
-        self.data = self.cur.execute("SELECT * FROM company").fetchall()
+        self.data = self.store.company()
 
         name = ['ORGANIZATION NAME: ', 'ADDRESS: ', 'TELEPHONE: ', 'FAX: ', 'E-MAIL: ']
         counter = 0
-        for rows in self.data:
-            for row in rows:
+        if self.data is not None:
+            for row in self.data:
                 if row == '':
                     row = 'None'
                 ttk.Label(self.mainframe, text=name[counter]+row).pack(anchor='w', padx=5, pady=5)
                 counter += 1
 
     def quitApp(self):
-        # Check whether the database is open or not, if so close it.
-        if self.database:
-            self.cur.close()
-            self.database.close()
         # Finally destroy the window on exit.
         self.grab_release()
         self.destroy()
@@ -864,64 +1066,15 @@ class CreateDatabase:
         self.com_telephone = com_telephone
         self.com_fax = com_fax
         self.com_email = com_email
-        # Create the database.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
 
     def create(self):
-        # Create item table.
-        self.cur.execute("""
-            CREATE TABLE item(rowid INTEGER PRIMARY KEY,
-                itemcode TEXT,
-                description TEXT,
-                unit TEXT)
-            """)
-        # Create incoming transaction table.
-        self.cur.execute("""
-            CREATE TABLE incoming(rowid INTEGER PRIMARY KEY,
-                itemcode TEXT,
-                description TEXT,
-                unit TEXT,
-                quantity REAL,
-                rate REAL,
-                date DATE,
-                remarks TEXT)
-            """)
-        # Create outgoing transaction table.
-        self.cur.execute("""
-            CREATE TABLE outgoing(rowid INTEGER PRIMARY KEY,
-                itemcode TEXT,
-                description TEXT,
-                unit TEXT,
-                quantity REAL,
-                rate REAL,
-                date DATE,
-                remarks TEXT)
-            """)
-        # Create company details.
-        self.cur.execute("""
-            CREATE TABLE company(com_name TEXT,
-                com_address TEXT,
-                com_telephone TEXT,
-                com_fax TEXT,
-                com_email TEXT)
-            """)
-        # Insert company details.
-        self.cur.execute("INSERT INTO company VALUES(?, ?, ?, ?, ?)",
-                         (self.com_name,
-                          self.com_address,
-                          self.com_telephone,
-                          self.com_fax,
-                          self.com_email))
-        # Apply the changes.
-        try:
-            self.database.commit()
-        except sqlite3.Error:
-            self.database.rollback()
-        # Close the database.
-        if self.database:
-            self.cur.close()
-            self.database.close()
+        # Create the tables of the latest schema version
+        # and insert the company details.
+        get_store().create((self.com_name,
+                            self.com_address,
+                            self.com_telephone,
+                            self.com_fax,
+                            self.com_email))
 
 
 class Reports(tk.Toplevel):
@@ -937,20 +1090,38 @@ class Reports(tk.Toplevel):
         container.pack(fill='both', expand=True)
 
         # Set the window icon.
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        try:
-            self.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self)
 
-        # Initialize the database.
-        self.database = sqlite3.connect('inv_database.db')
-        self.cur = self.database.cursor()
+        # Get the inventory store of the shared database.
+        self.store = get_store()
 
         # Create a label for the window.
         report_label = ttk.Label(container, text='Stock Report')
         report_label.pack(padx=7, pady=7)
         report_label.config(font=('Helvetica', 15, 'bold'))
+        self.status_label = ttk.Label(container)
+        self.status_label.pack()
+        self.load_job = None
+        self.inserter = None
+
+        # Create the entries of the date range of the report. Without
+        # dates the report shows the current balances, with only the
+        # To date the balances as of that date.
+        range_frame = tk.Frame(container)
+        range_frame.pack(anchor='w', padx=5, pady=5)
+        ttk.Label(range_frame, text='From:').pack(side='left')
+        self.from_entry = ttk.Entry(range_frame, width=12)
+        self.from_entry.pack(side='left', padx=5)
+        ttk.Label(range_frame, text='To:').pack(side='left')
+        self.to_entry = ttk.Entry(range_frame, width=12)
+        self.to_entry.pack(side='left', padx=5)
+        self.show_btn = ttk.Button(range_frame, text='Show',
+                                   command=self.showRange)
+        self.show_btn.pack(side='left', padx=5)
+        ttk.Label(range_frame, text='(YYYY-MM-DD)').pack(side='left')
+        self.valuation_btn = ttk.Button(range_frame, text='Valuation',
+                                        command=self.showValuation)
+        self.valuation_btn.pack(side='left', padx=5)
 
         # Create container for the treeview and scrollbar.
         display_frame = tk.Frame(container)
@@ -970,17 +1141,25 @@ class Reports(tk.Toplevel):
         self.headers = ('Item Code',
                         'Description',
                         'Unit',
+                        'Opening',
                         'In',
                         'Out',
-                        'Balance'
+                        'Balance',
+                        'Avg Cost',
+                        'Avg Value',
+                        'FIFO Value'
                         )
 
         self.column = ('itemcode',
                        'description',
                        'unit',
+                       'opening',
                        'incoming',
                        'outgoing',
-                       'balance'
+                       'balance',
+                       'cost',
+                       'average',
+                       'fifo'
                        )
 
         # Set the column of the tree.
@@ -995,6 +1174,8 @@ class Reports(tk.Toplevel):
                 setwidth = 85
             elif head == 'description':
                 setwidth = 180
+            elif head in ('cost', 'average', 'fifo'):
+                setwidth = 70
             else:
                 setwidth = 50
             self.display_tree.heading(head, text=self.headers[counter])
@@ -1005,6 +1186,7 @@ class Reports(tk.Toplevel):
         self.display_tree.tag_configure('oddrow', background='#FDA46A')
 
         # Insert the details to the tree.
+        self.report = ('balances', ())
         self.insertDetails()
 
         # Create a button below the treeview for exporting
@@ -1014,42 +1196,147 @@ class Reports(tk.Toplevel):
                                      )
         self.export_btn.pack()
 
-    def insertDetails(self):
+        # Create the progress bar and cancel button of the export,
+        # they are only shown while the export is running.
+        self.export_thread = None
+        self.export_job = None
+        self.progress_frame = tk.Frame(self)
+        self.progress_label = ttk.Label(self.progress_frame, text='Exporting...')
+        self.progress_label.pack(side='left', padx=5)
+        self.progress_bar = ttk.Progressbar(self.progress_frame,
+                                            orient='horizontal',
+                                            length=200,
+                                            mode='determinate'
+                                            )
+        self.progress_bar.pack(side='left', padx=5, pady=5)
+        self.cancel_btn = ttk.Button(self.progress_frame, text='Cancel',
+                                     command=self.cancelExport
+                                     )
+        self.cancel_btn.pack(side='left', padx=5)
+
+    def showRange(self):
+        """
+        This method is for showing the report of the dates entered,
+        the opening and closing balance of each item over a date range
+        or the balance of each item as of a date.
+        """
+        dates = []
+        for entry in (self.from_entry, self.to_entry):
+            value = entry.get().strip()
+            if value == '':
+                dates.append(None)
+                continue
+            try:
+                dates.append(datetime.strptime(value, '%Y-%m-%d').date())
+            except ValueError:
+                messagebox.showwarning('Warning',
+                                       'Please enter the dates as YYYY-MM-DD.',
+                                       parent=self)
+                return
+        start, end = dates
+        if start is not None and end is None:
+            end = date.today()
+        if start is not None and start > end:
+            messagebox.showwarning('Warning',
+                                   'The From date is after the To date.',
+                                   parent=self)
+            return
+        self.insertDetails(start, end)
+
+    def showValuation(self):
+        """
+        This method is for showing the value of the stock of each item
+        by weighted average cost and by FIFO.
+        """
+        self.insertDetails(valuation=True)
+
+    def insertDetails(self, start=None, end=None, valuation=False):
         """
         This method is for inserting all the details from the database
         to the treeview so that it can be shown to the user the total
         incoming and outgoing items and the balance for each items in the
         item master listing.
         """
-        # Combine incoming and outgoing material
-        item_table = self.cur.execute("SELECT * FROM item")
-        item_table_fetch = item_table.fetchall()
-        in_table = self.cur.execute("SELECT itemcode, quantity FROM incoming")
-        in_table_fetch = in_table.fetchall()
-        out_table = self.cur.execute("SELECT itemcode, quantity FROM outgoing")
-        out_table_fetch = out_table.fetchall()
-
-        counter = 1
-        for elem in item_table_fetch:
-            if counter % 2 == 0:
-                self.display_tree.insert('', 'end', str(elem[0]), text=str(elem[0]), tag=('evenrow',))
-            else:
-                self.display_tree.insert('', 'end', str(elem[0]), text=str(elem[0]), tag=('oddrow',))
-            self.display_tree.set(str(elem[0]), self.column[0], str(elem[1]))
-            self.display_tree.set(str(elem[0]), self.column[1], str(elem[2]))
-            self.display_tree.set(str(elem[0]), self.column[2], str(elem[3]))
-            itotal = 0
-            for inqty in in_table_fetch:
-                if inqty[0] == elem[1]:
-                    itotal += inqty[1]
-            self.display_tree.set(str(elem[0]), self.column[3], str(itotal))
-            ototal = 0
-            for outqty in out_table_fetch:
-                if outqty[0] == elem[1]:
-                    ototal += outqty[1]
-            self.display_tree.set(str(elem[0]), self.column[4], str(ototal))
-            self.display_tree.set(str(elem[0]), self.column[5], str(itotal + ototal))
-            counter += 1
+        self.cancelLoad()
+        children = self.display_tree.get_children()
+        if len(children) != 0:
+            self.display_tree.delete(*children)
+        # The rows always have the opening column, it is only shown
+        # for a date range.
+        if valuation:
+            # The saved costs are brought up to date first, only the
+            # transactions recorded since the last valuation are read.
+            def function(store):
+                store.update_valuation()
+                return [row[:4] + ('', '', '', row[4])
+                        + tuple('%.2f' % value for value in row[5:])
+                        for row in store.valuation()]
+            columns = ('itemcode', 'description', 'unit', 'balance', 'cost', 'average', 'fifo')
+            closing = 'Quantity'
+            report = ('valuation', ())
+        elif end is None:
+            function = lambda store: [row[:4] + ('',) + row[4:] for row in
+                                      store.balances()]
+            columns = ('itemcode', 'description', 'unit', 'incoming', 'outgoing', 'balance')
+            closing = 'Balance'
+            report = ('balances', ())
+        elif start is None:
+            # The in and out columns of the rows are the movements of the
+            # day alone, only the balance is shown.
+            function = lambda store: list(store.balances_as_of(end))
+            columns = ('itemcode', 'description', 'unit', 'balance')
+            closing = 'Balance'
+            report = ('as_of', (end,))
+        else:
+            function = lambda store: list(store.period_balances(start, end))
+            columns = self.column
+            closing = 'Closing'
+            report = ('period', (start, end))
+        self.display_tree['displaycolumns'] = columns
+        self.display_tree.heading('balance', text=closing)
+        # The export writes the report that is shown.
+        self.report = report
+        # The balances are read on the database worker and inserted a
+        # batch at a time so the window is shown and keeps responding.
+        self.status_label.config(text='Loading...')
+        self.load_job = get_worker().submit(function,
+                                            callback=self.showDetails,
+                                            error=self.loadError)
+
+    def showDetails(self, rows):
+        self.load_job = None
+        self.counter = 1
+        self.inserter = BatchInserter(self.display_tree, rows,
+                                      self.insertRow, self.loaded).start()
+
+    def insertRow(self, elem):
+        if self.counter % 2 == 0:
+            tag = ('evenrow',)
+        else:
+            tag = ('oddrow',)
+        self.display_tree.insert('', 'end', str(elem[0]),
+                                 text=str(elem[0]),
+                                 values=[str(value) for value in elem[1:]],
+                                 tag=tag
+                                 )
+        self.counter += 1
+
+    def loaded(self):
+        self.inserter = None
+        self.status_label.config(text='')
+
+    def loadError(self, message):
+        self.load_job = None
+        self.status_label.config(text='')
+        messagebox.showwarning('Warning', 'An Error Occured.\n\n' + message,
+                               parent=self)
+
+    def cancelLoad(self):
+        get_worker().cancel(self.load_job)
+        self.load_job = None
+        if self.inserter is not None:
+            self.inserter.cancel()
+            self.inserter = None
 
     def exportFile(self):
         """
@@ -1059,71 +1346,94 @@ class Reports(tk.Toplevel):
         so that it can be print into the printer with ease and report can
         be easily forwarded via e-mail.
         """
-        # Initialize the data to be shown
-        item_table = self.cur.execute("SELECT * FROM item")
-        item_table_fetch = item_table.fetchall()
-        in_table = self.cur.execute("SELECT itemcode, quantity FROM incoming")
-        in_table_fetch = in_table.fetchall()
-        out_table = self.cur.execute("SELECT itemcode, quantity FROM outgoing")
-        out_table_fetch = out_table.fetchall()
-
-        # Start saving it into a csv file.
-        with open('exportfile.csv', 'w', newline='') as csvfile:
-            cwriter = csv.writer(csvfile, delimiter=',',
-                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            # Write the title of the report.
-            cwriter.writerow(['Stock Report - Al Hamra Maintenance'])
-            # Then write the header of the report.
-            cwriter.writerow(['S. No.',
-                              'Item Code',
-                              'Description',
-                              'Unit',
-                              'In',
-                              'Out',
-                              'Balance'
-                              ])
-            # Start writing the details into the csv file.
-            for row in item_table_fetch:
-
-                # Check the itemcode if there is any in transaction.
-                # if so, sum the quantity of that transaction.
-                itotal = 0
-                for inqty in in_table_fetch:
-                    if inqty[0] == row[1]:
-                        itotal += inqty[1]
-
-                ototal = 0
-
-                # Check the itemcode if there is any out transaction.
-                # if so, sum the quantity of that transaction.
-                for outqty in out_table_fetch:
-                    if outqty[0] == row[1]:
-                        ototal += outqty[1]
-                # Start writing the details in the csv file.
-                cwriter.writerow([row[0],
-                                  row[1],
-                                  row[2],
-                                  row[3],
-                                  itotal,
-                                  ototal,
-                                  itotal+ototal
-                                  ])
-        # Once all the details has been saved to the excel.
-        # Show some confirmation.
-        # Declare also a location variable so that it can be
-        # shown to the user where the file has been saved.
-        location = "Report has been exported to csv file.\n\n" + "Location: " + os.getcwd()
-        messagebox.showinfo('Information', location)
+        if self.export_thread is not None:
+            return
+        export = get_settings()['export']
+        filename = filedialog.asksaveasfilename(parent=self,
+                                                title='Export',
+                                                initialfile=export.get('filename'),
+                                                defaultextension='.csv',
+                                                filetypes=[('CSV files', '*.csv')]
+                                                )
+        if not filename:
+            return
+        company = self.store.company()
+        if company is None:
+            name = ''
+        else:
+            name = company.name
+        title = simpledialog.askstring('Export', 'Report title:',
+                                       initialvalue=export.get('title').format(company=name),
+                                       parent=self
+                                       )
+        if title is None:
+            return
+
+        # Write the file on a worker thread with its own connection
+        # so the window keeps responding during a long export.
+        from application.export import ExportThread
+        from application.export import write_as_of
+        from application.export import write_balances
+        from application.export import write_period
+        from application.export import write_valuation
+        writers = {'valuation': write_valuation,
+                   'balances': write_balances,
+                   'as_of': write_as_of,
+                   'period': write_period}
+        kind, args = self.report
+        self.export_thread = ExportThread(get_database(), filename, title,
+                                          write=writers[kind], args=args)
+        self.export_btn.config(state='disabled')
+        self.progress_bar.config(value=0, maximum=1)
+        self.progress_frame.pack()
+        self.export_thread.start()
+        self.export_job = self.after(100, self.checkExport)
+
+    def checkExport(self):
+        """
+        Read the messages of the export thread and update the progress
+        bar until the export has finished.
+        """
+        finished = False
+        while True:
+            try:
+                message = self.export_thread.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                self.progress_bar.config(value=message[1], maximum=max(1, message[2]))
+            else:
+                finished = True
+                break
+        if not finished:
+            self.export_job = self.after(100, self.checkExport)
+            return
+
+        self.export_thread = None
+        self.export_job = None
+        self.progress_frame.pack_forget()
+        self.export_btn.config(state='normal')
+        # Once all the details has been saved show some confirmation
+        # and where the file has been saved.
+        if message[0] == 'done':
+            location = "Report has been exported to csv file.\n\n" + "Location: " + message[1]
+            messagebox.showinfo('Information', location, parent=self)
+        elif message[0] == 'error':
+            messagebox.showwarning('Export', 'An Error Occured.\n\n' + message[1], parent=self)
+
+    def cancelExport(self):
+        if self.export_thread is not None:
+            self.export_thread.cancel()
 
     def quitApp(self):
         """
         This method was created for properly shutting down
-        the application. And for the database to close properly.
+        the application.
         """
-        if self.database:
-            self.cur.close()
-            self.database.close()
-            print('Database has been closed.')
+        self.cancelExport()
+        if self.export_job is not None:
+            self.after_cancel(self.export_job)
+        self.cancelLoad()
         self.destroy()
 
 
@@ -1148,9 +1458,10 @@ class LicenseWindow(tk.Toplevel):
         close_btn.pack(padx=5, pady=5)
 
     def insertDetails(self):
-        lic_file = open("LICENSE", 'r')
-        data = lic_file.read()
-        lic_file.close()
+        try:
+            data = license_text()
+        except OSError as error:
+            data = 'Unable to read the license.\n\n' + str(error)
 
         self.lic_text.insert('end', data)
         self.lic_text.config(state='disabled')
@@ -1159,6 +1470,129 @@ class LicenseWindow(tk.Toplevel):
         self.destroy()
 
 
+class Diagnostics(tk.Toplevel):
+
+    def __init__(self, master):
+        """
+        Initialize the window showing where the time of the application
+        goes, the statements taking the most time, their query plan and
+        the time spent filling the treeviews of each window.
+        """
+        tk.Toplevel.__init__(self, master)
+        self.title('Diagnostics')
+        self.protocol('WM_DELETE_WINDOW', self.quitApp)
+        from application.trace import get_tracer
+        self.tracer = get_tracer()
+        self.statements = []
+
+        container = tk.Frame(self)
+        container.pack(expand=True, fill='both', padx=5, pady=5)
+        if not self.tracer.enabled:
+            ttk.Label(container,
+                      text='Tracing is disabled in the [trace] section of the settings.'
+                      ).pack(anchor='w')
+
+        # Create the treeview of the statements.
+        ttk.Label(container, text='Statements (select one for its query plan):').pack(anchor='w')
+        statement_frame = tk.Frame(container)
+        statement_frame.pack(expand=True, fill='both')
+        self.statement_tree = ttk.Treeview(statement_frame, height=12,
+                                           selectmode='browse')
+        self.statement_tree.pack(side='left', expand=True, fill='both')
+        yscrollbar = tk.Scrollbar(statement_frame, command=self.statement_tree.yview)
+        yscrollbar.pack(side='left', fill='y')
+        self.statement_tree.config(yscrollcommand=yscrollbar.set)
+        self.statement_tree['columns'] = ('window', 'calls', 'total', 'longest', 'rows', 'sql')
+        self.statement_tree.column('#0', width=35)
+        self.statement_tree.heading('#0', text='No.')
+        for column, text, width in (('window', 'Window', 160),
+                                    ('calls', 'Calls', 50),
+                                    ('total', 'Total ms', 70),
+                                    ('longest', 'Max ms', 70),
+                                    ('rows', 'Rows', 70),
+                                    ('sql', 'Statement', 400)):
+            self.statement_tree.heading(column, text=text)
+            self.statement_tree.column(column, width=width)
+        self.statement_tree.bind('<<TreeviewSelect>>', self.showPlan)
+
+        # Create the text of the query plan.
+        ttk.Label(container, text='Query plan:').pack(anchor='w')
+        self.plan_text = scrolledtext.ScrolledText(container, height=8)
+        self.plan_text.pack(fill='both')
+        self.plan_text.config(state='disabled')
+
+        # Create the treeview of the time spent filling the treeviews.
+        ttk.Label(container, text='Treeview updates:').pack(anchor='w')
+        self.render_tree = ttk.Treeview(container, height=5)
+        self.render_tree.pack(fill='both')
+        self.render_tree['columns'] = ('calls', 'total', 'longest', 'rows')
+        self.render_tree.heading('#0', text='Window')
+        for column, text in (('calls', 'Calls'),
+                             ('total', 'Total ms'),
+                             ('longest', 'Max ms'),
+                             ('rows', 'Rows')):
+            self.render_tree.heading(column, text=text)
+            self.render_tree.column(column, width=80)
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(pady=5)
+        ttk.Button(button_frame, text='Refresh', command=self.insertDetails).pack(side='left', padx=5)
+        ttk.Button(button_frame, text='Reset', command=self.resetDetails).pack(side='left', padx=5)
+        ttk.Button(button_frame, text='Close', command=self.quitApp).pack(side='left', padx=5)
+
+        self.insertDetails()
+
+    def insertDetails(self):
+        """
+        This method is for showing the statements and the treeview
+        updates taking the most time since the start or the last reset.
+        """
+        for tree in (self.statement_tree, self.render_tree):
+            children = tree.get_children()
+            if len(children) != 0:
+                tree.delete(*children)
+        self.statements = self.tracer.top_statements()
+        for number, stats in enumerate(self.statements):
+            self.statement_tree.insert('', 'end', str(number), text=str(number + 1),
+                                       values=[stats.window,
+                                               stats.calls,
+                                               '%.1f' % (stats.total * 1000),
+                                               '%.1f' % (stats.longest * 1000),
+                                               stats.rows,
+                                               ' '.join(stats.sql.split())
+                                               ])
+        for stats in self.tracer.top_renders():
+            self.render_tree.insert('', 'end', text=stats.window,
+                                    values=[stats.calls,
+                                            '%.1f' % (stats.total * 1000),
+                                            '%.1f' % (stats.longest * 1000),
+                                            stats.rows
+                                            ])
+
+    def showPlan(self, event):
+        selection = self.statement_tree.selection()
+        if not selection:
+            return
+        stats = self.statements[int(selection[0])]
+        from application.trace import explain
+        try:
+            plan = '\n'.join(explain(get_database().connect(), stats.sql,
+                                      stats.parameters))
+        except (sqlite3.Error, ValueError) as error:
+            plan = 'No query plan: %s' % error
+        self.plan_text.config(state='normal')
+        self.plan_text.delete('1.0', 'end')
+        self.plan_text.insert('end', ' '.join(stats.sql.split()) + '\n\n' + plan)
+        self.plan_text.config(state='disabled')
+
+    def resetDetails(self):
+        self.tracer.reset()
+        self.insertDetails()
+
+    def quitApp(self):
+        self.destroy()
+
+
 class AboutDialog(tk.Toplevel):
 
     def __init__(self, master):
@@ -1169,12 +1603,7 @@ class AboutDialog(tk.Toplevel):
         container = tk.Frame(self)
         container.pack(fill='both', expand=True, padx=5, pady=5)
         self.grab_set()
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        print(self.iconlocation)
-        try:
-            self.master.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self)
         # Create style.
         style = ttk.Style()
         style.configure('appname.TLabel',
@@ -1256,27 +1685,16 @@ class MainWindow(tk.Frame):
         # Disable maximize window.
         self.master.resizable(0, 0)
         self.pack(fill='both', expand=True, padx=5, pady=5)
-        self.iconlocation = os.getcwd() + "/tsicon.ico"
-        try:
-            self.master.iconbitmap(self.iconlocation)
-        except:
-            pass
+        window_icon(self.master)
 
         # Create menu bar of the main window.
         self.menubar = tk.Menu(self)
         self.master.config(menu=self.menubar)
-        self.filemenu = tk.Menu(self.menubar, tearoff=0)
-        self.helpmenu = tk.Menu(self.menubar, tearoff=0)
-        self.optionmenu = tk.Menu(self.menubar, tearoff=0)
-        self.menubar.add_cascade(label='File', menu=self.filemenu)
-        self.menubar.add_cascade(label='Option', menu=self.optionmenu)
-        self.menubar.add_cascade(label='Help', menu=self.helpmenu)
-        self.filemenu.add_command(label='Quit', command=self.quitApp)
-        self.helpmenu.add_command(label='License', command=self.licenseWindow)
-        self.helpmenu.add_command(label='Company', command=self.companyDetails)
-        self.helpmenu.add_separator()
-        self.helpmenu.add_command(label='About', command=self.aboutDialog)
-        self.optionmenu.add_command(label='Edit Company', command=self.updateDetails)
+        # The entries of the menus are only added the first time the
+        # menu is opened.
+        self.filemenu = self.lazyMenu(self.menubar, 'File', self.fileMenu)
+        self.optionmenu = self.lazyMenu(self.menubar, 'Option', self.optionMenu)
+        self.helpmenu = self.lazyMenu(self.menubar, 'Help', self.helpMenu)
 
         # Create 4 buttons for item master, incoming, outgoing, and reports.
         self.item_master_btn = ttk.Button(self, text='Item Master',
@@ -1293,38 +1711,304 @@ class MainWindow(tk.Frame):
                                      command=self.showReport)
         self.report_btn.grid(row=0, column=3)
 
+        # Progress of a running import, shown only during the import.
+        self.import_thread = None
+        self.import_job = None
+        self.import_label = ttk.Label(self)
+        self.import_label.grid(row=1, column=0, columnspan=4, sticky='w')
+        self.import_bar = ttk.Progressbar(self, orient='horizontal', mode='determinate')
+        self.import_bar.grid(row=2, column=0, columnspan=4, sticky='we')
+        self.import_label.grid_remove()
+        self.import_bar.grid_remove()
+        # The backup shows its progress in the same place.
+        self.backup_thread = None
+        self.backup_job = None
+
         # Check whether database is available
         # if not create database and tables.
-        if not os.path.isfile('inv_database.db'):
+        if not get_database().exists():
             self.setCompanyDetails()
+        else:
+            self.migrateDatabase()
+
+        # Run the slow reads of the windows in the background, starting
+        # with the closing balances of the periods ended since last time.
+        worker = start_worker(self, get_database().filename, get_database().traced)
+        if get_database().exists():
+            worker.submit(lambda store: store.close_periods(
+                get_settings()['reports'].get('period')),
+                error=lambda message: print('Closing the periods failed:', message))
+
+    def lazyMenu(self, parent, label, build):
+        """
+        Add a cascade menu to parent and return it, its entries are
+        added by build when it is opened for the first time.
+        """
+        menu = tk.Menu(parent, tearoff=0)
+
+        def post():
+            menu.config(postcommand='')
+            build(menu)
+
+        menu.config(postcommand=post)
+        parent.add_cascade(label=label, menu=menu)
+        return menu
+
+    def fileMenu(self, menu):
+        self.importmenu = self.lazyMenu(menu, 'Import', self.importMenu)
+        menu.add_command(label='Backup', command=self.backupDatabase)
+        menu.add_separator()
+        menu.add_command(label='Quit', command=self.quitApp)
+
+    def importMenu(self, menu):
+        from application.importer import ITEMS
+        menu.add_command(label='Items...',
+                         command=lambda: self.importFile(ITEMS))
+        menu.add_command(label='Incoming...',
+                         command=lambda: self.importFile(INCOMING))
+        menu.add_command(label='Outgoing...',
+                         command=lambda: self.importFile(OUTGOING))
+
+    def optionMenu(self, menu):
+        menu.add_command(label='Edit Company', command=self.updateDetails)
+        menu.add_command(label='Rebuild Balances', command=self.rebuildBalances)
+        menu.add_command(label='Archive Transactions...', command=self.archiveTransactions)
+        menu.add_command(label='Diagnostics', command=self.diagnostics)
+
+    def helpMenu(self, menu):
+        menu.add_command(label='License', command=self.licenseWindow)
+        menu.add_command(label='Company', command=self.companyDetails)
+        menu.add_separator()
+        menu.add_command(label='About', command=self.aboutDialog)
+
+    def migrateDatabase(self):
+        """
+        This method is for upgrading the database made by an older
+        version of the application to the latest schema, adding the
+        new tables and indexes without touching the existing records.
+        """
+        try:
+            applied = migrate(get_database().connect())
+            if applied:
+                print('Database upgraded to version', applied[-1])
+        except sqlite3.Error as error:
+            messagebox.showerror('Error',
+                                 'Unable to upgrade the database.\n\n' + str(error),
+                                 parent=self.master
+                                 )
+
+    def rebuildBalances(self):
+        """
+        This method is for recomputing the stock balance of every item
+        from the whole incoming and outgoing transactions in case the
+        running totals need to be repaired.
+        """
+        try:
+            get_store().rebuild_balances()
+            messagebox.showinfo('Information',
+                                'Stock balances have been rebuilt.',
+                                parent=self.master
+                                )
+        except sqlite3.Error:
+            messagebox.showwarning('Warning',
+                                   'An Error Occured.',
+                                   parent=self.master
+                                   )
+
+    def archiveTransactions(self):
+        """
+        This method is for moving the transactions older than a date
+        into the yearly archive files so that the daily work only reads
+        the recent ones. A carried forward balance is left for each item
+        and the reports of the older dates read the archives.
+        """
+        cutoff = simpledialog.askstring('Archive',
+                                        'Archive the transactions dated before (YYYY-MM-DD):',
+                                        initialvalue='%d-01-01' % (date.today().year - 1),
+                                        parent=self.master
+                                        )
+        if cutoff is None:
+            return
+        try:
+            cutoff = datetime.strptime(cutoff.strip(), '%Y-%m-%d').date()
+        except ValueError:
+            messagebox.showwarning('Warning', 'Please enter the date as YYYY-MM-DD.',
+                                   parent=self.master)
+            return
+        if not messagebox.askyesno('Archive',
+                                   'Move the transactions dated before %s into '
+                                   'the yearly archives?' % cutoff,
+                                   parent=self.master):
+            return
+        # The rows are moved on the database worker, it can take a
+        # while for several years of transactions.
+        self.import_label.config(text='Archiving...')
+        self.import_label.grid()
+        get_worker().submit(lambda store: store.archive(cutoff),
+                            callback=self.archived,
+                            error=self.archiveError)
+
+    def archived(self, count):
+        self.import_label.grid_remove()
+        messagebox.showinfo('Information',
+                            '%d transaction(s) have been archived.' % count,
+                            parent=self.master
+                            )
+
+    def archiveError(self, message):
+        self.import_label.grid_remove()
+        messagebox.showwarning('Warning', 'An Error Occured.\n\n' + message,
+                               parent=self.master)
+
+    def backupDatabase(self):
+        """
+        This method is for saving a copy of the database into the backup
+        folder while it is being used, unlike copying the file it can't
+        catch a transaction half written. The copy is checked and the
+        oldest backups are deleted.
+        """
+        if self.backup_thread is not None or self.import_thread is not None:
+            messagebox.showinfo('Backup', 'Please wait for the running task to finish.',
+                                parent=self.master)
+            return
+        database = get_database()
+        if not database.exists():
+            return
+        # Commit what the windows have entered so it is in the backup.
+        database.commit()
+        from application.backup import BackupThread
+        self.backup_thread = BackupThread(database)
+        self.import_label.config(text='Backing up...')
+        self.import_bar.config(value=0, maximum=1)
+        self.import_label.grid()
+        self.import_bar.grid()
+        self.backup_thread.start()
+        self.backup_job = self.after(100, self.checkBackup)
+
+    def checkBackup(self):
+        """
+        Read the messages of the backup thread and update the progress
+        bar until the backup has finished.
+        """
+        finished = False
+        while True:
+            try:
+                message = self.backup_thread.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                self.import_bar.config(value=message[1], maximum=max(1, message[2]))
+            else:
+                finished = True
+                break
+        if not finished:
+            self.backup_job = self.after(100, self.checkBackup)
+            return
+
+        self.backup_thread = None
+        self.backup_job = None
+        self.import_label.grid_remove()
+        self.import_bar.grid_remove()
+        if message[0] == 'done':
+            messagebox.showinfo('Information',
+                                'The database has been backed up.\n\nLocation: ' + message[1],
+                                parent=self.master)
+        else:
+            messagebox.showwarning('Backup', 'An Error Occured.\n\n' + message[1],
+                                   parent=self.master)
+
+    def importFile(self, kind):
+        """
+        This method is for loading the items or the transactions of an
+        existing inventory from a csv file. The invalid rows are not
+        imported but saved into another csv file next to the original
+        so they can be corrected and imported again.
+        """
+        if self.import_thread is not None or self.backup_thread is not None:
+            messagebox.showinfo('Import', 'Please wait for the running task to finish.',
+                                parent=self.master)
+            return
+        filename = filedialog.askopenfilename(parent=self.master,
+                                              title='Import ' + kind,
+                                              filetypes=[('CSV files', '*.csv')]
+                                              )
+        if not filename:
+            return
+
+        # The import writes through its own connection, save what the
+        # windows have entered so far first.
+        database = get_database()
+        database.commit()
+        from application.importer import ImportThread
+        self.import_thread = ImportThread(database.filename, kind, filename)
+        self.import_label.config(text='Importing ' + os.path.basename(filename) + '...')
+        self.import_bar.config(value=0, maximum=1)
+        self.import_label.grid()
+        self.import_bar.grid()
+        self.import_thread.start()
+        self.import_job = self.after(100, self.checkImport)
+
+    def checkImport(self):
+        """
+        Read the messages of the import thread and update the progress
+        bar until the import has finished.
+        """
+        finished = False
+        while True:
+            try:
+                message = self.import_thread.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                self.import_bar.config(value=message[1], maximum=max(1, message[2]))
+            else:
+                finished = True
+                break
+        if not finished:
+            self.import_job = self.after(100, self.checkImport)
+            return
+
+        self.import_thread = None
+        self.import_job = None
+        self.import_label.grid_remove()
+        self.import_bar.grid_remove()
+        # The item master may have changed behind the shared store.
+        get_store().forget_items()
+        if message[0] == 'done':
+            result = message[1]
+            details = '%d row(s) have been imported.' % result.imported
+            if result.rejected:
+                details += ('\n\n%d row(s) have been rejected.\n\nLocation: %s'
+                            % (result.rejected, result.rejected_filename))
+            messagebox.showinfo('Information', details, parent=self.master)
+        else:
+            messagebox.showwarning('Import', 'An Error Occured.\n\n' + message[1],
+                                   parent=self.master)
 
     def updateDetails(self):
         """
         This method is for updating the company details if there is a
-        some changes needed to done for information puporses and make
-        sure that the existing table has been deleted before creating
-        a new table for company.
-        """
-        # Initialize the database and delete company table
-        database = sqlite3.connect('inv_database.db')
-        cur = database.cursor()
-        cur.execute("DROP TABLE IF EXISTS company")
-        cur.execute("""
-            CREATE TABLE company(com_name TEXT,
-                com_address TEXT,
-                com_telephone TEXT,
-                com_fax TEXT,
-                com_email TEXT)
-            """)
-        self.setcompanydetails()
+        some changes needed to done for information puporses. The
+        current details are shown and only replaced once the new ones
+        are saved with the Update button.
+        """
+        self.setCompanyDetails()
+        self.setcom_tp.protocol('WM_DELETE_WINDOW', self.closeCompanyDetails)
+        company = get_store().company()
+        if company is not None:
+            for entry, value in zip((self.com_name_entry, self.com_addr_entry,
+                                     self.com_tel_entry, self.com_fax_entry,
+                                     self.com_email_entry), company):
+                entry.insert(0, value or '')
         self.save_button.grid_forget()
         self.update_button = ttk.Button(self.setcom_frame, text='Update')
         self.update_button.bind('<Button-1>', self.updatecomdetails)
         self.update_button.grid(row=5, column=1, sticky='e')
-        if database:
-            database.commit()
-            cur.close()
-            database.close()
+
+    def closeCompanyDetails(self):
+        # Closing the window keeps the details unchanged.
+        self.setcom_tp.grab_release()
+        self.setcom_tp.destroy()
 
     def setCompanyDetails(self):
         """
@@ -1431,26 +2115,16 @@ class MainWindow(tk.Frame):
         This method will insert the new details for the company
         into the newly created table and close the user interface.
         """
-        print(event)
-        database = sqlite3.connect('inv_database.db')
-        cur = database.cursor()
-        cur.execute("INSERT INTO company VALUES(?, ?, ?, ?, ?)",
-                    (self.com_name_entry.get(),
-                     self.com_addr_entry.get(),
-                     self.com_tel_entry.get(),
-                     self.com_fax_entry.get(),
-                     self.com_email_entry.get()))
-        try:
-            database.commit()
-        except sqlite3.Error:
-            database.rollback()
-
-        if database:
-            cur.close()
-            database.close()
+        company = (self.com_name_entry.get(),
+                   self.com_addr_entry.get(),
+                   self.com_tel_entry.get(),
+                   self.com_fax_entry.get(),
+                   self.com_email_entry.get())
+        submitwrite(self.setcom_tp, lambda store: store.set_company(company),
+                    self.companyupdated)
 
-        self.setcom_tp.grab_release()
-        self.setcom_tp.destroy()
+    def companyupdated(self, result):
+        self.closeCompanyDetails()
 
     def aboutDialog(self):
         """
@@ -1496,6 +2170,13 @@ class MainWindow(tk.Frame):
         """
         CompanyDetails(self)
 
+    def diagnostics(self):
+        """
+        This method is for showing where the time of the application
+        goes, to find the slow statements and windows.
+        """
+        Diagnostics(self)
+
     def showReport(self):
         """
         This method is for showing the user the stock reports for monitoring
@@ -1507,14 +2188,81 @@ class MainWindow(tk.Frame):
         """
         This method is for quitting your application gracefully.
         """
+        if self.import_thread is not None:
+            if not messagebox.askyesno('Import',
+                                       'An import is still running and will be '
+                                       'lost.\n\nQuit anyway?',
+                                       parent=self.master):
+                return
+        if self.backup_thread is not None:
+            if not messagebox.askyesno('Backup',
+                                       'A backup is still running and will be '
+                                       'lost.\n\nQuit anyway?',
+                                       parent=self.master):
+                return
+        if self.import_job is not None:
+            self.after_cancel(self.import_job)
+        if self.backup_job is not None:
+            self.after_cancel(self.backup_job)
+        stop_worker()
+        # Commit what the open windows have entered and close the
+        # shared database connection.
+        get_database().close()
         self.master.destroy()
 
 
-def main():
+class StartupProfile:
+    """
+    The time taken by each step of the start of the application, from
+    the start of the script up to the first idle moment of the main
+    window, when it answers the user.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.steps = []
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+        print('Startup profile:')
+        for step, seconds in self.steps:
+            print('  %-14s %8.1f ms' % (step, seconds * 1000))
+        print('  %-14s %8.1f ms' % ('interactive', (self.last - self.started) * 1000))
+
+
+def main(argv=None, started=None):
+    """
+    Start the application. The script passes the time it started so
+    the report of --profile-startup includes the imports.
+    """
+    parser = argparse.ArgumentParser(prog='tarsierstock', description=__description__)
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print how long each step of the start takes')
+    args = parser.parse_args(argv)
+    profile = None
+    if args.profile_startup:
+        profile = StartupProfile(time.perf_counter() if started is None else started)
+        profile.mark('imports')
     app = tk.Tk()
+    if profile is not None:
+        profile.mark('tk')
     MainWindow(app)
+    if profile is not None:
+        profile.mark('main window')
+
+        def interactive():
+            profile.mark('first draw')
+            profile.report()
+
+        app.after_idle(interactive)
     app.mainloop()
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#
+# archive.py - Yearly archives of the transactions of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+
+import os
+import sys
+import sqlite3
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from application.database import Database
+from application.valuation import ItemCost
+
+# The transactions dated before the cutoff are moved into one database
+# file per year next to the inventory database, and replaced by one
+# carried forward row per item holding the balance and the average cost
+# of the archived movements. The day-to-day screens and the current
+# balances only read the main database, the reports of a date range
+# before the cutoff attach the archives they need.
+ARCHIVE_TABLE = """
+    CREATE TABLE IF NOT EXISTS archive_year(year INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL,
+        until TEXT NOT NULL)
+    """
+
+# The tables of an archive file. archive_copy records each copy made
+# into the file with the last rowids copied, so an archiving that was
+# interrupted before the rows were deleted from the main database is
+# finished without copying them twice.
+ARCHIVE_FILE_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS archive.{table}(
+        rowid INTEGER PRIMARY KEY,
+        itemcode TEXT,
+        description TEXT,
+        unit TEXT,
+        quantity REAL,
+        rate REAL,
+        date DATE,
+        remarks TEXT)
+    """, """
+    CREATE INDEX IF NOT EXISTS archive.{table}_date
+    ON {table}(date, itemcode, quantity)
+    """)
+ARCHIVE_COPY_TABLE = """
+    CREATE TABLE IF NOT EXISTS archive.archive_copy(until TEXT PRIMARY KEY,
+        incoming_rowid INTEGER NOT NULL,
+        outgoing_rowid INTEGER NOT NULL)
+    """
+
+# The carried forward rows left in the main database by the archiving.
+# They are listed here rather than told apart by their remarks, which
+# can be typed on any transaction.
+CARRIED_TABLE = """
+    CREATE TABLE IF NOT EXISTS carried_forward(tablename TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        PRIMARY KEY(tablename, id)) WITHOUT ROWID
+    """
+CARRIED_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS {table}_carried_delete
+    AFTER DELETE ON {table}
+    BEGIN
+        DELETE FROM carried_forward WHERE tablename = '{table}' AND id = OLD.rowid;
+    END
+    """
+CARRIED = "rowid IN (SELECT id FROM main.carried_forward WHERE tablename = '{table}')"
+
+# Remarks of the carried forward rows, only shown to the user.
+CARRIED_FORWARD = 'Carried forward'
+
+# The movements of the year to archive, without the carried forward
+# rows of an earlier archiving.
+YEAR_ROWS = """
+    date >= :first AND date < :until AND rowid <= :{table}_rowid
+    AND NOT """ + CARRIED
+
+# The rows replaced by the new carried forward rows, the movements of
+# the year and the carried forward rows before it.
+FOLD_ROWS = """
+    date < :until AND (""" + CARRIED + """
+                       OR (date >= :first AND rowid <= :{table}_rowid))"""
+
+FOLD_MOVEMENTS = """
+    SELECT itemcode, date, 0 AS kind, rowid, quantity, rate FROM incoming
+    WHERE """ + FOLD_ROWS.format(table='incoming') + """
+    UNION ALL
+    SELECT itemcode, date, 1, rowid, quantity, rate FROM outgoing
+    WHERE """ + FOLD_ROWS.format(table='outgoing') + """
+    ORDER BY 1, 2, 3, 4
+    """
+
+# The movements of the attached archives and of the main database
+# without its carried forward rows, read by the reports in place of the
+# transaction tables.
+ARCHIVE_VIEW = """
+    CREATE TEMP VIEW archive_{table} AS {archives}
+    SELECT * FROM main.{table}
+    WHERE date IS NULL OR date >= '{cutoff}' OR NOT """ + CARRIED + """
+    """
+
+TRANSACTION_TABLES = ('incoming', 'outgoing')
+
+
+def create_archive_table(cursor):
+    cursor.execute(ARCHIVE_TABLE)
+
+
+def create_carried_table(cursor):
+    """
+    Create the list of the carried forward rows and the triggers taking
+    the deleted rows out of it.
+    """
+    cursor.execute(CARRIED_TABLE)
+    for table in TRANSACTION_TABLES:
+        cursor.execute(CARRIED_TRIGGER.format(table=table))
+
+
+def archive_filename(filename, year):
+    """
+    Return the name of the archive file of a year, inv_database_2015.db
+    for inv_database.db.
+    """
+    base, extension = os.path.splitext(filename)
+    return '%s_%d%s' % (base, year, extension or '.db')
+
+
+def archive_cutoff(cursor):
+    """
+    Return the date before which the transactions have been archived,
+    or None.
+    """
+    return cursor.execute("SELECT MAX(until) FROM archive_year").fetchone()[0]
+
+
+def pending_years(cursor, cutoff):
+    """
+    Return the years of the transactions dated before the cutoff that
+    are still in the main database.
+    """
+    rows = cursor.execute("""
+        SELECT DISTINCT CAST(substr(date, 1, 4) AS INTEGER) FROM (
+            SELECT date FROM incoming
+            WHERE date < :cutoff AND NOT """ + CARRIED.format(table='incoming') + """
+            UNION
+            SELECT date FROM outgoing
+            WHERE date < :cutoff AND NOT """ + CARRIED.format(table='outgoing') + """)
+        ORDER BY 1
+        """, {'cutoff': cutoff})
+    return [row[0] for row in rows if row[0]]
+
+
+def copy_year(cursor, first, until):
+    """
+    Copy the movements of a year into the attached archive and return
+    the last rowids copied. A copy made before for the same date is not
+    made again.
+    """
+    for table in TRANSACTION_TABLES:
+        for statement in ARCHIVE_FILE_TABLES:
+            cursor.execute(statement.format(table=table))
+    cursor.execute(ARCHIVE_COPY_TABLE)
+    row = cursor.execute("""
+        SELECT incoming_rowid, outgoing_rowid FROM archive.archive_copy
+        WHERE until = ?
+        """, (until,)).fetchone()
+    if row is not None:
+        return {'incoming_rowid': row[0], 'outgoing_rowid': row[1]}
+    marks = {}
+    for table in TRANSACTION_TABLES:
+        marks[table + '_rowid'] = cursor.execute(
+            "SELECT IFNULL(MAX(rowid), 0) FROM main." + table).fetchone()[0]
+    values = dict(marks, first=first, until=until)
+    for table in TRANSACTION_TABLES:
+        cursor.execute("""
+            INSERT INTO archive.""" + table + """
+            SELECT NULL, itemcode, description, unit, quantity, rate, date, remarks
+            FROM main.""" + table + """
+            WHERE """ + YEAR_ROWS.format(table=table), values)
+    cursor.execute("INSERT INTO archive.archive_copy VALUES(?, ?, ?)",
+                   (until, marks['incoming_rowid'], marks['outgoing_rowid']))
+    return marks
+
+
+def fold_year(cursor, year, filename, first, until, marks):
+    """
+    Replace the copied movements of a year and the carried forward rows
+    before them by one carried forward row per item, dated the day
+    before until. Return the number of movements archived.
+    """
+    values = dict(marks, first=first, until=until)
+    costs = {}
+    for itemcode, tdate, kind, rowid, quantity, rate in cursor.execute(FOLD_MOVEMENTS, values).fetchall():
+        cost = costs.get(itemcode)
+        if cost is None:
+            cost = costs[itemcode] = ItemCost()
+        cost.move(tdate, kind, quantity, rate)
+    archived = 0
+    for table in TRANSACTION_TABLES:
+        archived -= cursor.execute("""
+            SELECT COUNT(*) FROM """ + table + """
+            WHERE date < :until AND """ + CARRIED.format(table=table),
+            values).fetchone()[0]
+        archived += cursor.execute("DELETE FROM " + table + " WHERE " +
+                                   FOLD_ROWS.format(table=table), values).rowcount
+    carried = str(datetime.strptime(until, '%Y-%m-%d') - timedelta(days=1))
+    items = cursor.connection.cursor()
+    for itemcode, cost in costs.items():
+        item = items.execute("SELECT description, unit FROM item WHERE itemcode = ?",
+                             (itemcode,)).fetchone() or ('', '')
+        # The rows are incoming at the average cost, a stock below zero
+        # as a negative quantity and an item without stock as 0 at its
+        # last cost, so the valuation after the cutoff doesn't change.
+        rowid = cursor.execute("INSERT INTO incoming VALUES(null, ?, ?, ?, ?, ?, ?, ?)",
+                               (itemcode, item[0], item[1], cost.quantity,
+                                cost.average_cost(), carried, CARRIED_FORWARD)).lastrowid
+        cursor.execute("INSERT INTO carried_forward VALUES('incoming', ?)", (rowid,))
+    items.close()
+    cursor.execute("""
+        INSERT OR REPLACE INTO archive_year
+        SELECT ?, ?, MAX(?, IFNULL((SELECT until FROM archive_year WHERE year = ?), ''))
+        """, (year, os.path.basename(filename), until, year))
+    return archived
+
+
+def archive_transactions(database, cutoff):
+    """
+    Move the transactions dated before the cutoff date into the yearly
+    archives. Each year is copied into its archive in one transaction
+    and removed from the main database in another, so the balances are
+    right after each step and an interrupted archiving can be run again.
+    Return the number of rows archived.
+    """
+    cutoff = str(cutoff)
+    connection = database.connect()
+    # A file attached twice would lock itself.
+    detach_archives(connection)
+    total = 0
+    for year in pending_years(database.cursor(), cutoff):
+        first = str(date(year, 1, 1))
+        until = min(str(date(year + 1, 1, 1)), cutoff)
+        filename = archive_filename(database.filename, year)
+        # Databases are attached outside of a transaction.
+        connection.execute("ATTACH DATABASE ? AS archive", (filename,))
+        try:
+            marks = database.write(copy_year, first, until)
+            total += database.write(fold_year, year, filename, first, until, marks)
+        finally:
+            connection.execute("DETACH DATABASE archive")
+    return total
+
+
+def attach_archives(connection, start):
+    """
+    Attach the archives holding movements dated on or after start and
+    create the archive_incoming and archive_outgoing views over them and
+    the main database. The archives that are not needed are detached.
+    """
+    cutoff = archive_cutoff(connection)
+    folder = os.path.dirname(main_filename(connection))
+    needed = {}
+    for year, filename in connection.execute(
+            "SELECT year, filename FROM archive_year WHERE until > ? ORDER BY year", (start,)):
+        needed['archive_%d' % year] = os.path.join(folder, filename)
+    attached = set(row[1] for row in connection.execute("PRAGMA database_list"))
+    for name in list(attached):
+        if name.startswith('archive_') and name not in needed:
+            connection.execute("DETACH DATABASE " + name)
+            attached.discard(name)
+    limit = connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(needed) > limit:
+        raise ValueError('The report needs %d yearly archives, only %d can be '
+                         'opened at once. Please choose a shorter date range.'
+                         % (len(needed), limit))
+    for name, filename in needed.items():
+        if name not in attached:
+            if not os.path.isfile(filename):
+                raise ValueError('The archive %s is missing.' % filename)
+            connection.execute("ATTACH DATABASE ? AS " + name, (filename,))
+    for table in TRANSACTION_TABLES:
+        archives = ''.join('SELECT * FROM %s.%s UNION ALL ' % (name, table)
+                           for name in needed)
+        connection.execute("DROP VIEW IF EXISTS temp.archive_" + table)
+        connection.execute(ARCHIVE_VIEW.format(table=table, archives=archives,
+                                               cutoff=cutoff))
+
+
+def detach_archives(connection):
+    """
+    Drop the archive views and detach the archives attached for the
+    reports.
+    """
+    for table in TRANSACTION_TABLES:
+        connection.execute("DROP VIEW IF EXISTS temp.archive_" + table)
+    for row in connection.execute("PRAGMA database_list").fetchall():
+        if row[1].startswith('archive_'):
+            connection.execute("DETACH DATABASE " + row[1])
+
+
+def main_filename(connection):
+    for row in connection.execute("PRAGMA database_list"):
+        if row[1] == 'main':
+            return row[2]
+    return ''
+
+
+def main():
+    """
+    Archive the transactions dated before a cutoff from the command
+    line: python3 -m application.archive YYYY-MM-DD [inv_database.db]
+    """
+    if len(sys.argv) < 2:
+        print('Usage: python3 -m application.archive YYYY-MM-DD [inv_database.db]')
+        return 2
+    try:
+        cutoff = datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+    except ValueError:
+        print('Please enter the cutoff date as YYYY-MM-DD.')
+        return 2
+    if len(sys.argv) > 2:
+        filename = sys.argv[2]
+    else:
+        filename = None
+    # The schema module imports this one.
+    from application.schema import migrate
+    database = Database(filename)
+    try:
+        migrate(database.connect())
+        count = archive_transactions(database, cutoff)
+    except sqlite3.Error as error:
+        print('Archiving the transactions failed:', error)
+        return 1
+    finally:
+        database.close()
+    print('%d transaction(s) archived.' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# backup.py - Online backup of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+
+import argparse
+import gzip
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+from application.database import Database
+from application.settings import get_settings
+
+# Size of the gzip copy buffer.
+BUFFER_SIZE = 1 << 20
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def backup_filename(filename, folder, when, compress=False):
+    """
+    Return the name of a backup of the database taken at the given
+    time, inv_database_20150102_030405.db in the backup folder.
+    """
+    base = os.path.splitext(os.path.basename(filename))[0]
+    name = '%s_%s.db' % (base, when.strftime('%Y%m%d_%H%M%S'))
+    if compress:
+        name += '.gz'
+    return os.path.join(folder, name)
+
+
+def backup_folder(database, folder=None):
+    """
+    Return the backup folder, relative folders are next to the database.
+    """
+    if folder is None:
+        folder = get_settings()['backup'].get('folder')
+    return os.path.join(os.path.dirname(database.filename), folder)
+
+
+def list_backups(filename, folder):
+    """
+    Return the backups of the database found in the folder, the oldest
+    first.
+    """
+    base = os.path.splitext(os.path.basename(filename))[0]
+    pattern = re.compile(re.escape(base) + r'_\d{8}_\d{6}\.db(\.gz)?$')
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if pattern.match(name))
+
+
+def check_integrity(filename):
+    """
+    Raise BackupError unless PRAGMA integrity_check finds the copy fine.
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        rows = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+    finally:
+        connection.close()
+    if rows != ['ok']:
+        raise BackupError('The backup is damaged: ' + '; '.join(rows[:5]))
+
+
+def rotate_backups(filename, folder, keep):
+    """
+    Delete the oldest backups so that only keep of them are left, 0
+    keeps them all. Return the deleted files.
+    """
+    if keep <= 0:
+        return []
+    old = list_backups(filename, folder)[:-keep]
+    for name in old:
+        os.remove(name)
+    return old
+
+
+def copy_pages(source, target, settings, progress=None, snapshot=False,
+               restarts=None):
+    """
+    Copy the pages of the source into the target with the online backup
+    API. With snapshot the source is read in one read transaction. The
+    copy stops with BackupRestarted once writes of other connections
+    have restarted it more than restarts times.
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def step(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if restarts is not None and state['restarts'] > restarts:
+                raise BackupRestarted()
+        state['remaining'] = remaining
+        if progress is not None:
+            progress(total - remaining, total)
+
+    if snapshot:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    try:
+        source.backup(target, pages=settings.getint('pages'), progress=step,
+                      sleep=settings.getfloat('sleep'))
+    finally:
+        if snapshot:
+            source.rollback()
+
+
+def backup_database(database, folder=None, compress=None, keep=None,
+                    progress=None):
+    """
+    Copy the database into a new timestamped file of the backup folder
+    while it stays in use and return the name of the file. The pages are
+    copied a few at a time with the online backup API, the other
+    terminals can read and write between the steps. The copy is checked
+    with PRAGMA integrity_check before it is compressed and the oldest
+    backups are rotated out. progress(done, total) is called with the
+    pages copied.
+    """
+    settings = get_settings()['backup']
+    if compress is None:
+        compress = settings.getboolean('compress')
+    if keep is None:
+        keep = settings.getint('keep')
+    folder = backup_folder(database, folder)
+    os.makedirs(folder, exist_ok=True)
+    when = datetime.now()
+    filename = backup_filename(database.filename, folder, when, compress)
+    # Work on a temporary file so a failed backup never looks like a
+    # good one.
+    copy = backup_filename(database.filename, folder, when) + '.part'
+
+    source = database.open()
+    target = sqlite3.connect(copy)
+    try:
+        # In WAL mode the pages are read from a snapshot that the other
+        # terminals don't block, else their writes restart the copy and
+        # after a few restarts the rest is copied under a read lock.
+        wal = source.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        try:
+            copy_pages(source, target, settings, progress,
+                       snapshot=wal, restarts=settings.getint('restarts'))
+        except BackupRestarted:
+            copy_pages(source, target, settings, progress, snapshot=True)
+    except BaseException:
+        target.close()
+        os.remove(copy)
+        raise
+    finally:
+        source.close()
+    target.close()
+    try:
+        check_integrity(copy)
+        if compress:
+            with open(copy, 'rb') as infile, \
+                    gzip.open(filename + '.part', 'wb',
+                              compresslevel=settings.getint('compresslevel')) as outfile:
+                shutil.copyfileobj(infile, outfile, BUFFER_SIZE)
+            os.remove(copy)
+            copy = filename + '.part'
+        os.replace(copy, filename)
+    except BaseException:
+        if os.path.exists(copy):
+            os.remove(copy)
+        raise
+    rotate_backups(database.filename, folder, keep)
+    return filename
+
+
+class BackupThread(threading.Thread):
+    """
+    Run a backup on a worker thread with its own connection to the
+    database. The progress is put in the messages queue so the window
+    can read it from the tkinter thread:
+        ('progress', done, total)
+        ('done', filename)
+        ('error', message)
+    """
+
+    def __init__(self, database, folder=None, compress=None, keep=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.database = database
+        self.folder = folder
+        self.compress = compress
+        self.keep = keep
+        self.messages = queue.Queue()
+
+    def progress(self, done, total):
+        self.messages.put(('progress', done, total))
+
+    def run(self):
+        try:
+            filename = backup_database(self.database, self.folder, self.compress,
+                                       self.keep, self.progress)
+            self.messages.put(('done', filename))
+        except Exception as error:
+            self.messages.put(('error', str(error)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up the inventory database while it is in use.')
+    parser.add_argument('--database', help='database file, default from the settings')
+    parser.add_argument('--folder', help='backup folder, default from the settings')
+    parser.add_argument('--compress', action='store_true', default=None,
+                        help='compress the backup with gzip')
+    parser.add_argument('--keep', type=int, help='number of backups kept, 0 keeps all')
+    args = parser.parse_args()
+    database = Database(args.database)
+    if not database.exists():
+        print('The database %s does not exist.' % database.filename)
+        return 1
+    try:
+        filename = backup_database(database, args.folder, args.compress, args.keep)
+    except (sqlite3.Error, BackupError, OSError) as error:
+        print('The backup failed:', error)
+        return 1
+    print('Backup saved to', filename)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
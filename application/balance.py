@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# balance.py - Stock balance engine of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import sys
+import sqlite3
+from datetime import datetime
+from datetime import timedelta
+
+from application.archive import archive_cutoff
+from application.archive import attach_archives
+from application.database import Database
+from application.snapshot import nearest_snapshot
+
+# Running totals per item code, kept current by the triggers below on
+# every insert, update and delete of the transaction tables. Outgoing
+# quantities are stored as negative numbers so total_out is negative
+# and the balance is always total_in + total_out.
+BALANCE_TABLE = """
+    CREATE TABLE IF NOT EXISTS stock_balance(itemcode TEXT PRIMARY KEY,
+        total_in REAL NOT NULL DEFAULT 0,
+        total_out REAL NOT NULL DEFAULT 0,
+        balance REAL NOT NULL DEFAULT 0,
+        last_movement_date DATE)
+    """
+
+# The latest movement date of an item is only searched again when the
+# removed row was the latest one.
+LAST_DATE = """
+    CASE WHEN OLD.date < last_movement_date THEN last_movement_date
+    ELSE (SELECT MAX(latest) FROM
+            (SELECT MAX(date) AS latest FROM incoming
+                WHERE itemcode = OLD.itemcode
+             UNION ALL
+             SELECT MAX(date) FROM outgoing
+                WHERE itemcode = OLD.itemcode))
+    END"""
+
+ADD_MOVEMENT = """
+        INSERT OR IGNORE INTO stock_balance(itemcode) VALUES(NEW.itemcode);
+        UPDATE stock_balance
+        SET {column} = {column} + IFNULL(NEW.quantity, 0),
+            balance = balance + IFNULL(NEW.quantity, 0),
+            last_movement_date = CASE
+                WHEN last_movement_date IS NULL
+                    OR last_movement_date < NEW.date THEN NEW.date
+                ELSE last_movement_date END
+        WHERE itemcode = NEW.itemcode;"""
+
+REMOVE_MOVEMENT = """
+        UPDATE stock_balance
+        SET {column} = {column} - IFNULL(OLD.quantity, 0),
+            balance = balance - IFNULL(OLD.quantity, 0),
+            last_movement_date = """ + LAST_DATE + """
+        WHERE itemcode = OLD.itemcode;"""
+
+BALANCE_TRIGGERS = ("""
+    CREATE TRIGGER IF NOT EXISTS {table}_balance_insert
+    AFTER INSERT ON {table}
+    BEGIN""" + ADD_MOVEMENT + """
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_balance_delete
+    AFTER DELETE ON {table}
+    BEGIN""" + REMOVE_MOVEMENT + """
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_balance_update
+    AFTER UPDATE OF itemcode, quantity, date ON {table}
+    BEGIN""" + REMOVE_MOVEMENT + ADD_MOVEMENT + """
+    END
+    """)
+
+REBUILD_QUERY = """
+    INSERT INTO stock_balance
+    SELECT itemcode,
+           SUM(qty_in),
+           SUM(qty_out),
+           SUM(qty_in) + SUM(qty_out),
+           MAX(date)
+    FROM (SELECT itemcode, IFNULL(quantity, 0) AS qty_in,
+                 0 AS qty_out, date
+          FROM incoming
+          UNION ALL
+          SELECT itemcode, 0, IFNULL(quantity, 0), date
+          FROM outgoing)
+    GROUP BY itemcode
+    """
+
+# Reading the report is a primary key lookup of the running totals for
+# each row of the item master, whatever the size of the transactions.
+BALANCE_COLUMNS = """
+    SELECT item.rowid,
+           item.itemcode,
+           item.description,
+           item.unit,
+           IFNULL(stock_balance.total_in, 0),
+           IFNULL(stock_balance.total_out, 0),
+           IFNULL(stock_balance.balance, 0)
+    FROM item
+    LEFT JOIN stock_balance ON stock_balance.itemcode = item.itemcode
+    """
+BALANCE_QUERY = BALANCE_COLUMNS + """
+    ORDER BY item.rowid
+    """
+BALANCE_PAGE = BALANCE_COLUMNS + """
+    WHERE item.rowid > :after
+    ORDER BY item.rowid
+    LIMIT :limit
+    """
+ITEM_BALANCE = BALANCE_COLUMNS + """
+    WHERE item.itemcode = :itemcode
+    """
+
+
+# Balances over a date range [start, end) from the date indexes of the
+# transaction tables. {known} sums the movements whose balance is known
+# without reading them: either the movements after the range, which are
+# taken away from the current balance, or the movements before the
+# range, which are the opening balance. The movements before the range
+# are read from the nearest closing balance snapshot when there is one.
+# Only the shorter side is read.
+PERIOD_MOVEMENTS = """
+    WITH movements(itemcode, qty_in, qty_out, known) AS (
+        SELECT itemcode, quantity, 0, 0 FROM {incoming}
+        WHERE date >= :start AND date < :end
+        UNION ALL
+        SELECT itemcode, 0, quantity, 0 FROM {outgoing}
+        WHERE date >= :start AND date < :end
+        UNION ALL
+        SELECT itemcode, 0, 0, quantity FROM {incoming} WHERE {known}
+        UNION ALL
+        SELECT itemcode, 0, 0, quantity FROM {outgoing} WHERE {known}{snapshot}),
+    totals AS (
+        SELECT itemcode, SUM(qty_in) AS qty_in, SUM(qty_out) AS qty_out,
+               SUM(known) AS known
+        FROM movements GROUP BY itemcode)
+    SELECT item.rowid,
+           item.itemcode,
+           item.description,
+           item.unit,
+           {opening} AS opening,
+           IFNULL(totals.qty_in, 0),
+           IFNULL(totals.qty_out, 0),
+           {opening} + IFNULL(totals.qty_in, 0) + IFNULL(totals.qty_out, 0)
+    FROM item
+    LEFT JOIN stock_balance ON stock_balance.itemcode = item.itemcode
+    LEFT JOIN totals ON totals.itemcode = item.itemcode
+    ORDER BY item.rowid
+    """
+
+# The opening balance is the current balance less the movements of and
+# after the range, or the sum of the movements before the range. Rows
+# without a date count as the oldest movements.
+AFTER_OPENING = ("IFNULL(stock_balance.balance, 0) - IFNULL(totals.known, 0)"
+                 " - IFNULL(totals.qty_in, 0) - IFNULL(totals.qty_out, 0)")
+AFTER_RANGE = PERIOD_MOVEMENTS.format(
+    incoming='incoming',
+    outgoing='outgoing',
+    known="date >= :end",
+    snapshot="",
+    opening=AFTER_OPENING)
+BEFORE_RANGE = PERIOD_MOVEMENTS.format(
+    incoming='incoming',
+    outgoing='outgoing',
+    known="date < :start OR date IS NULL",
+    snapshot="",
+    opening="IFNULL(totals.known, 0)")
+SNAPSHOT_RANGE = PERIOD_MOVEMENTS.format(
+    incoming='incoming',
+    outgoing='outgoing',
+    known="date >= :snapshot AND date < :start",
+    snapshot="""
+        UNION ALL
+        SELECT itemcode, 0, 0, balance FROM balance_snapshot
+        WHERE until = :snapshot""",
+    opening="IFNULL(totals.known, 0)")
+# A range starting before the archive cutoff reads the movements of the
+# attached archives in place of the carried forward rows, the opening
+# balance is taken from the current balance.
+ARCHIVE_RANGE = PERIOD_MOVEMENTS.format(
+    incoming='archive_incoming',
+    outgoing='archive_outgoing',
+    known="date >= :end",
+    snapshot="",
+    opening=AFTER_OPENING)
+
+DATE_LIMITS = """
+    SELECT MIN(first), MAX(last) FROM (
+        SELECT MIN(date) AS first, MAX(date) AS last FROM incoming
+        UNION ALL
+        SELECT MIN(date), MAX(date) FROM outgoing)
+    """
+
+
+def create_balance_table(cursor):
+    """
+    Create the stock_balance table and the triggers on the incoming and
+    outgoing tables that keep it up to date.
+    """
+    cursor.execute(BALANCE_TABLE)
+    for trigger in BALANCE_TRIGGERS:
+        cursor.execute(trigger.format(table='incoming', column='total_in'))
+        cursor.execute(trigger.format(table='outgoing', column='total_out'))
+
+
+def rebuild_balances(cursor):
+    """
+    Recompute the stock_balance table from the full transaction history,
+    this is used for existing databases and to repair the totals.
+    """
+    cursor.execute("DELETE FROM stock_balance")
+    cursor.execute(REBUILD_QUERY)
+
+
+def stock_balances(cursor):
+    """
+    Execute the balance query on the given cursor and return it so that
+    the rows can be iterated without loading the whole report in memory.
+    Each row is (rowid, itemcode, description, unit, in, out, balance),
+    outgoing quantities are stored as negative numbers so the balance is
+    the sum of the in and out columns.
+    """
+    return cursor.execute(BALANCE_QUERY)
+
+
+def balance_page(cursor, after, limit):
+    """
+    Execute the balance query of at most limit items following the
+    item with the rowid after and return the cursor.
+    """
+    return cursor.execute(BALANCE_PAGE, {'after': after, 'limit': limit})
+
+
+def item_balance(cursor, itemcode):
+    """
+    Return the balance row of one item or None.
+    """
+    return cursor.execute(ITEM_BALANCE, {'itemcode': itemcode}).fetchone()
+
+
+def period_balances(cursor, start, end):
+    """
+    Execute the query of the balances between the start and end dates,
+    both included, and return the cursor. Each row is (rowid, itemcode,
+    description, unit, opening, in, out, closing). start may be None for
+    a report from the first transaction.
+    """
+    end = str(end + timedelta(days=1))
+    if start is None:
+        start = ''
+    else:
+        start = str(start)
+    cutoff = archive_cutoff(cursor.connection)
+    if cutoff is not None and start < cutoff:
+        attach_archives(cursor.connection, start)
+        return cursor.execute(ARCHIVE_RANGE, {'start': start, 'end': end})
+    snapshot = nearest_snapshot(cursor.connection, start)
+    if after_is_shorter(cursor, start, end, snapshot):
+        query = AFTER_RANGE
+    elif snapshot is None:
+        query = BEFORE_RANGE
+    else:
+        query = SNAPSHOT_RANGE
+    return cursor.execute(query, {'start': start, 'end': end,
+                                  'snapshot': snapshot})
+
+
+def balances_as_of(cursor, day):
+    """
+    Execute the query of the balances at the end of the given day and
+    return the cursor, the closing column is the balance. The in and out
+    columns are the movements of that day only.
+    """
+    return period_balances(cursor, day, day)
+
+
+def after_is_shorter(cursor, start, end, snapshot=None):
+    """
+    Return whether there are fewer days of movements after the range
+    than before it, or since the snapshot before it. A month end report
+    of the last month only reads the last month.
+    """
+    first, last = cursor.connection.execute(DATE_LIMITS).fetchone()
+    if first is None or last is None or last < end:
+        return True
+    try:
+        after = datetime.strptime(last[:10], '%Y-%m-%d') - \
+            datetime.strptime(end, '%Y-%m-%d')
+        before = datetime.strptime((start or first)[:10], '%Y-%m-%d') - \
+            datetime.strptime((snapshot or first)[:10], '%Y-%m-%d')
+    except ValueError:
+        return True
+    return after <= before
+
+
+def main():
+    """
+    Rebuild the stock balances of an existing database from the command
+    line: python3 -m application.balance [inv_database.db]
+    """
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = None
+    database = Database(filename).connect()
+    cur = database.cursor()
+    try:
+        create_balance_table(cur)
+        rebuild_balances(cur)
+        database.commit()
+    except sqlite3.Error as error:
+        database.rollback()
+        print('Rebuilding the stock balances failed:', error)
+        return 1
+    finally:
+        cur.close()
+        database.close()
+    print('Stock balances have been rebuilt.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
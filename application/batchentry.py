@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# batchentry.py - Batch entry grid of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+
+import tkinter as tk
+from tkinter import ttk
+
+# Number of invalid lines listed in the message, they are all
+# highlighted in the grid.
+ERRORS_SHOWN = 10
+
+
+class BatchEntry(ttk.LabelFrame):
+    """
+    Grid of the transaction lines queued by the user, a whole delivery
+    note can be entered and checked before it is posted at once. Each
+    line is (itemcode, description, unit, quantity, rate, date, remarks)
+    with a positive quantity.
+    """
+
+    def __init__(self, master, post, text='Batch'):
+        ttk.LabelFrame.__init__(self, master, text=text)
+        self.lines = {}
+        self.counter = 0
+
+        # Create the treeview of the queued lines.
+        tree_frame = tk.Frame(self)
+        tree_frame.pack(expand=True, fill='both')
+        self.batch_tree = ttk.Treeview(tree_frame, height=6, selectmode='extended')
+        self.batch_tree.pack(side='left', expand=True, fill='both')
+        yscroll = tk.Scrollbar(tree_frame, command=self.batch_tree.yview)
+        yscroll.pack(side='left', fill='y')
+        self.batch_tree.config(yscrollcommand=yscroll.set)
+        self.column = ('date', 'itemcode', 'description', 'unit', 'rate', 'quantity', 'amount', 'remarks')
+        self.heading = ('Date',
+                        'Item Code',
+                        'Description',
+                        'Unit',
+                        'Rate',
+                        'Quantity',
+                        'Amount',
+                        'Remarks'
+                        )
+        self.batch_tree['columns'] = self.column
+        self.batch_tree.column('#0', width=35)
+        self.batch_tree.heading('#0', text='No.')
+        for elem, head in zip(self.column, self.heading):
+            if elem == 'description':
+                col_width = 200
+            elif elem == 'remarks':
+                col_width = 150
+            else:
+                col_width = 75
+            self.batch_tree.column(elem, width=col_width)
+            self.batch_tree.heading(elem, text=head)
+        self.batch_tree.tag_configure('error', background='#FF6B6B')
+        self.batch_tree.bind('<Delete>', lambda event: self.remove())
+
+        # Create the buttons and the total of the batch.
+        button_frame = tk.Frame(self)
+        button_frame.pack(fill='x')
+        self.post_btn = ttk.Button(button_frame, text='Post', command=post)
+        self.post_btn.pack(side='right', padx=5, pady=5)
+        self.remove_btn = ttk.Button(button_frame, text='Remove',
+                                     command=self.remove)
+        self.remove_btn.pack(side='right', padx=5, pady=5)
+        self.total_label = ttk.Label(button_frame)
+        self.total_label.pack(side='left', padx=5)
+        self.update_total()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add(self, line):
+        """
+        Queue a line at the end of the batch.
+        """
+        itemcode, description, unit, quantity, rate, tdate, remarks = line
+        self.counter += 1
+        iid = str(self.counter)
+        self.lines[iid] = line
+        try:
+            amount = str(float(quantity) * float(rate))
+        except ValueError:
+            amount = ''
+        self.batch_tree.insert('', 'end', iid, text=str(len(self.lines)),
+                               values=[tdate, itemcode, description, unit,
+                                       rate, quantity, amount, remarks])
+        self.batch_tree.see(iid)
+        self.update_total()
+
+    def remove(self):
+        self.discard(self.batch_tree.selection())
+
+    def discard(self, iids):
+        """
+        Remove the lines of the given iids that are still queued.
+        """
+        for iid in iids:
+            if iid in self.lines:
+                self.batch_tree.delete(iid)
+                del self.lines[iid]
+        self.renumber()
+
+    def clear(self):
+        children = self.batch_tree.get_children()
+        if len(children) != 0:
+            self.batch_tree.delete(*children)
+        self.lines.clear()
+        self.update_total()
+
+    def keys(self):
+        """
+        Return the iids of the queued lines in order.
+        """
+        return self.batch_tree.get_children()
+
+    def batch(self):
+        """
+        Return the queued lines in order.
+        """
+        return [self.lines[iid] for iid in self.keys()]
+
+    def mark(self, errors):
+        """
+        Highlight the lines of the (index, message) errors and return
+        the text listing them.
+        """
+        children = self.batch_tree.get_children()
+        for iid in children:
+            self.batch_tree.item(iid, tags=())
+        text = []
+        for index, message in errors:
+            self.batch_tree.item(children[index], tags=('error',))
+            if len(text) < ERRORS_SHOWN:
+                text.append('Line %d: %s' % (index + 1, message))
+        if len(errors) > ERRORS_SHOWN:
+            text.append('and %d more.' % (len(errors) - ERRORS_SHOWN))
+        if errors:
+            self.batch_tree.see(children[errors[0][0]])
+        return '\n'.join(text)
+
+    def renumber(self):
+        for number, iid in enumerate(self.batch_tree.get_children(), 1):
+            self.batch_tree.item(iid, text=str(number))
+        self.update_total()
+
+    def update_total(self):
+        total = 0.0
+        for line in self.lines.values():
+            try:
+                total += float(line[3]) * float(line[4])
+            except ValueError:
+                pass
+        self.total_label.config(text='Lines: %d  Amount: %s' % (len(self.lines), total))
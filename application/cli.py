@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#
+# cli.py - Command line interface of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+from datetime import date
+from datetime import datetime
+from itertools import islice
+
+from application.backup import BackupError
+from application.backup import backup_database
+from application.database import Database
+from application.importer import ITEMS
+from application.importer import Importer
+from application.schema import migrate
+from application.server import serve
+from application.store import INCOMING
+from application.store import OUTGOING
+from application.store import TRANSACTION_TABLES
+from application.store import Balance
+from application.store import InventoryStore
+from application.store import Item
+from application.store import PeriodBalance
+from application.store import Transaction
+from application.store import Valuation
+
+TABLES = (ITEMS,) + TRANSACTION_TABLES
+FORMATS = ('csv', 'json', 'jsonl')
+AS_OF_FIELDS = ('rowid', 'itemcode', 'description', 'unit', 'balance')
+
+# Rows read from the cursor at a time and size of the output buffer.
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 1 << 16
+
+
+def day(text):
+    """
+    Return the date of a 'YYYY-MM-DD' argument.
+    """
+    try:
+        return datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a YYYY-MM-DD date' % text)
+
+
+def write_rows(rows, fields, out, form, chunk_size=CHUNK_SIZE):
+    """
+    Write the rows of a cursor or an iterator as csv with a header, as a
+    json list of objects or as one json object per line, reading them
+    chunk by chunk. Return the number of rows written.
+    """
+    done = 0
+    if form == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+    elif form == 'json':
+        out.write('[')
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        if form == 'csv':
+            writer.writerows(chunk)
+        elif form == 'json':
+            out.write(',\n' if done else '\n')
+            out.write(',\n'.join(json.dumps(dict(zip(fields, row))) for row in chunk))
+        else:
+            out.writelines(json.dumps(dict(zip(fields, row))) + '\n' for row in chunk)
+        done += len(chunk)
+    if form == 'json':
+        out.write('\n]\n' if done else ']\n')
+    return done
+
+
+def output(rows, fields, args):
+    if args.output in (None, '-'):
+        try:
+            count = write_rows(rows, fields, sys.stdout, args.format)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reading end of the pipe, like head, has stopped early.
+            # Point the standard output elsewhere so Python doesn't fail
+            # again flushing it at exit.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8',
+                  buffering=BUFFER_SIZE) as out:
+            count = write_rows(rows, fields, out, args.format)
+    print('%d row(s) written.' % count, file=sys.stderr)
+    return 0
+
+
+def report(store, args):
+    if args.valuation:
+        store.update_valuation()
+        return output(store.valuation(), Valuation._fields, args)
+    if args.as_of is not None:
+        # The in and out fields would only be the movements of the day.
+        rows = (row[:4] + (row.closing,) for row in store.balances_as_of(args.as_of))
+        return output(rows, AS_OF_FIELDS, args)
+    if args.start is not None or args.end is not None:
+        end = args.end
+        if end is None:
+            end = date.today()
+        return output(store.period_balances(args.start, end), PeriodBalance._fields, args)
+    return output(store.balances(), Balance._fields, args)
+
+
+def export(store, args):
+    if args.table == ITEMS:
+        return output(store.items(), Item._fields, args)
+    return output(store.transactions(args.table, args.start, args.end),
+                  Transaction._fields, args)
+
+
+def import_file(store, args):
+    importer = Importer(store.database, args.table, args.filename,
+                        args.rejected, args.workers)
+    result = importer.run()
+    print('%d row(s) imported, %d rejected.' % (result.imported, result.rejected))
+    if result.rejected:
+        print('Rejected rows have been written to ' + result.rejected_filename)
+    return 0
+
+
+def backup(store, args):
+    try:
+        filename = backup_database(store.database, args.folder, args.compress, args.keep)
+    except BackupError as error:
+        print('The backup failed:', error, file=sys.stderr)
+        return 1
+    print('Backup saved to', filename)
+    return 0
+
+
+def add_item(store, args):
+    if store.find_item(args.itemcode) is not None:
+        print('The item code %s already exists.' % args.itemcode, file=sys.stderr)
+        return 1
+    rowid = store.add_item(args.itemcode, args.description, args.unit)
+    print('Item %s added as number %d.' % (args.itemcode, rowid))
+    return 0
+
+
+def post(store, args):
+    item = store.find_item(args.itemcode)
+    if item is None:
+        print('Unknown item code %s.' % args.itemcode, file=sys.stderr)
+        return 1
+    line = (item.itemcode, item.description, item.unit, args.quantity,
+            args.rate, args.date, args.remarks)
+    errors = store.check_batch([line])
+    if errors:
+        print(errors[0][1], file=sys.stderr)
+        return 1
+    transaction = store.post_batch(args.table, [line])[0]
+    print('%s transaction %d saved.' % (args.table.capitalize(), transaction.rowid))
+    return 0
+
+
+def serve_api(store, args):
+    # The threads of the server open their own connections.
+    store.database.close()
+    return serve(store.database.filename, args.host, args.port)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python3 -m application.cli',
+                                     description='Batch operations on the inventory database.')
+    parser.add_argument('--database', help='database file, default from the settings')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    def streamed(command):
+        command.add_argument('--format', choices=FORMATS, default='csv')
+        command.add_argument('--output', help='output file, default the standard output')
+
+    command = commands.add_parser('report', help='write the stock balances')
+    command.add_argument('--start', type=day, help='first day of a period report')
+    command.add_argument('--end', type=day, help='last day of a period report, default today')
+    command.add_argument('--as-of', type=day, help='balances at the end of a day')
+    command.add_argument('--valuation', action='store_true',
+                         help='weighted average and FIFO value of the stock')
+    streamed(command)
+    command.set_defaults(run=report)
+
+    command = commands.add_parser('export', help='write the items or the transactions')
+    command.add_argument('table', choices=TABLES)
+    command.add_argument('--start', type=day, help='first day of the transactions')
+    command.add_argument('--end', type=day, help='last day of the transactions')
+    streamed(command)
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('import', help='import items or transactions from a csv file')
+    command.add_argument('table', choices=TABLES)
+    command.add_argument('filename', help='csv file with a header row')
+    command.add_argument('--workers', type=int, help='number of parsing processes')
+    command.add_argument('--rejected', help='csv file receiving the rejected rows')
+    command.set_defaults(run=import_file)
+
+    command = commands.add_parser('backup', help='back up the database while it is in use')
+    command.add_argument('--folder', help='backup folder, default from the settings')
+    command.add_argument('--compress', action='store_true', default=None,
+                         help='compress the backup with gzip')
+    command.add_argument('--keep', type=int, help='number of backups kept, 0 keeps all')
+    command.set_defaults(run=backup)
+
+    command = commands.add_parser('add-item', help='add an item to the item master')
+    command.add_argument('itemcode')
+    command.add_argument('description')
+    command.add_argument('unit')
+    command.set_defaults(run=add_item)
+
+    command = commands.add_parser('post', help='record an incoming or outgoing transaction')
+    command.add_argument('table', choices=(INCOMING, OUTGOING))
+    command.add_argument('itemcode')
+    command.add_argument('quantity', type=float, help='quantity, positive for both tables')
+    command.add_argument('rate', type=float)
+    command.add_argument('--date', type=day, default=date.today(), help='default today')
+    command.add_argument('--remarks', default='')
+    command.set_defaults(run=post)
+
+    command = commands.add_parser('serve', help='serve the json api over http')
+    command.add_argument('--host', help='address to listen on, default from the settings')
+    command.add_argument('--port', type=int, help='port to listen on, default from the settings')
+    command.set_defaults(run=serve_api)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run a batch operation from the command line, for the scheduled
+    tasks of a server without a display:
+    python3 -m application.cli [--database FILE] command ...
+    The reports and exports are written to the standard output, or to
+    --output FILE, one chunk of rows at a time so the memory used does
+    not depend on the size of the database. Neither tkinter nor the
+    windows are imported.
+    """
+    args = build_parser().parse_args(argv)
+    database = Database(args.database)
+    if not database.exists():
+        print('The database %s does not exist.' % database.filename, file=sys.stderr)
+        return 1
+    try:
+        migrate(database.connect())
+        return args.run(InventoryStore(database), args)
+    except (sqlite3.Error, OSError, ValueError) as error:
+        print('The %s command failed: %s' % (args.command, error), file=sys.stderr)
+        return 1
+    finally:
+        database.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
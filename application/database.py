@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#
+# database.py - Connection manager of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from application.settings import get_settings
+
+
+class Database:
+    """
+    Own the connection to the inventory database. The connection is
+    opened on first use and configured from the [database] section of
+    the settings, every window of the application shares the same one
+    so the page cache stays warm and windows don't lock each other.
+    The statements of a traced database are timed for the Diagnostics
+    window.
+    """
+
+    def __init__(self, filename=None, settings=None, retries=None, traced=False):
+        if settings is None:
+            settings = get_settings()
+        self.settings = settings['database']
+        if retries is None:
+            retries = self.settings.getint('retries')
+        self.retries = retries
+        self.traced = traced
+        if filename is None:
+            filename = self.settings.get('filename')
+        # Resolve the path once so changing the working directory later
+        # doesn't open another database.
+        self.filename = os.path.abspath(filename)
+        self.connection = None
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def connect(self):
+        """
+        Return the connection, opening and configuring it if needed.
+        """
+        if self.connection is None:
+            self.connection = self.open()
+        return self.connection
+
+    def open(self, **kwargs):
+        """
+        Open a new configured connection to the same database file.
+        """
+        if self.traced:
+            from application.trace import TracedConnection
+            kwargs.setdefault('factory', TracedConnection)
+        connection = sqlite3.connect(
+            self.filename,
+            timeout=self.settings.getint('busy_timeout') / 1000,
+            cached_statements=self.settings.getint('cached_statements'),
+            **kwargs)
+        self.configure(connection)
+        return connection
+
+    def configure(self, connection):
+        if self.settings.getboolean('concurrent'):
+            connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA cache_size = %d"
+                           % self.settings.getint('cache_size'))
+        connection.execute("PRAGMA mmap_size = %d"
+                           % self.settings.getint('mmap_size'))
+        connection.execute("PRAGMA synchronous = %s"
+                           % self.settings.get('synchronous'))
+        connection.execute("PRAGMA temp_store = %s"
+                           % self.settings.get('temp_store'))
+
+    def cursor(self):
+        return self.connect().cursor()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Run the statements of the with block in one transaction, it is
+        committed when the block ends and rolled back if it raises. An
+        immediate transaction takes the write lock at the start so a
+        busy database fails before anything has been executed. Inside a
+        transaction that is already open the block is a savepoint, the
+        statements before it are neither committed nor rolled back.
+        """
+        connection = self.connect()
+        cur = connection.cursor()
+        if connection.in_transaction:
+            cur.execute("SAVEPOINT block")
+            try:
+                yield cur
+                cur.execute("RELEASE block")
+            except BaseException:
+                # Some errors roll back the whole transaction by themselves.
+                if connection.in_transaction:
+                    cur.execute("ROLLBACK TO block")
+                    cur.execute("RELEASE block")
+                raise
+            finally:
+                cur.close()
+            return
+        if immediate:
+            cur.execute("BEGIN IMMEDIATE")
+        else:
+            cur.execute("BEGIN")
+        try:
+            yield cur
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def write(self, function, *args):
+        """
+        Call function(cursor, *args) in an immediate transaction and
+        return its result. When another terminal keeps the database
+        locked past the busy timeout the whole transaction is tried
+        again with an exponential backoff before giving up, unless the
+        database was made without retries.
+        """
+        retries = self.retries
+        delay = self.settings.getfloat('retry_delay')
+        attempt = 0
+        while True:
+            try:
+                with self.transaction(immediate=True) as cur:
+                    return function(cur, *args)
+            except sqlite3.OperationalError as error:
+                if not is_busy(error) or attempt >= retries:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+            delay *= 2
+
+    @contextmanager
+    def synchronous(self, level=None):
+        """
+        Use another synchronous level for the transactions of the with
+        block, the configured one is used again when it ends.
+        """
+        if not level:
+            yield
+            return
+        connection = self.connect()
+        connection.execute("PRAGMA synchronous = %s" % level)
+        try:
+            yield
+        finally:
+            connection.execute("PRAGMA synchronous = %s"
+                               % self.settings.get('synchronous'))
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        """
+        Commit the pending changes and close the connection.
+        """
+        if self.connection is not None:
+            try:
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+            self.connection.close()
+            self.connection = None
+
+
+def is_busy(error):
+    """
+    Return True if the error is raised because the database is locked.
+    """
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+_database = None
+
+
+def get_database():
+    """
+    Return the database shared by the whole application.
+    """
+    global _database
+    if _database is None:
+        # The windows save through the database worker, which tries the
+        # writes again. The few writes left on the tkinter thread, like
+        # the migrations, only wait the busy timeout so as not to sleep
+        # between the retries with the windows frozen.
+        _database = Database(retries=0,
+                             traced=get_settings()['trace'].getboolean('enabled'))
+    return _database
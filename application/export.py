@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# export.py - Streaming csv export of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import csv
+import os
+import queue
+import threading
+from itertools import islice
+
+from application.balance import balances_as_of
+from application.balance import period_balances
+from application.balance import stock_balances
+from application.valuation import stock_valuation
+
+REPORT_HEADER = ['S. No.', 'Item Code', 'Description', 'Unit', 'In', 'Out', 'Balance']
+PERIOD_HEADER = ['S. No.', 'Item Code', 'Description', 'Unit', 'Opening', 'In', 'Out',
+                 'Closing']
+AS_OF_HEADER = ['S. No.', 'Item Code', 'Description', 'Unit', 'Balance']
+VALUATION_HEADER = ['S. No.', 'Item Code', 'Description', 'Unit', 'Quantity',
+                    'Average Cost', 'Average Value', 'FIFO Value']
+
+# Rows read from the cursor at a time and size of the file buffer, the
+# memory used by an export doesn't depend on the size of the database.
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 1 << 16
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def write_report(cursor, filename, title, header, rows, progress=None,
+                 cancel=None, chunk_size=CHUNK_SIZE):
+    """
+    Write a report into a csv file while reading the rows, a cursor or
+    an iterator, chunk by chunk. progress(done, total) is called after
+    each chunk, and the export stops with ExportCancelled when the
+    cancel event is set. Return the number of items written.
+    """
+    total = cursor.connection.execute("SELECT COUNT(*) FROM item").fetchone()[0]
+    done = 0
+    with open(filename, 'w', newline='', buffering=BUFFER_SIZE) as csvfile:
+        cwriter = csv.writer(csvfile, delimiter=',',
+                             quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        # Write the title and the header of the report.
+        cwriter.writerow([title])
+        cwriter.writerow(header)
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelled()
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            cwriter.writerows(chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, total)
+    return done
+
+
+def write_balances(cursor, filename, title, progress=None, cancel=None,
+                   chunk_size=CHUNK_SIZE):
+    """
+    Write the stock balance report into a csv file.
+    """
+    return write_report(cursor, filename, title, REPORT_HEADER,
+                        stock_balances(cursor), progress, cancel, chunk_size)
+
+
+def write_valuation(cursor, filename, title, progress=None, cancel=None,
+                    chunk_size=CHUNK_SIZE):
+    """
+    Write the stock valuation report into a csv file, the valuation
+    should have been brought up to date before.
+    """
+    return write_report(cursor, filename, title, VALUATION_HEADER,
+                        stock_valuation(cursor), progress, cancel, chunk_size)
+
+
+def write_period(cursor, filename, title, start, end, progress=None,
+                 cancel=None, chunk_size=CHUNK_SIZE):
+    """
+    Write the opening and closing balance of each item between two
+    dates, both included, into a csv file.
+    """
+    return write_report(cursor, filename, title, PERIOD_HEADER,
+                        period_balances(cursor, start, end), progress, cancel,
+                        chunk_size)
+
+
+def write_as_of(cursor, filename, title, day, progress=None, cancel=None,
+                chunk_size=CHUNK_SIZE):
+    """
+    Write the balance of each item at the end of a day into a csv file.
+    """
+    rows = (row[:4] + row[7:] for row in balances_as_of(cursor, day))
+    return write_report(cursor, filename, title, AS_OF_HEADER, rows,
+                        progress, cancel, chunk_size)
+
+
+class ExportThread(threading.Thread):
+    """
+    Run an export on a worker thread with its own connection to the
+    database. The progress is put in the messages queue so the window
+    can read it from the tkinter thread. The args are passed to the
+    write function after the title, like the dates of a period report.
+    The messages are:
+        ('progress', done, total)
+        ('done', filename, rows)
+        ('cancelled', filename)
+        ('error', message)
+    """
+
+    def __init__(self, database, filename, title, chunk_size=CHUNK_SIZE,
+                 write=write_balances, args=()):
+        threading.Thread.__init__(self, daemon=True)
+        self.database = database
+        self.write = write
+        self.args = args
+        self.filename = filename
+        self.title = title
+        self.chunk_size = chunk_size
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def progress(self, done, total):
+        self.messages.put(('progress', done, total))
+
+    def run(self):
+        # sqlite3 connections belong to the thread that opens them.
+        connection = self.database.open()
+        cur = connection.cursor()
+        try:
+            rows = self.write(cur, self.filename, self.title, *self.args,
+                              progress=self.progress, cancel=self.cancel_event,
+                              chunk_size=self.chunk_size)
+            self.messages.put(('done', self.filename, rows))
+        except ExportCancelled:
+            # Don't leave a half written report behind.
+            os.remove(self.filename)
+            self.messages.put(('cancelled', self.filename))
+        except Exception as error:
+            self.messages.put(('error', str(error)))
+        finally:
+            cur.close()
+            connection.close()
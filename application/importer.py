@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+#
+# importer.py - Bulk csv import of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+#
+# The csv file starts with a header row naming its columns, in any order:
+#   items:              itemcode, description, unit
+#   incoming, outgoing: itemcode, quantity, date (YYYY-MM-DD), and the
+#                       optional description, unit, rate and remarks.
+# Outgoing quantities are given as positive numbers. A missing description
+# or unit of a transaction is taken from the item master.
+
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from collections import namedtuple
+from itertools import islice
+
+from application.balance import create_balance_table
+from application.balance import rebuild_balances
+from application.database import Database
+from application.schema import create_date_indexes
+from application.schema import create_indexes
+from application.schema import migrate
+from application.store import INCOMING
+from application.store import OUTGOING
+from application.store import datestring
+
+ITEMS = 'items'
+KINDS = (ITEMS, INCOMING, OUTGOING)
+
+COLUMNS = {
+    ITEMS: ('itemcode', 'description', 'unit'),
+    INCOMING: ('itemcode', 'description', 'unit', 'quantity', 'rate', 'date', 'remarks'),
+    OUTGOING: ('itemcode', 'description', 'unit', 'quantity', 'rate', 'date', 'remarks'),
+}
+
+REQUIRED = {
+    ITEMS: ('itemcode',),
+    INCOMING: ('itemcode', 'quantity', 'date'),
+    OUTGOING: ('itemcode', 'quantity', 'date'),
+}
+
+# Rows parsed by a worker at a time and the number of rows of a
+# transaction import from which the indexes and balance triggers are
+# dropped during the load and built again once at the end.
+CHUNK_SIZE = 5000
+INDEX_THRESHOLD = 20000
+# Chunks read ahead of the inserts for each worker process, the rest of
+# the file is only read as the chunks are inserted.
+READ_AHEAD = 2
+
+ImportResult = namedtuple('ImportResult', 'imported rejected rejected_filename')
+
+
+def columnname(name):
+    # 'Item Code' and 'itemcode' are the same column.
+    return name.strip().lower().replace(' ', '').replace('_', '')
+
+
+def headermap(kind, header):
+    """
+    Return the position of each known column in the header row.
+    """
+    positions = {}
+    for position, name in enumerate(header):
+        name = columnname(name)
+        if name in COLUMNS[kind]:
+            positions[name] = position
+    missing = [name for name in REQUIRED[kind] if name not in positions]
+    if missing:
+        raise ValueError('Missing column(s): ' + ', '.join(missing))
+    return positions
+
+
+def parse_row(kind, positions, row):
+    """
+    Return the values to insert for a csv row, raise ValueError with the
+    reason when the row is not valid.
+    """
+    values = {}
+    for name in COLUMNS[kind]:
+        position = positions.get(name)
+        if position is None or position >= len(row):
+            values[name] = ''
+        else:
+            values[name] = row[position].strip()
+    if values['itemcode'] == '':
+        raise ValueError('empty item code')
+    if kind == ITEMS:
+        return (values['itemcode'], values['description'], values['unit'])
+    try:
+        quantity = float(values['quantity'])
+    except ValueError:
+        raise ValueError('invalid quantity %r' % values['quantity'])
+    if values['rate'] == '':
+        rate = 0.0
+    else:
+        try:
+            rate = float(values['rate'])
+        except ValueError:
+            raise ValueError('invalid rate %r' % values['rate'])
+    try:
+        tdate = datestring(values['date'])
+    except ValueError:
+        raise ValueError('invalid date %r' % values['date'])
+    if kind == OUTGOING:
+        quantity = -quantity
+    return (values['itemcode'], values['description'], values['unit'],
+            quantity, rate, tdate, values['remarks'])
+
+
+def parse_chunk(job):
+    """
+    Parse and validate a chunk of rows, this runs in the worker
+    processes. Return the valid rows with their values and the rejected
+    rows with the reasons.
+    """
+    kind, positions, chunk = job
+    valid = []
+    rejected = []
+    for line, row in chunk:
+        try:
+            valid.append((line, row, parse_row(kind, positions, row)))
+        except ValueError as error:
+            rejected.append((line, row, str(error)))
+    return valid, rejected
+
+
+def read_chunks(kind, positions, reader, chunk_size):
+    line = 1
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield (kind, positions, [(line + number + 1, row)
+                                 for number, row in enumerate(chunk)])
+        line += len(chunk)
+
+
+def parse_ahead(pool, jobs, window):
+    """
+    Parse the chunks on the pool and return their results in order,
+    with at most window chunks read from the file and not yet returned.
+    Pool.imap would read the whole file into its task queue.
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(parse_chunk, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def count_rows(filename):
+    with open(filename, 'rb') as csvfile:
+        return max(0, sum(1 for line in csvfile) - 1)
+
+
+def drop_balance_maintenance(cur, table):
+    cur.execute("DROP INDEX IF EXISTS %s_itemcode_date" % table)
+    cur.execute("DROP INDEX IF EXISTS %s_date" % table)
+    for action in ('insert', 'delete', 'update'):
+        cur.execute("DROP TRIGGER IF EXISTS %s_balance_%s" % (table, action))
+
+
+def restore_balance_maintenance(cur):
+    create_indexes(cur)
+    create_date_indexes(cur)
+    create_balance_table(cur)
+    rebuild_balances(cur)
+
+
+class Importer:
+    """
+    Import a csv file of items or transactions. The rows are parsed by
+    a pool of worker processes while the main process inserts the valid
+    ones with executemany in a single transaction, so a failed import
+    leaves the database untouched.
+    """
+
+    def __init__(self, database, kind, filename, rejected_filename=None,
+                 workers=None, chunk_size=CHUNK_SIZE, progress=None):
+        if kind not in KINDS:
+            raise ValueError('Unknown import kind: %r' % (kind,))
+        self.database = database
+        self.kind = kind
+        self.filename = filename
+        if rejected_filename is None:
+            rejected_filename = os.path.splitext(filename)[0] + '.rejected.csv'
+        self.rejected_filename = rejected_filename
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def run(self):
+        total = count_rows(self.filename)
+        return self.database.write(self.load, total)
+
+    def load(self, cur, total):
+        imported = 0
+        rejected = 0
+        fast = self.kind != ITEMS and total >= INDEX_THRESHOLD
+        if fast:
+            drop_balance_maintenance(cur, self.kind)
+        known = self.knownitems(cur)
+
+        with open(self.filename, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, [])
+            # A wrong header fails before the rejected file is created.
+            positions = headermap(self.kind, header)
+            jobs = read_chunks(self.kind, positions, reader, self.chunk_size)
+
+            if self.workers > 1 and total > self.chunk_size:
+                # Spawn the workers instead of forking the process, which
+                # may be running tkinter and other threads.
+                context = multiprocessing.get_context('spawn')
+                pool = context.Pool(self.workers)
+                results = parse_ahead(pool, jobs, self.workers * READ_AHEAD)
+            else:
+                pool = None
+                results = map(parse_chunk, jobs)
+            try:
+                with open(self.rejected_filename, 'w', newline='') as rejectfile:
+                    rejects = csv.writer(rejectfile)
+                    rejects.writerow(['line'] + header + ['reason'])
+                    for valid, invalid in results:
+                        valid = self.checkitems(valid, known, invalid)
+                        self.insert(cur, valid)
+                        for line, row, reason in invalid:
+                            rejects.writerow([line] + row + [reason])
+                        imported += len(valid)
+                        rejected += len(invalid)
+                        if self.progress is not None:
+                            self.progress(imported + rejected, total)
+            finally:
+                if pool is not None:
+                    pool.terminate()
+
+        if fast:
+            restore_balance_maintenance(cur)
+        if rejected == 0:
+            os.remove(self.rejected_filename)
+            return ImportResult(imported, 0, None)
+        return ImportResult(imported, rejected, self.rejected_filename)
+
+    def knownitems(self, cur):
+        """
+        Return the item codes of the item master, with their description
+        and unit for the transaction imports.
+        """
+        if self.kind == ITEMS:
+            return set(row[0] for row in cur.execute("SELECT itemcode FROM item"))
+        return dict((row[0], (row[1], row[2])) for row in
+                    cur.execute("SELECT itemcode, description, unit FROM item"))
+
+    def checkitems(self, valid, known, invalid):
+        """
+        Reject the duplicated items or the transactions of unknown items
+        and return the values of the rows to insert.
+        """
+        checked = []
+        for line, row, values in valid:
+            itemcode = values[0]
+            if self.kind == ITEMS:
+                if itemcode in known:
+                    invalid.append((line, row, 'duplicate item code'))
+                    continue
+                known.add(itemcode)
+            else:
+                item = known.get(itemcode)
+                if item is None:
+                    invalid.append((line, row, 'unknown item code'))
+                    continue
+                if values[1] == '' or values[2] == '':
+                    values = (itemcode, values[1] or item[0], values[2] or item[1]) + values[3:]
+            checked.append(values)
+        return checked
+
+    def insert(self, cur, rows):
+        if self.kind == ITEMS:
+            cur.executemany("INSERT INTO item VALUES(null, ?, ?, ?)", rows)
+        else:
+            cur.executemany("INSERT INTO " + self.kind +
+                            " VALUES(null, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+class ImportThread(threading.Thread):
+    """
+    Run an import on a worker thread with its own connection to the
+    database. The progress is put in the messages queue so the window
+    can read it from the tkinter thread:
+        ('progress', done, total)
+        ('done', result)
+        ('error', message)
+    """
+
+    def __init__(self, filename, kind, csvfilename):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.kind = kind
+        self.csvfilename = csvfilename
+        self.messages = queue.Queue()
+
+    def progress(self, done, total):
+        self.messages.put(('progress', done, total))
+
+    def run(self):
+        # sqlite3 connections belong to the thread that opens them.
+        database = Database(self.filename)
+        try:
+            importer = Importer(database, self.kind, self.csvfilename,
+                                progress=self.progress)
+            self.messages.put(('done', importer.run()))
+        except Exception as error:
+            self.messages.put(('error', str(error)))
+        finally:
+            database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import items or transactions from a csv file.')
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('filename', help='csv file with a header row')
+    parser.add_argument('--database', help='database file, default from the settings')
+    parser.add_argument('--workers', type=int, help='number of parsing processes')
+    parser.add_argument('--rejected', help='csv file receiving the rejected rows')
+    args = parser.parse_args()
+    database = Database(args.database)
+    migrate(database.connect())
+    importer = Importer(database, args.kind, args.filename,
+                        args.rejected, args.workers)
+    result = importer.run()
+    print('%d row(s) imported, %d rejected.' % (result.imported, result.rejected))
+    if result.rejected:
+        print('Rejected rows have been written to ' + result.rejected_filename)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
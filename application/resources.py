@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#
+# resources.py - Shared icon and license text of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import os
+import tkinter as tk
+
+ICON_FILE = 'tsicon.gif'
+LICENSE_FILE = 'LICENSE'
+
+# The icon image of each Tk root, None when it could not be read so the
+# file is not tried again for every window.
+_icons = {}
+_license = None
+
+
+def window_icon(window):
+    """
+    Set the icon of a window. The image is read from the disk once and
+    shared by every window of the application.
+    """
+    root = window._root()
+    if root not in _icons:
+        try:
+            _icons[root] = tk.PhotoImage(master=root,
+                                         file=os.path.join(os.getcwd(), ICON_FILE))
+        except tk.TclError:
+            print('Sorry an error occured setting the icon.')
+            _icons[root] = None
+    icon = _icons[root]
+    if icon is not None:
+        window.iconphoto(False, icon)
+
+
+def license_text():
+    """
+    Return the text of the license, read from the disk the first time.
+    """
+    global _license
+    if _license is None:
+        with open(os.path.join(os.getcwd(), LICENSE_FILE), encoding='utf-8') as lic_file:
+            _license = lic_file.read()
+    return _license
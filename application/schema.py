@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# schema.py - Database migrations of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import sys
+import sqlite3
+
+from application.database import Database
+
+# Each migration imports the modules of its tables, an up to date
+# database is opened without loading them.
+
+
+def create_tables(cursor):
+    """
+    Version 1, the tables of the first release of the application.
+    """
+    # Create item table.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS item(rowid INTEGER PRIMARY KEY,
+            itemcode TEXT,
+            description TEXT,
+            unit TEXT)
+        """)
+    # Create incoming and outgoing transaction table.
+    for table in ('incoming', 'outgoing'):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS """ + table + """(
+                rowid INTEGER PRIMARY KEY,
+                itemcode TEXT,
+                description TEXT,
+                unit TEXT,
+                quantity REAL,
+                rate REAL,
+                date DATE,
+                remarks TEXT)
+            """)
+    # Create company details.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS company(com_name TEXT,
+            com_address TEXT,
+            com_telephone TEXT,
+            com_fax TEXT,
+            com_email TEXT)
+        """)
+
+
+def create_stock_balance(cursor):
+    """
+    Version 2, the running stock balance of each item.
+    """
+    from application.balance import create_balance_table
+    from application.balance import rebuild_balances
+    create_balance_table(cursor)
+    rebuild_balances(cursor)
+
+
+def create_indexes(cursor):
+    """
+    Version 3, indexes for the item code lookups and the transactions
+    of an item ordered by date. The item code is made unique unless the
+    existing item master already has duplicates.
+    """
+    try:
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS item_itemcode
+            ON item(itemcode)
+            """)
+    except sqlite3.IntegrityError:
+        print('Duplicate item codes found, item code is not made unique.')
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS item_itemcode ON item(itemcode)
+            """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS incoming_itemcode_date
+        ON incoming(itemcode, date)
+        """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS outgoing_itemcode_date
+        ON outgoing(itemcode, date)
+        """)
+
+
+def create_search_index(cursor):
+    """
+    Version 4, full text index of the item codes and descriptions.
+    """
+    from application.search import create_item_search
+    if not create_item_search(cursor):
+        print('SQLite has no FTS5 support, item search will use LIKE.')
+
+
+def create_date_indexes(cursor):
+    """
+    Version 5, indexes of the transactions by date for the reports over
+    a date range. They hold the item code and quantity as well so the
+    sums are read from the index alone.
+    """
+    for table in ('incoming', 'outgoing'):
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS """ + table + """_date
+            ON """ + table + """(date, itemcode, quantity)
+            """)
+
+
+def create_balance_snapshots(cursor):
+    """
+    Version 6, closing balance snapshots of the ended periods.
+    """
+    from application.snapshot import create_snapshot_tables
+    create_snapshot_tables(cursor)
+
+
+def create_valuation(cursor):
+    """
+    Version 7, saved cost state of the weighted average and FIFO
+    valuation.
+    """
+    from application.valuation import create_valuation_tables
+    create_valuation_tables(cursor)
+
+
+def create_archives(cursor):
+    """
+    Version 8, list of the yearly archives of the old transactions. The
+    snapshot triggers of version 6 are replaced as they scanned the
+    snapshots on each deleted row.
+    """
+    from application.archive import create_archive_table
+    from application.snapshot import recreate_snapshot_triggers
+    create_archive_table(cursor)
+    recreate_snapshot_triggers(cursor)
+
+
+def create_carried_forward(cursor):
+    """
+    Version 9, list of the carried forward rows of the archiving, which
+    were told apart by their remarks before. The existing ones are the
+    rows with those remarks dated on the last day of an archived period.
+    """
+    from application.archive import CARRIED_FORWARD
+    from application.archive import TRANSACTION_TABLES
+    from application.archive import create_carried_table
+    create_carried_table(cursor)
+    for table in TRANSACTION_TABLES:
+        cursor.execute("""
+            INSERT OR IGNORE INTO carried_forward
+            SELECT ?, rowid FROM """ + table + """
+            WHERE remarks IS ?
+            AND date IN (SELECT datetime(until, '-1 day') FROM archive_year)
+            """, (table, CARRIED_FORWARD))
+
+
+# The position of a migration in this list is the schema version it
+# upgrades the database to, new migrations are only ever appended.
+MIGRATIONS = [create_tables,
+              create_stock_balance,
+              create_indexes,
+              create_search_index,
+              create_date_indexes,
+              create_balance_snapshots,
+              create_valuation,
+              create_archives,
+              create_carried_forward
+              ]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(database):
+    """
+    Return the schema version stored in PRAGMA user_version.
+    """
+    return database.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(database):
+    """
+    Upgrade the database in place to the latest schema version. Each
+    migration and the new user_version are committed together so an
+    interrupted upgrade resumes from the last completed version. Return
+    the list of versions that have been applied.
+    """
+    applied = []
+    version = schema_version(database)
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(
+            'Database schema version %d is newer than this application '
+            'supports (%d).' % (version, SCHEMA_VERSION))
+    # Each migration runs in its own transaction.
+    if database.in_transaction:
+        database.commit()
+    cur = database.cursor()
+    try:
+        for number in range(version + 1, SCHEMA_VERSION + 1):
+            cur.execute("BEGIN")
+            try:
+                MIGRATIONS[number - 1](cur)
+                cur.execute("PRAGMA user_version = %d" % number)
+                database.commit()
+            except sqlite3.Error:
+                database.rollback()
+                raise
+            applied.append(number)
+    finally:
+        cur.close()
+    return applied
+
+
+def main():
+    """
+    Upgrade a database from the command line:
+    python3 -m application.schema [inv_database.db]
+    """
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = None
+    database = Database(filename).connect()
+    try:
+        applied = migrate(database)
+    except sqlite3.Error as error:
+        print('Upgrading the database failed:', error)
+        return 1
+    finally:
+        database.close()
+    if applied:
+        print('Database upgraded to version %d.' % applied[-1])
+    else:
+        print('Database is up to date.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
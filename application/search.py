@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# search.py - Full text search of the item master.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import re
+import sqlite3
+
+# Full text index over the item code and description. The index only
+# stores the tokens, the text is read back from the item table. Item
+# codes like 'AB-100/2' are kept as one token so they can be searched
+# by prefix, and the two and three letter prefixes are indexed for the
+# short searches.
+SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(
+        itemcode,
+        description,
+        content='item',
+        content_rowid='rowid',
+        prefix='2 3',
+        tokenize="unicode61 tokenchars '-_./#'")
+    """
+
+SEARCH_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item
+    BEGIN
+        INSERT INTO item_fts(rowid, itemcode, description)
+        VALUES (new.rowid, new.itemcode, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item
+    BEGIN
+        INSERT INTO item_fts(item_fts, rowid, itemcode, description)
+        VALUES ('delete', old.rowid, old.itemcode, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS item_fts_update AFTER UPDATE ON item
+    BEGIN
+        INSERT INTO item_fts(item_fts, rowid, itemcode, description)
+        VALUES ('delete', old.rowid, old.itemcode, old.description);
+        INSERT INTO item_fts(rowid, itemcode, description)
+        VALUES (new.rowid, new.itemcode, new.description);
+    END
+    """,
+)
+
+# A match in the item code weighs more than one in the description and
+# an exact item code always comes first. The matches are ranked by the
+# full text index itself, which keeps only the best ones while reading
+# them.
+SEARCH_QUERY = """
+    SELECT item.* FROM (
+        SELECT rowid, MIN(score) AS score FROM (
+            SELECT * FROM (
+                SELECT rowid, rank AS score FROM item_fts
+                WHERE item_fts MATCH ? AND rank MATCH 'bm25(10.0, 1.0)'
+                ORDER BY rank LIMIT ?)
+            UNION ALL
+            SELECT rowid, -1e300 FROM item WHERE itemcode = ?)
+        GROUP BY rowid) AS found
+    JOIN item ON item.rowid = found.rowid
+    ORDER BY found.score, item.rowid
+    LIMIT ?
+    """
+
+# Used when sqlite3 is built without FTS5.
+LIKE_QUERY = """
+    SELECT * FROM item
+    WHERE itemcode LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\'
+    ORDER BY itemcode = ? DESC, itemcode LIKE ? ESCAPE '\\' DESC, itemcode
+    LIMIT ?
+    """
+
+TOKEN = re.compile(r"[\w\-./#]+")
+
+
+def has_fts5(cursor):
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.fts5_check USING fts5(text)")
+    except sqlite3.OperationalError:
+        return False
+    cursor.execute("DROP TABLE temp.fts5_check")
+    return True
+
+
+def create_item_search(cursor):
+    """
+    Create the full text index of the items and the triggers keeping it
+    in sync with the item table, then index the existing items. Return
+    False when sqlite3 doesn't support FTS5.
+    """
+    if not has_fts5(cursor):
+        return False
+    cursor.execute(SEARCH_TABLE)
+    for trigger in SEARCH_TRIGGERS:
+        cursor.execute(trigger)
+    rebuild_item_search(cursor)
+    return True
+
+
+def rebuild_item_search(cursor):
+    cursor.execute("INSERT INTO item_fts(item_fts) VALUES ('rebuild')")
+
+
+def search_available(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'item_fts'")
+    return cursor.fetchone() is not None
+
+
+def match_query(text):
+    """
+    Return the FTS5 query finding the items having every word of the
+    text as a prefix of a word of their item code or description, or
+    None when the text has no words.
+    """
+    words = TOKEN.findall(text.lower())
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+
+
+def like_pattern(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_items(cursor, text, limit=100, fulltext=True):
+    """
+    Return a cursor over the items best matching the text, ranked by
+    relevance. Without the full text index the items whose item code
+    starts with the text or whose description contains it are returned.
+    """
+    text = text.strip()
+    if fulltext:
+        query = match_query(text)
+        if query is None:
+            return iter(())
+        return cursor.execute(SEARCH_QUERY, (query, limit, text, limit))
+    pattern = like_pattern(text)
+    return cursor.execute(LIKE_QUERY, (pattern + '%', '%' + pattern + '%',
+                                       text, pattern + '%', limit))
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+#
+# server.py - JSON API of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import argparse
+import asyncio
+import json
+import queue
+import sqlite3
+import sys
+import threading
+from datetime import date
+from http import HTTPStatus
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+from application.database import Database
+from application.schema import migrate
+from application.settings import get_settings
+from application.store import OUTGOING
+from application.store import TRANSACTION_TABLES
+from application.store import InventoryStore
+from application.store import Transaction
+from application.store import datestring
+
+# Rows of a page when the request doesn't give a limit, and headers
+# read from a request at most.
+PAGE_SIZE = 100
+MAX_HEADERS = 100
+
+
+class RequestError(Exception):
+    """
+    An error answered to the client with the given HTTP status.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def settle(future, result, error):
+    # The request is cancelled when its client goes away.
+    if future.done():
+        return
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+
+
+class ReadPool:
+    """
+    Answer the reads on a few threads, each with its own connection to
+    the database, so a slow read holds up neither the other reads nor
+    the event loop. function(store, *args) runs on one of the threads and
+    its result is set on the future returned by submit.
+    """
+
+    def __init__(self, filename, loop, size):
+        self.filename = filename
+        self.loop = loop
+        self.requests = queue.Queue()
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for number in range(size)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        # sqlite3 connections belong to the thread that opens them.
+        database = Database(self.filename)
+        store = InventoryStore(database)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            future, function, args = request
+            try:
+                result = function(store, *args)
+            except Exception as error:
+                self.loop.call_soon_threadsafe(settle, future, None, error)
+            else:
+                self.loop.call_soon_threadsafe(settle, future, result, None)
+            finally:
+                # Don't keep a read transaction open between the requests,
+                # it would hold the snapshot of the database.
+                if database.connection is not None and database.connection.in_transaction:
+                    database.connection.rollback()
+        database.close()
+
+    def submit(self, function, *args):
+        future = self.loop.create_future()
+        self.requests.put((future, function, args))
+        return future
+
+    def stop(self):
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Writer(threading.Thread):
+    """
+    Save all the writes through one thread and one connection, in the
+    order they are received, so the requests never wait on each other's
+    locks. The writes waiting in the queue are saved together in one
+    transaction, each one in its own savepoint so a failing request
+    doesn't undo the others, and the whole group is synced to the disk
+    once. function(cursor, *args) runs inside the transaction.
+    """
+
+    def __init__(self, filename, loop, size, batch, synchronous=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.loop = loop
+        self.requests = queue.Queue(size)
+        self.batch = batch
+        self.synchronous = synchronous
+
+    def run(self):
+        database = Database(self.filename)
+        running = True
+        while running:
+            request = self.requests.get()
+            if request is None:
+                break
+            requests = [request]
+            while len(requests) < self.batch:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                requests.append(request)
+            try:
+                with database.synchronous(self.synchronous):
+                    results = database.write(self.save, requests)
+            except Exception as error:
+                results = [(None, error)] * len(requests)
+            for (future, function, args), (result, error) in zip(requests, results):
+                self.loop.call_soon_threadsafe(settle, future, result, error)
+        database.close()
+
+    def save(self, cur, requests):
+        results = []
+        for future, function, args in requests:
+            cur.execute("SAVEPOINT request")
+            try:
+                results.append((function(cur, *args), None))
+            except Exception as error:
+                cur.execute("ROLLBACK TO request")
+                results.append((None, error))
+            cur.execute("RELEASE request")
+        return results
+
+    def submit(self, function, *args):
+        """
+        Queue function(cursor, *args) and return the future of its result,
+        raise queue.Full when too many writes are waiting.
+        """
+        future = self.loop.create_future()
+        self.requests.put_nowait((future, function, args))
+        return future
+
+    def stop(self):
+        self.requests.put(None)
+        self.join()
+
+
+def parse_lines(body):
+    """
+    Return the (itemcode, quantity, rate, date, remarks) lines of the
+    json body of a posting, a transaction or a list of transactions.
+    The quantities are positive for both tables.
+    """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(HTTPStatus.BAD_REQUEST, 'The body is not json.')
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise RequestError(HTTPStatus.BAD_REQUEST,
+                           'Send a transaction or a list of transactions.')
+    lines = []
+    for number, line in enumerate(data, 1):
+        if not isinstance(line, dict):
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: a transaction is a json object.' % number)
+        itemcode = line.get('itemcode')
+        if not isinstance(itemcode, str) or not itemcode:
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: the item code is missing.' % number)
+        try:
+            quantity = float(line['quantity'])
+            rate = float(line['rate'])
+        except (KeyError, TypeError, ValueError):
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: the rate and quantity must be numbers.' % number)
+        if not quantity > 0:
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: the quantity must be more than 0.' % number)
+        if not rate >= 0:
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: the rate cannot be negative.' % number)
+        tdate = line.get('date') or str(date.today())
+        try:
+            datestring(tdate)
+        except (TypeError, ValueError):
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               'Line %d: the date is not YYYY-MM-DD.' % number)
+        lines.append((itemcode, quantity, rate, tdate, str(line.get('remarks', ''))))
+    return lines
+
+
+def post_lines(cur, table, lines):
+    """
+    Save the lines of a posting into the incoming or outgoing table and
+    return them as transactions. The description and unit are taken from
+    the item master, an unknown item code fails the whole posting.
+    """
+    sign = -1.0 if table == OUTGOING else 1.0
+    transactions = []
+    for number, (itemcode, quantity, rate, tdate, remarks) in enumerate(lines, 1):
+        item = cur.execute("SELECT description, unit FROM item WHERE itemcode = ?",
+                           (itemcode,)).fetchone()
+        if item is None:
+            raise RequestError(HTTPStatus.UNPROCESSABLE_ENTITY,
+                               'Line %d: unknown item code %s.' % (number, itemcode))
+        values = (itemcode, item[0], item[1], sign * quantity, rate,
+                  datestring(tdate), remarks)
+        rowid = cur.execute("INSERT INTO " + table + " VALUES(null, ?, ?, ?, ?, ?, ?, ?)",
+                            values).lastrowid
+        transactions.append(Transaction(rowid, *values))
+    return transactions
+
+
+def response(status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    head = ('HTTP/1.1 %d %s\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n\r\n'
+            % (status, HTTPStatus(status).phrase, len(body),
+               'keep-alive' if keep_alive else 'close'))
+    return head.encode('latin-1') + body
+
+
+class InventoryServer:
+    """
+    Answer the JSON API of the inventory over HTTP with asyncio:
+        GET  /items?after=ROWID&limit=N          page of the item master
+        GET  /items/ITEMCODE                     stock balance of an item
+        GET  /balances?after=ROWID&limit=N       page of the stock balances
+        GET  /transactions/TABLE?after=ROWID&limit=N
+                                                 page of the transactions
+        POST /transactions/TABLE                 save one or a list of
+             {"itemcode", "quantity", "rate", "date", "remarks"}
+    TABLE is incoming or outgoing. The pages are ordered by rowid, next
+    is the after of the following page or null on the last one. The
+    reads are answered by the read pool and the writes go through the
+    single writer.
+    """
+
+    def __init__(self, filename, settings=None):
+        if settings is None:
+            settings = get_settings()
+        self.filename = filename
+        self.settings = settings['server']
+        self.synchronous = settings['entry'].get('synchronous')
+        self.page_limit = self.settings.getint('page_limit')
+        self.max_body = self.settings.getint('max_body')
+        self.timeout = self.settings.getfloat('timeout')
+        self.readers = None
+        self.writer = None
+
+    async def serve(self, host=None, port=None, ready=None):
+        """
+        Answer the clients until the task is cancelled. ready(server) is
+        called once the socket listens.
+        """
+        if host is None:
+            host = self.settings.get('host')
+        if port is None:
+            port = self.settings.getint('port')
+        loop = asyncio.get_running_loop()
+        self.readers = ReadPool(self.filename, loop, self.settings.getint('readers'))
+        self.writer = Writer(self.filename, loop, self.settings.getint('queue'),
+                             self.settings.getint('batch'), self.synchronous)
+        self.readers.start()
+        self.writer.start()
+        try:
+            server = await asyncio.start_server(self.handle, host, port)
+            async with server:
+                if ready is not None:
+                    ready(server)
+                await server.serve_forever()
+        finally:
+            self.writer.stop()
+            self.readers.stop()
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests of one client connection, kept open between
+        the requests until the client closes it or stays idle too long.
+        """
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                try:
+                    body = await self.read_body(reader, writer, headers)
+                    status, payload = await self.dispatch(method, target, body)
+                except RequestError as error:
+                    status, payload = error.status, {'error': str(error)}
+                    if error.status in (HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                        HTTPStatus.NOT_IMPLEMENTED):
+                        # The body has not been read.
+                        keep_alive = False
+                except Exception as error:
+                    print('The request %s %s failed:' % (method, target), error)
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(error)}
+                writer.write(response(status, payload, keep_alive))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            # A line longer than the stream limit or a bad request line.
+            try:
+                writer.write(response(HTTPStatus.BAD_REQUEST,
+                                      {'error': 'Bad request.'}, False))
+                await writer.drain()
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """
+        Return (method, target, version, headers) of the next request or
+        None when the client has closed the connection.
+        """
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError('Bad request line: %r' % line)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise ValueError('Too many headers.')
+            name, separator, value = line.decode('latin-1').partition(':')
+            if not separator:
+                raise ValueError('Bad header: %r' % line)
+            headers[name.strip().lower()] = value.strip()
+        return parts[0].upper(), parts[1], parts[2], headers
+
+    async def read_body(self, reader, writer, headers):
+        if 'transfer-encoding' in headers:
+            raise RequestError(HTTPStatus.NOT_IMPLEMENTED,
+                               'Send the body with a Content-Length.')
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'Bad Content-Length.')
+        if length > self.max_body:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                               'The body is larger than %d bytes.' % self.max_body)
+        if length <= 0:
+            return b''
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        return await reader.readexactly(length)
+
+    async def dispatch(self, method, target, body):
+        """
+        Answer a request and return (status, payload).
+        """
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        try:
+            if path == ['items']:
+                self.allow(method, 'GET')
+                return await self.page(query, lambda store, after, limit:
+                                       store.list_items(after, limit))
+            if len(path) == 2 and path[0] == 'items':
+                self.allow(method, 'GET')
+                balance = await self.readers.submit(
+                    lambda store: store.item_balance(path[1]))
+                if balance is None:
+                    raise RequestError(HTTPStatus.NOT_FOUND,
+                                       'Unknown item code %s.' % path[1])
+                return HTTPStatus.OK, balance._asdict()
+            if path == ['balances']:
+                self.allow(method, 'GET')
+                return await self.page(query, lambda store, after, limit:
+                                       store.list_balances(after, limit))
+            if len(path) == 2 and path[0] == 'transactions' and path[1] in TRANSACTION_TABLES:
+                table = path[1]
+                if method == 'POST':
+                    return await self.post(table, body)
+                self.allow(method, 'GET')
+                return await self.page(query, lambda store, after, limit:
+                                       store.list_transactions(table, 0, limit, after))
+        except sqlite3.Error as error:
+            print('The request %s %s failed:' % (method, target), error)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': 'The database failed.'}
+        raise RequestError(HTTPStatus.NOT_FOUND, 'Unknown path %s.' % url.path)
+
+    def allow(self, method, allowed):
+        if method != allowed:
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED,
+                               'Use %s for this path.' % allowed)
+
+    def number(self, query, name, default):
+        try:
+            return int(query[name][0])
+        except KeyError:
+            return default
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, '%s must be a number.' % name)
+
+    async def page(self, query, function):
+        """
+        Read a page of rows after the rowid given in the query, the rows
+        are records of the store.
+        """
+        after = self.number(query, 'after', 0)
+        limit = max(1, min(self.number(query, 'limit', PAGE_SIZE), self.page_limit))
+        rows = await self.readers.submit(function, after, limit)
+        following = rows[-1].rowid if len(rows) == limit else None
+        return HTTPStatus.OK, {'rows': [row._asdict() for row in rows],
+                               'next': following}
+
+    async def post(self, table, body):
+        lines = parse_lines(body)
+        try:
+            future = self.writer.submit(post_lines, table, lines)
+        except queue.Full:
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE,
+                               'Too many writes are waiting, try again.')
+        transactions = await future
+        return HTTPStatus.CREATED, {'rows': [transaction._asdict()
+                                             for transaction in transactions]}
+
+
+def serve(filename, host=None, port=None):
+    """
+    Run the server in the foreground until it is interrupted.
+    """
+    server = InventoryServer(filename)
+
+    def ready(listening):
+        for sock in listening.sockets:
+            print('Serving the inventory on http://%s:%d' % sock.getsockname()[:2])
+
+    try:
+        asyncio.run(server.serve(host, port, ready))
+    except KeyboardInterrupt:
+        pass
+    except OSError as error:
+        print('The server failed:', error)
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the JSON API of the inventory database.')
+    parser.add_argument('--database', help='database file, default from the settings')
+    parser.add_argument('--host', help='address to listen on, default from the settings')
+    parser.add_argument('--port', type=int, help='port to listen on, default from the settings')
+    args = parser.parse_args()
+    database = Database(args.database)
+    if not database.exists():
+        print('The database %s does not exist.' % database.filename)
+        return 1
+    try:
+        migrate(database.connect())
+    except sqlite3.Error as error:
+        print('Upgrading the database failed:', error)
+        return 1
+    finally:
+        database.close()
+    return serve(database.filename, args.host, args.port)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# settings.py - Configuration of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import configparser
+
+SETTINGS_FILE = 'tarsierstock.ini'
+
+# Every setting has a default here so the application runs without a
+# tarsierstock.ini, the file only needs the values that are changed.
+DEFAULTS = {
+    'database': {
+        'filename': 'inv_database.db',
+        # Page cache size, negative values are in KiB.
+        'cache_size': '-20000',
+        # Bytes of the database file read through memory mapping.
+        'mmap_size': '67108864',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+        # Number of prepared statements kept by the sqlite3 module.
+        'cached_statements': '256',
+        # Concurrent-access mode for several terminals, it switches the
+        # database to write-ahead logging so readers and the writer
+        # don't block each other. WAL does not work on a network file
+        # share, it needs shared memory between the processes that open
+        # the file. Only enable it when every terminal runs on the
+        # computer holding the file, never on a shared folder opened by
+        # other PCs.
+        'concurrent': 'no',
+        # Milliseconds a statement waits for a lock held by another
+        # terminal before failing with "database is locked".
+        'busy_timeout': '5000',
+        # Times a write is tried again when the database stays locked,
+        # waiting retry_delay seconds, doubled after each attempt.
+        'retries': '4',
+        'retry_delay': '0.2',
+    },
+    'reports': {
+        # Closing balances are kept for each ended period, monthly or
+        # yearly, so the reports of past dates start from the nearest
+        # one instead of the first transaction. Each period stores one
+        # row per item, yearly suits a very large item master.
+        'period': 'monthly',
+    },
+    'entry': {
+        # The lines of a batch are saved in one transaction when it is
+        # posted. FULL syncs the posted batch to the disk before the
+        # window is cleared, an empty value uses the synchronous setting
+        # of the database.
+        'synchronous': 'FULL',
+        # Post the batch once it has this many lines, 0 only posts it
+        # with the Post button.
+        'autopost': '0',
+    },
+    'backup': {
+        # Folder of the backups, relative to the database file.
+        'folder': 'backups',
+        # Pages copied at each step of the backup, the database can be
+        # used by the other terminals between two steps.
+        'pages': '256',
+        # Seconds to wait before trying a step again when the database
+        # is locked.
+        'sleep': '0.05',
+        # Times the writes of the other terminals may restart the copy
+        # before the rest is copied under a read lock, this only happens
+        # without the concurrent mode.
+        'restarts': '3',
+        'compress': 'no',
+        # gzip level of the compressed backups, 1 is the fastest and 9
+        # the smallest.
+        'compresslevel': '6',
+        # Number of backups kept, the oldest are deleted. 0 keeps all.
+        'keep': '10',
+    },
+    'trace': {
+        # Time every statement and treeview update of the windows for the
+        # Diagnostics window, the statements slower than slow_ms
+        # milliseconds are written to the log file, rotated once it
+        # reaches max_bytes. It slows down the reading of the rows, the
+        # command line tools and the server are never traced.
+        'enabled': 'no',
+        'slow_ms': '200',
+        'logfile': 'tarsierstock-slow.log',
+        'max_bytes': '1048576',
+        'backups': '3',
+    },
+    'server': {
+        # Address of the JSON API of python3 -m application.server, only
+        # the local machine can connect by default. The server reads
+        # while writing in the concurrent mode of the database.
+        'host': '127.0.0.1',
+        'port': '8080',
+        # Connections answering the reads side by side, the writes all
+        # go through one connection in the order they are received.
+        'readers': '4',
+        # Writes waiting for the writer, the next ones are refused with
+        # 503 until it catches up.
+        'queue': '1000',
+        # Waiting writes saved together in one transaction.
+        'batch': '100',
+        # Largest number of rows of a page.
+        'page_limit': '1000',
+        # Largest request body in bytes, and seconds an idle connection
+        # of a client is kept open.
+        'max_body': '1048576',
+        'timeout': '30',
+    },
+    'export': {
+        # Suggested file and title of the exported stock report, the
+        # title can use {company} for the name of the company.
+        'filename': 'exportfile.csv',
+        'title': 'Stock Report - {company}',
+    },
+}
+
+_settings = None
+
+
+def load_settings(filename=SETTINGS_FILE):
+    """
+    Read the settings file on top of the defaults.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    config.read(filename)
+    return config
+
+
+def get_settings():
+    """
+    Return the settings of the application, reading them once.
+    """
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
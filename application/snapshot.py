@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# snapshot.py - Period closing balances of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import sys
+import sqlite3
+from datetime import date
+
+from application.database import Database
+
+# The closing balance of each item at the end of a period. A period is
+# identified by the day after its end, 'until', so the snapshot is the
+# sum of the movements dated before until. Items without movements have
+# no row and a balance of 0.
+SNAPSHOT_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS balance_period(until TEXT PRIMARY KEY,
+        closed_at TEXT)
+    """, """
+    CREATE TABLE IF NOT EXISTS balance_snapshot(until TEXT NOT NULL,
+        itemcode TEXT NOT NULL,
+        balance REAL NOT NULL,
+        PRIMARY KEY(until, itemcode)) WITHOUT ROWID
+    """)
+
+# A movement dated before the end of a closed period makes the snapshots
+# of that period and the later ones wrong, they are deleted and closed
+# again later. Rows without a date count as the oldest movements, the
+# comparison is kept on until alone so it is a range of the primary key.
+INVALIDATE = """
+        DELETE FROM balance_snapshot WHERE until > IFNULL({date}, '');
+        DELETE FROM balance_period WHERE until > IFNULL({date}, '');"""
+
+SNAPSHOT_TRIGGERS = ("""
+    CREATE TRIGGER IF NOT EXISTS {table}_snapshot_insert
+    AFTER INSERT ON {table}
+    WHEN NEW.date IS NULL OR NEW.date < (SELECT MAX(until) FROM balance_period)
+    BEGIN""" + INVALIDATE.format(date='NEW.date') + """
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_snapshot_delete
+    AFTER DELETE ON {table}
+    WHEN OLD.date IS NULL OR OLD.date < (SELECT MAX(until) FROM balance_period)
+    BEGIN""" + INVALIDATE.format(date='OLD.date') + """
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_snapshot_update
+    AFTER UPDATE OF itemcode, quantity, date ON {table}
+    WHEN OLD.date IS NULL OR NEW.date IS NULL
+        OR MIN(OLD.date, NEW.date) < (SELECT MAX(until) FROM balance_period)
+    BEGIN""" + INVALIDATE.format(date='MIN(OLD.date, NEW.date)') + """
+    END
+    """)
+
+# The closing balance of a period from the closing balance of the
+# previous period and the movements in between.
+CLOSE_FROM_SNAPSHOT = """
+    INSERT INTO balance_snapshot
+    SELECT :until, itemcode, SUM(quantity) FROM (
+        SELECT itemcode, balance AS quantity FROM balance_snapshot
+        WHERE until = :previous
+        UNION ALL
+        SELECT itemcode, quantity FROM incoming
+        WHERE date >= :previous AND date < :until
+        UNION ALL
+        SELECT itemcode, quantity FROM outgoing
+        WHERE date >= :previous AND date < :until)
+    WHERE quantity IS NOT NULL
+    GROUP BY itemcode
+    """
+
+CLOSE_FROM_START = """
+    INSERT INTO balance_snapshot
+    SELECT :until, itemcode, SUM(quantity) FROM (
+        SELECT itemcode, quantity FROM incoming
+        WHERE date < :until OR date IS NULL
+        UNION ALL
+        SELECT itemcode, quantity FROM outgoing
+        WHERE date < :until OR date IS NULL)
+    WHERE quantity IS NOT NULL
+    GROUP BY itemcode
+    """
+
+MONTHLY = 'monthly'
+YEARLY = 'yearly'
+PERIODS = (MONTHLY, YEARLY)
+
+
+def create_snapshot_tables(cursor):
+    """
+    Create the snapshot tables and the triggers on the incoming and
+    outgoing tables that invalidate them.
+    """
+    for table in SNAPSHOT_TABLES:
+        cursor.execute(table)
+    for trigger in SNAPSHOT_TRIGGERS:
+        cursor.execute(trigger.format(table='incoming'))
+        cursor.execute(trigger.format(table='outgoing'))
+
+
+def recreate_snapshot_triggers(cursor):
+    """
+    Replace the snapshot triggers of the incoming and outgoing tables
+    with the current ones.
+    """
+    for table in ('incoming', 'outgoing'):
+        for action in ('insert', 'delete', 'update'):
+            cursor.execute("DROP TRIGGER IF EXISTS %s_snapshot_%s" % (table, action))
+        for trigger in SNAPSHOT_TRIGGERS:
+            cursor.execute(trigger.format(table=table))
+
+
+def period_ends(first, today, period=MONTHLY):
+    """
+    Return the until dates of the periods that ended after the first
+    movement date and before today.
+    """
+    ends = []
+    year, month = first.year, first.month
+    while True:
+        if period == YEARLY:
+            year, month = year + 1, 1
+        elif month == 12:
+            year, month = year + 1, 1
+        else:
+            month += 1
+        until = date(year, month, 1)
+        if until > today:
+            return ends
+        ends.append(until)
+
+
+def nearest_snapshot(cursor, day):
+    """
+    Return the until date of the latest closed period ending on or
+    before the given 'YYYY-MM-DD' day, or None.
+    """
+    row = cursor.execute("SELECT MAX(until) FROM balance_period WHERE until <= ?",
+                         (day,)).fetchone()
+    return row[0]
+
+
+def pending_periods(cursor, period=MONTHLY, today=None):
+    """
+    Return the until dates of the ended periods that are not closed yet.
+    """
+    if period not in PERIODS:
+        raise ValueError('Unknown period: %r' % (period,))
+    if today is None:
+        today = date.today()
+    first = cursor.execute("""
+        SELECT MIN(first) FROM (
+            SELECT MIN(date) AS first FROM incoming
+            UNION ALL
+            SELECT MIN(date) FROM outgoing)
+        """).fetchone()[0]
+    if first is None:
+        return []
+    try:
+        first = date(int(first[:4]), int(first[5:7]), 1)
+    except ValueError:
+        return []
+    closed = set(row[0] for row in cursor.execute("SELECT until FROM balance_period"))
+    return [str(until) for until in period_ends(first, today, period)
+            if str(until) not in closed]
+
+
+def close_period(cursor, until):
+    """
+    Write the closing balances of the period ending before until from
+    the previous snapshot, or from the first transaction.
+    """
+    if cursor.execute("SELECT 1 FROM balance_period WHERE until = ?",
+                      (until,)).fetchone() is not None:
+        return
+    previous = nearest_snapshot(cursor, until)
+    if previous is None:
+        cursor.execute(CLOSE_FROM_START, {'until': until})
+    else:
+        cursor.execute(CLOSE_FROM_SNAPSHOT, {'until': until, 'previous': previous})
+    cursor.execute("INSERT INTO balance_period VALUES(?, datetime('now'))", (until,))
+
+
+def close_periods(database, period=MONTHLY, today=None):
+    """
+    Close the ended periods in order, each one in its own transaction so
+    the terminals are never locked out for long. Return the number of
+    periods closed.
+    """
+    periods = pending_periods(database.cursor(), period, today)
+    for until in periods:
+        database.write(close_period, until)
+    return len(periods)
+
+
+def clear_snapshots(cursor):
+    cursor.execute("DELETE FROM balance_snapshot")
+    cursor.execute("DELETE FROM balance_period")
+
+
+def main():
+    """
+    Close the ended periods of a database from the command line:
+    python3 -m application.snapshot [monthly|yearly] [inv_database.db]
+    """
+    period = MONTHLY
+    filename = None
+    for arg in sys.argv[1:]:
+        if arg in PERIODS:
+            period = arg
+        else:
+            filename = arg
+    # The schema module imports this one.
+    from application.schema import migrate
+    database = Database(filename)
+    try:
+        migrate(database.connect())
+        count = close_periods(database, period)
+    except sqlite3.Error as error:
+        print('Closing the periods failed:', error)
+        return 1
+    finally:
+        database.close()
+    print('%d period(s) closed.' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+#
+# store.py - Inventory service layer of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+from collections import OrderedDict
+from collections import namedtuple
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from application.database import get_database
+from application.schema import migrate
+from application.snapshot import clear_snapshots
+from application.snapshot import close_periods
+
+# The balance reports, the valuation, the archives, the search and the
+# type-ahead index are imported by the methods using them, the main
+# window starts without them.
+
+# Records returned by the store, the fields follow the column order of
+# the tables so they can still be used as plain tuples.
+Item = namedtuple('Item', 'rowid itemcode description unit')
+Transaction = namedtuple('Transaction',
+                         'rowid itemcode description unit quantity rate date remarks')
+Balance = namedtuple('Balance',
+                     'rowid itemcode description unit incoming outgoing balance')
+PeriodBalance = namedtuple('PeriodBalance',
+                           'rowid itemcode description unit opening incoming outgoing closing')
+Valuation = namedtuple('Valuation',
+                       'rowid itemcode description unit quantity average_cost average_value fifo_value')
+Company = namedtuple('Company', 'name address telephone fax email')
+
+INCOMING = 'incoming'
+OUTGOING = 'outgoing'
+TRANSACTION_TABLES = (INCOMING, OUTGOING)
+
+# Number of item codes kept by the item lookup cache.
+ITEM_CACHE_SIZE = 2000
+
+
+def datestring(value):
+    """
+    Return the text stored in the date column of the transactions for
+    a date, a datetime or a 'YYYY-MM-DD' string.
+    """
+    if isinstance(value, datetime):
+        return str(value)
+    if isinstance(value, date):
+        return str(datetime(value.year, value.month, value.day))
+    return str(datetime.strptime(value, '%Y-%m-%d'))
+
+
+def checktable(table):
+    if table not in TRANSACTION_TABLES:
+        raise ValueError('Unknown transaction table: %r' % (table,))
+    return table
+
+
+class InventoryStore:
+    """
+    All the reads and writes of the inventory database, without any user
+    interface. The tkinter windows, the scripts and the benchmarks use
+    the same methods so every hot path can be run and measured headless.
+    """
+
+    def __init__(self, database=None):
+        if database is None:
+            database = get_database()
+        self.database = database
+        # Whether the full text index exists, checked on first search.
+        self.fulltext = None
+        # Type-ahead index of the item master, built on first use.
+        self.prefix_index = None
+        # Least recently used items found by item code, item code -> Item.
+        self.item_cache = OrderedDict()
+
+    def cursor(self, record=None):
+        """
+        Return a cursor of the shared connection, returning the rows as
+        the given record type.
+        """
+        cur = self.database.cursor()
+        if record is not None:
+            cur.row_factory = lambda cursor, row: record._make(row)
+        return cur
+
+    # Database.
+
+    def create(self, company):
+        """
+        Create the tables of a new database and save the company details.
+        """
+        migrate(self.database.connect())
+        self.database.write(lambda cur: cur.execute(
+            "INSERT INTO company VALUES(?, ?, ?, ?, ?)", tuple(company)))
+
+    def rebuild_balances(self):
+        from application.balance import create_balance_table
+        from application.balance import rebuild_balances
+        from application.valuation import reset_valuation
+
+        def rebuild(cur):
+            create_balance_table(cur)
+            rebuild_balances(cur)
+            clear_snapshots(cur)
+            reset_valuation(cur)
+        self.database.write(rebuild)
+
+    # Company details.
+
+    def company(self):
+        return self.cursor(Company).execute("SELECT * FROM company").fetchone()
+
+    def set_company(self, company):
+        """
+        Replace the company details, the old ones are only deleted in
+        the transaction saving the new ones.
+        """
+        def replace(cur):
+            cur.execute("DELETE FROM company")
+            cur.execute("INSERT INTO company VALUES(?, ?, ?, ?, ?)", tuple(company))
+        self.database.write(replace)
+
+    # Item master.
+
+    def items(self):
+        """
+        Return an iterator over the items ordered by rowid.
+        """
+        return self.cursor(Item).execute("SELECT * FROM item ORDER BY rowid")
+
+    def list_items(self, after=0, limit=200):
+        """
+        Return a page of at most limit items following the item with the
+        rowid after, ordered by rowid.
+        """
+        return self.cursor(Item).execute(
+            "SELECT * FROM item WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (after, limit)).fetchall()
+
+    def find_item(self, itemcode):
+        """
+        Return the item with the given item code or None. The items
+        found are cached until the item master changes, an unknown code
+        is looked up again every time since another terminal may add it.
+        """
+        try:
+            item = self.item_cache[itemcode]
+        except KeyError:
+            item = self.cursor(Item).execute(
+                "SELECT * FROM item WHERE itemcode = ?", (itemcode,)).fetchone()
+            if item is not None:
+                self.item_cache[itemcode] = item
+                if len(self.item_cache) > ITEM_CACHE_SIZE:
+                    self.item_cache.popitem(last=False)
+        else:
+            self.item_cache.move_to_end(itemcode)
+        return item
+
+    def first_itemcodes(self, limit):
+        """
+        Return the first item codes in sorted order.
+        """
+        return [row[0] for row in self.database.cursor().execute(
+            "SELECT itemcode FROM item ORDER BY itemcode LIMIT ?", (limit,))]
+
+    def item_index(self):
+        """
+        Return the type-ahead index of the item master, it is built
+        once and kept until the items change.
+        """
+        from application.typeahead import PrefixIndex
+        if self.prefix_index is None:
+            self.prefix_index = PrefixIndex(self.database.cursor().execute(
+                "SELECT itemcode, description FROM item"))
+        return self.prefix_index
+
+    def forget_items(self):
+        """
+        Drop what is kept in memory about the item master, to be called
+        when the items have been changed by another connection.
+        """
+        self.prefix_index = None
+        self.item_cache.clear()
+
+    def search_items(self, text, limit=100):
+        """
+        Return the items best matching the words of the text, a word
+        matches the start of any word of the item code or description.
+        """
+        from application.search import search_available
+        from application.search import search_items
+        if self.fulltext is None:
+            self.fulltext = search_available(self.database.cursor())
+        return list(search_items(self.cursor(Item), text, limit, self.fulltext))
+
+    def add_item(self, itemcode, description, unit):
+        """
+        Add an item to the item master and return its rowid.
+        """
+        rowid = self.database.write(lambda cur: cur.execute(
+            "INSERT INTO item VALUES(null, ?, ?, ?)",
+            (itemcode, description, unit)).lastrowid)
+        self.forget_items()
+        return rowid
+
+    def delete_item(self, rowid):
+        """
+        Delete an item and return the number of items deleted.
+        """
+        deleted = self.database.write(lambda cur: cur.execute(
+            "DELETE FROM item WHERE rowid = ?", (rowid,)).rowcount)
+        self.forget_items()
+        return deleted
+
+    # Transactions.
+
+    def record(self, table, itemcode, description, unit, quantity, rate,
+               tdate, remarks=''):
+        """
+        Save a transaction into the incoming or outgoing table as it is
+        given and return it with its new rowid.
+        """
+        checktable(table)
+        values = (itemcode, description, unit, float(quantity), float(rate),
+                  datestring(tdate), remarks)
+        rowid = self.database.write(lambda cur: cur.execute(
+            "INSERT INTO " + table + " VALUES(null, ?, ?, ?, ?, ?, ?, ?)",
+            values).lastrowid)
+        return Transaction(rowid, *values)
+
+    def record_incoming(self, itemcode, description, unit, quantity, rate,
+                        tdate, remarks=''):
+        return self.record(INCOMING, itemcode, description, unit,
+                           quantity, rate, tdate, remarks)
+
+    def record_outgoing(self, itemcode, description, unit, quantity, rate,
+                        tdate, remarks=''):
+        """
+        Save an outgoing transaction, the quantity is given as a positive
+        number and stored as a negative one.
+        """
+        return self.record(OUTGOING, itemcode, description, unit,
+                           -float(quantity), rate, tdate, remarks)
+
+    def check_batch(self, lines):
+        """
+        Check a batch of (itemcode, description, unit, quantity, rate,
+        date, remarks) lines before posting it and return a list of
+        (index, message) for the lines that can't be saved.
+        """
+        errors = []
+        for index, line in enumerate(lines):
+            itemcode, description, unit, quantity, rate, tdate, remarks = line
+            try:
+                datestring(tdate)
+            except ValueError:
+                errors.append((index, 'The date is not YYYY-MM-DD.'))
+                continue
+            try:
+                quantity = float(quantity)
+                rate = float(rate)
+            except (TypeError, ValueError):
+                errors.append((index, 'The rate and quantity must be numbers.'))
+                continue
+            if not quantity > 0:
+                errors.append((index, 'The quantity must be more than 0.'))
+            elif not rate >= 0:
+                errors.append((index, 'The rate cannot be negative.'))
+            elif self.find_item(itemcode) is None:
+                errors.append((index, 'Unknown item code %s.' % itemcode))
+        return errors
+
+    def post_batch(self, table, lines, synchronous=None):
+        """
+        Save a batch of (itemcode, description, unit, quantity, rate,
+        date, remarks) lines in one transaction and return them as
+        transactions with their new rowid. The quantities are positive,
+        the outgoing ones are stored as negative numbers. synchronous
+        overrides the durability of the transaction.
+        """
+        checktable(table)
+        sign = -1.0 if table == OUTGOING else 1.0
+        values = [(itemcode, description, unit, sign * float(quantity), float(rate),
+                   datestring(tdate), remarks)
+                  for itemcode, description, unit, quantity, rate, tdate, remarks in lines]
+
+        def post(cur):
+            last = cur.execute("SELECT IFNULL(MAX(rowid), 0) FROM " + table).fetchone()[0]
+            cur.executemany("INSERT INTO " + table + " VALUES(null, ?, ?, ?, ?, ?, ?, ?)",
+                            values)
+            # No other terminal writes during the transaction, the new
+            # rows are the ones after the last rowid.
+            return [row[0] for row in cur.execute(
+                "SELECT rowid FROM " + table + " WHERE rowid > ? ORDER BY rowid", (last,))]
+
+        with self.database.synchronous(synchronous):
+            rowids = self.database.write(post)
+        return [Transaction(rowid, *line) for rowid, line in zip(rowids, values)]
+
+    def count_transactions(self, table):
+        return self.database.cursor().execute(
+            "SELECT COUNT(*) FROM " + checktable(table)).fetchone()[0]
+
+    def list_transactions(self, table, offset=0, limit=200, after=None):
+        """
+        Return a page of transactions ordered by rowid. When the rowid of
+        the last row of the previous page is given as after, the page is
+        read from there instead of skipping offset rows.
+        """
+        checktable(table)
+        cur = self.cursor(Transaction)
+        if after is None:
+            cur.execute("SELECT * FROM " + table +
+                        " ORDER BY rowid LIMIT ? OFFSET ?", (limit, offset))
+        else:
+            cur.execute("SELECT * FROM " + table +
+                        " WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, limit))
+        return cur.fetchall()
+
+    def transactions(self, table, start=None, end=None):
+        """
+        Return an iterator over the transactions ordered by rowid, only
+        the ones dated between the start and end dates, both included,
+        when they are given.
+        """
+        checktable(table)
+        where = []
+        parameters = {}
+        if start is not None:
+            where.append("date >= :start")
+            parameters['start'] = datestring(start)
+        if end is not None:
+            where.append("date < :end")
+            parameters['end'] = datestring(end + timedelta(days=1))
+        query = "SELECT * FROM " + table
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        return self.cursor(Transaction).execute(query + " ORDER BY rowid", parameters)
+
+    # Reports.
+
+    def balances(self):
+        """
+        Return an iterator over the stock balance of every item.
+        """
+        from application.balance import stock_balances
+        return stock_balances(self.cursor(Balance))
+
+    def list_balances(self, after=0, limit=200):
+        """
+        Return the stock balance of at most limit items following the
+        item with the rowid after, ordered by rowid.
+        """
+        from application.balance import balance_page
+        return balance_page(self.cursor(Balance), after, limit).fetchall()
+
+    def item_balance(self, itemcode):
+        """
+        Return the stock balance of an item or None. Unlike find_item
+        it is read from the database every time.
+        """
+        from application.balance import item_balance
+        return item_balance(self.cursor(Balance), itemcode)
+
+    def period_balances(self, start, end):
+        """
+        Return an iterator over the opening balance, the movements and
+        the closing balance of every item between two dates, both
+        included. A start of None reports from the first transaction.
+        """
+        from application.balance import period_balances
+        return period_balances(self.cursor(PeriodBalance), start, end)
+
+    def balances_as_of(self, day):
+        """
+        Return an iterator over the balance of every item at the end of
+        the given day, in the closing field. The incoming and outgoing
+        fields only hold the movements of that day.
+        """
+        from application.balance import balances_as_of
+        return balances_as_of(self.cursor(PeriodBalance), day)
+
+    def close_periods(self, period):
+        """
+        Save the closing balances of the periods that have ended since
+        the last time and return how many periods have been closed.
+        """
+        return close_periods(self.database, period)
+
+    def update_valuation(self):
+        """
+        Apply the transactions recorded since the last valuation to the
+        saved cost of the items and return how many items have changed.
+        """
+        from application.valuation import update_valuation
+        return self.database.write(update_valuation)
+
+    def valuation(self):
+        """
+        Return an iterator over the quantity and the weighted average
+        and FIFO value of every item, as of the last valuation.
+        """
+        from application.valuation import stock_valuation
+        return stock_valuation(self.cursor(Valuation))
+
+    def archive(self, cutoff):
+        """
+        Move the transactions dated before the cutoff date into the
+        yearly archives and return the number of rows archived.
+        """
+        from application.archive import archive_transactions
+        return archive_transactions(self.database, cutoff)
+
+    def export_balances(self, filename, title, progress=None):
+        """
+        Write the stock balance report into a csv file, streaming the rows
+        from the database. Return the number of items written.
+        """
+        # The export module is only loaded once a report is exported.
+        from application.export import write_balances
+        return write_balances(self.database.cursor(), filename, title, progress)
+
+    def export_valuation(self, filename, title, progress=None):
+        """
+        Bring the valuation up to date and write it into a csv file.
+        """
+        from application.export import write_valuation
+        self.update_valuation()
+        return write_valuation(self.database.cursor(), filename, title, progress)
+
+
+_store = None
+
+
+def get_store():
+    """
+    Return the store of the shared database.
+    """
+    global _store
+    if _store is None:
+        _store = InventoryStore()
+    return _store
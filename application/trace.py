@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# trace.py - Query tracing of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from application.settings import get_settings
+
+# Statements shown in the slow query log are shortened to this length.
+SQL_LENGTH = 2000
+# The frames of this file are the windows of the application.
+PACKAGE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+WINDOWS_FILE = os.path.join(PACKAGE_FOLDER, 'application.py')
+
+
+def calling_window():
+    """
+    Return the window method that runs the current statement, like
+    'Reports.insertDetails', or else the first function outside of the
+    application package, like a command line tool.
+    """
+    frame = sys._getframe(2)
+    first = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == WINDOWS_FILE:
+            return qualified_name(code)
+        if first is None and not code.co_filename.startswith(PACKAGE_FOLDER):
+            first = qualified_name(code)
+        frame = frame.f_back
+    return first or ''
+
+
+def qualified_name(code):
+    # co_qualname is new in Python 3.11.
+    name = getattr(code, 'co_qualname', code.co_name)
+    return name.split('.<locals>')[0]
+
+
+def oneline(sql):
+    return ' '.join(sql.split())
+
+
+class StatementStats:
+    """
+    The totals of one statement run by one window.
+    """
+
+    __slots__ = ('sql', 'window', 'calls', 'total', 'longest', 'rows', 'parameters')
+
+    def __init__(self, sql, window):
+        self.sql = sql
+        self.window = window
+        self.calls = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.rows = 0
+        self.parameters = ()
+
+
+class RenderStats:
+    """
+    The time spent filling the treeviews of one window.
+    """
+
+    __slots__ = ('window', 'calls', 'total', 'longest', 'rows')
+
+    def __init__(self, window):
+        self.window = window
+        self.calls = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.rows = 0
+
+
+class Tracer:
+    """
+    Collect the time, the rows and the calling window of the statements
+    and of the treeview updates. The statements slower than the slow
+    setting are written to a rotating log file.
+    """
+
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = get_settings()
+        self.settings = settings['trace']
+        self.enabled = self.settings.getboolean('enabled')
+        self.slow = self.settings.getfloat('slow_ms') / 1000
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.renders = {}
+        self.logger = None
+
+    def slow_log(self):
+        if self.logger is None:
+            # Only needed once a statement is slow, keep it out of the
+            # start of the application.
+            import logging
+            import logging.handlers
+            self.logger = logging.getLogger('tarsierstock.slow')
+            self.logger.propagate = False
+            handler = logging.handlers.RotatingFileHandler(
+                self.settings.get('logfile'),
+                maxBytes=self.settings.getint('max_bytes'),
+                backupCount=self.settings.getint('backups'),
+                encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+        return self.logger
+
+    def record(self, sql, parameters, window, seconds, rows):
+        with self.lock:
+            stats = self.statements.get((sql, window))
+            if stats is None:
+                stats = self.statements[(sql, window)] = StatementStats(sql, window)
+            stats.calls += 1
+            stats.total += seconds
+            stats.rows += rows
+            if seconds >= stats.longest:
+                stats.longest = seconds
+                stats.parameters = parameters
+        if seconds >= self.slow:
+            self.slow_log().info('%.1f ms %d row(s) %s: %s', seconds * 1000, rows,
+                                 window or '-', oneline(sql)[:SQL_LENGTH])
+
+    def record_render(self, window, seconds, rows):
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.renders.get(window)
+            if stats is None:
+                stats = self.renders[window] = RenderStats(window)
+            stats.calls += 1
+            stats.total += seconds
+            stats.rows += rows
+            stats.longest = max(stats.longest, seconds)
+
+    def top_statements(self, limit=50):
+        """
+        Return the statements taking the most time in total.
+        """
+        with self.lock:
+            statements = list(self.statements.values())
+        return sorted(statements, key=lambda stats: stats.total, reverse=True)[:limit]
+
+    def top_renders(self):
+        with self.lock:
+            renders = list(self.renders.values())
+        return sorted(renders, key=lambda stats: stats.total, reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.renders.clear()
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statements. The time spent in execute and in
+    reading the rows is added up until the next statement, the cursor
+    is closed or its rows are exhausted.
+    """
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        self.trace_start(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self.trace_elapsed += time.perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        self.trace_start(sql, ())
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            self.trace_elapsed += time.perf_counter() - start
+            self.finish()
+
+    def trace_start(self, sql, parameters):
+        self.trace_sql = sql
+        self.trace_parameters = parameters
+        self.trace_window = calling_window()
+        self.trace_elapsed = 0.0
+        self.trace_rows = 0
+
+    def finish(self):
+        """
+        Record the current statement.
+        """
+        sql = getattr(self, 'trace_sql', None)
+        if sql is None:
+            return
+        self.trace_sql = None
+        rows = self.trace_rows
+        if rows == 0 and self.rowcount > 0:
+            rows = self.rowcount
+        get_tracer().record(sql, self.trace_parameters, self.trace_window,
+                            self.trace_elapsed, rows)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = sqlite3.Cursor.fetchone(self)
+        self.trace_read(start, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        if size is None:
+            size = self.arraysize
+        rows = sqlite3.Cursor.fetchmany(self, size)
+        self.trace_read(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchall(self)
+        self.trace_read(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = sqlite3.Cursor.__next__(self)
+        except StopIteration:
+            self.trace_read(start, 0, True)
+            raise
+        self.trace_read(start, 1, False)
+        return row
+
+    def trace_read(self, start, rows, done):
+        if getattr(self, 'trace_sql', None) is None:
+            return
+        self.trace_elapsed += time.perf_counter() - start
+        self.trace_rows += rows
+        if done:
+            self.finish()
+
+    def close(self):
+        self.finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            # The tracer may be gone when the interpreter shuts down.
+            pass
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are timed, the execute shortcuts of the
+    connection use them as well.
+    """
+
+    def cursor(self, factory=TracedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    # The shortcuts of sqlite3.Connection open a plain cursor.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def explain(connection, sql, parameters=()):
+    """
+    Return the lines of the query plan of a statement.
+    """
+    rows = connection.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    depth = {0: 0}
+    lines = []
+    for node, parent, unused, detail in rows:
+        depth[node] = depth.get(parent, 0) + 1
+        lines.append('  ' * (depth[node] - 1) + detail)
+    return lines
+
+
+_tracer = None
+
+
+def get_tracer():
+    """
+    Return the tracer of the application.
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# typeahead.py - Type-ahead item selection of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+from array import array
+from bisect import bisect_left
+
+# Number of matches shown in the listbox and the delay in milliseconds
+# after the last keystroke before the list is filtered.
+MATCH_LIMIT = 100
+DEBOUNCE_DELAY = 150
+
+# Greater than any character of a key, prefix + LAST_CHAR ends the range
+# of the keys starting with prefix.
+LAST_CHAR = '\U0010ffff'
+
+
+class PrefixIndex:
+    """
+    Sorted in-memory index of the item codes and the words of the item
+    descriptions. Each key is kept once in a sorted list with the
+    position of its item in a parallel array, so a prefix is found with
+    two binary searches and the matches are read in order without
+    scanning the whole item master.
+    """
+
+    __slots__ = ('codes', 'texts', 'codekeys', 'codeowners',
+                 'wordkeys', 'wordowners')
+
+    def __init__(self, items):
+        """
+        Build the index from an iterable of (itemcode, description).
+        """
+        self.codes = []
+        self.texts = []
+        keys = []
+        owners = []
+        for position, (itemcode, description) in enumerate(items):
+            itemcode = str(itemcode)
+            words = str(description or '').lower().split()
+            self.codes.append(itemcode)
+            # ' milk' in text when a word of the item starts with 'milk'.
+            self.texts.append(' ' + ' '.join([itemcode.lower()] + words))
+            for word in set(words):
+                keys.append(word)
+                owners.append(position)
+        codekeys = [code.lower() for code in self.codes]
+        order = sorted(range(len(codekeys)), key=codekeys.__getitem__)
+        self.codekeys = [codekeys[number] for number in order]
+        self.codeowners = array('i', order)
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.wordkeys = [keys[number] for number in order]
+        self.wordowners = array('i', [owners[number] for number in order])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def first(self, limit=MATCH_LIMIT):
+        """
+        Return the first item codes in sorted order.
+        """
+        return [self.codes[position] for position in self.codeowners[:limit]]
+
+    def prefixrange(self, keys, prefix):
+        return (bisect_left(keys, prefix), bisect_left(keys, prefix + LAST_CHAR))
+
+    def match(self, text, limit=MATCH_LIMIT):
+        """
+        Return up to limit item codes matching the text. The items whose
+        code starts with the text come first, then the items having every
+        word of the text as the start of a word of their code or
+        description.
+        """
+        words = text.lower().split()
+        if not words:
+            return self.first(limit)
+        found = []
+        seen = set()
+
+        # The item codes starting with the whole text.
+        start, end = self.prefixrange(self.codekeys, text.strip().lower())
+        for position in self.codeowners[start:min(end, start + limit)]:
+            found.append(self.codes[position])
+            seen.add(position)
+        if len(found) >= limit:
+            return found
+
+        # Walk the matches of the word having the fewest of them and
+        # check the other words on the text of each item.
+        best = None
+        for word in words:
+            coderange = self.prefixrange(self.codekeys, word)
+            wordrange = self.prefixrange(self.wordkeys, word)
+            size = coderange[1] - coderange[0] + wordrange[1] - wordrange[0]
+            if best is None or size < best[0]:
+                best = (size, coderange, wordrange)
+        for owners, (start, end) in ((self.codeowners, best[1]),
+                                     (self.wordowners, best[2])):
+            for index in range(start, end):
+                position = owners[index]
+                if position in seen:
+                    continue
+                if self.contains(position, words):
+                    found.append(self.codes[position])
+                    seen.add(position)
+                    if len(found) >= limit:
+                        return found
+        return found
+
+    def contains(self, position, words):
+        text = self.texts[position]
+        for word in words:
+            if ' ' + word not in text:
+                return False
+        return True
+
+
+class TypeAhead:
+    """
+    Filter a listbox of item codes as the user types in an entry. The
+    list is filtered once the user stops typing for DEBOUNCE_DELAY
+    milliseconds and never shows more than limit item codes.
+    """
+
+    def __init__(self, entry, listbox, index, delay=DEBOUNCE_DELAY,
+                 limit=MATCH_LIMIT):
+        self.entry = entry
+        self.listbox = listbox
+        self.index = index
+        self.delay = delay
+        self.limit = limit
+        self.job = None
+        self.text = None
+        self.entry.bind('<KeyRelease>', self.keyrelease, add='+')
+        self.entry.bind('<Destroy>', lambda event: self.cancel(), add='+')
+
+    def keyrelease(self, event):
+        if event.keysym in ('Return', 'KP_Enter'):
+            # Return is left to the search of the window.
+            return
+        self.cancel()
+        self.job = self.entry.after(self.delay, self.filter)
+
+    def cancel(self):
+        if self.job is not None:
+            self.entry.after_cancel(self.job)
+            self.job = None
+
+    def filter(self, force=False):
+        """
+        Show the item codes matching the text of the entry.
+        """
+        self.job = None
+        text = self.entry.get()
+        if text == self.text and not force:
+            return
+        self.text = text
+        self.show(self.index().match(text, self.limit))
+
+    def show(self, codes):
+        self.listbox.delete('0', 'end')
+        if codes:
+            self.listbox.insert('end', *codes)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+#
+# valuation.py - Inventory valuation of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import json
+import sys
+import sqlite3
+
+from application.database import Database
+
+# The cost of the stock of each item after its movements up to
+# last_date, by weighted average and by FIFO. The FIFO layers are a json
+# list of [quantity, rate] from the oldest. valuation_mark holds the
+# last rowid of each transaction table that has been valued, so the
+# next valuation only reads the newer rows.
+VALUATION_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS valuation_state(itemcode TEXT PRIMARY KEY,
+        last_date TEXT,
+        quantity REAL NOT NULL,
+        average_value REAL NOT NULL,
+        last_cost REAL NOT NULL,
+        fifo_value REAL NOT NULL,
+        fifo_layers TEXT NOT NULL)
+    """, """
+    CREATE TABLE IF NOT EXISTS valuation_mark(tablename TEXT PRIMARY KEY,
+        last_rowid INTEGER NOT NULL)
+    """, """
+    CREATE TABLE IF NOT EXISTS valuation_dirty(itemcode TEXT PRIMARY KEY)
+    """)
+
+# A movement dated on or before the last valued date of its item, a
+# change to a movement that has been valued, or a new movement reusing
+# the rowid of a deleted one means the item has to be valued again from
+# its first movement.
+VALUATION_TRIGGERS = ("""
+    CREATE TRIGGER IF NOT EXISTS {table}_valuation_insert
+    AFTER INSERT ON {table}
+    WHEN NEW.date IS NULL OR NEW.date <= (SELECT last_date FROM valuation_state
+                                         WHERE itemcode = NEW.itemcode)
+        OR NEW.rowid <= (SELECT last_rowid FROM valuation_mark
+                         WHERE tablename = '{table}')
+    BEGIN
+        INSERT OR IGNORE INTO valuation_dirty VALUES(NEW.itemcode);
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_valuation_delete
+    AFTER DELETE ON {table}
+    WHEN OLD.rowid <= (SELECT last_rowid FROM valuation_mark
+                       WHERE tablename = '{table}')
+    BEGIN
+        INSERT OR IGNORE INTO valuation_dirty VALUES(OLD.itemcode);
+    END
+    """, """
+    CREATE TRIGGER IF NOT EXISTS {table}_valuation_update
+    AFTER UPDATE OF itemcode, quantity, rate, date ON {table}
+    WHEN OLD.rowid <= (SELECT last_rowid FROM valuation_mark
+                       WHERE tablename = '{table}')
+    BEGIN
+        INSERT OR IGNORE INTO valuation_dirty VALUES(OLD.itemcode);
+        INSERT OR IGNORE INTO valuation_dirty VALUES(NEW.itemcode);
+    END
+    """)
+
+# The movements of the items as one stream ordered by item and date, on
+# the same date the incoming ones first.
+MOVEMENTS = """
+    SELECT itemcode, date, 0 AS kind, rowid, quantity, rate FROM incoming
+    WHERE {where}
+    UNION ALL
+    SELECT itemcode, date, 1, rowid, quantity, rate FROM outgoing
+    WHERE {where}
+    ORDER BY 1, 2, 3, 4
+    """
+ITEM_MOVEMENTS = MOVEMENTS.format(where="itemcode = :itemcode")
+NEW_MOVEMENTS = """
+    SELECT itemcode, date, 0 AS kind, rowid, quantity, rate FROM incoming
+    WHERE rowid > :incoming
+    UNION ALL
+    SELECT itemcode, date, 1, rowid, quantity, rate FROM outgoing
+    WHERE rowid > :outgoing
+    ORDER BY 1, 2, 3, 4
+    """
+
+VALUATION_QUERY = """
+    SELECT item.rowid,
+           item.itemcode,
+           item.description,
+           item.unit,
+           IFNULL(valuation_state.quantity, 0),
+           CASE WHEN valuation_state.quantity != 0
+                THEN valuation_state.average_value / valuation_state.quantity
+                ELSE IFNULL(valuation_state.last_cost, 0) END,
+           IFNULL(valuation_state.average_value, 0),
+           IFNULL(valuation_state.fifo_value, 0)
+    FROM item
+    LEFT JOIN valuation_state ON valuation_state.itemcode = item.itemcode
+    ORDER BY item.rowid
+    """
+
+
+class ItemCost:
+    """
+    The running cost of the stock of one item. Incoming movements add
+    their quantity at their rate, outgoing ones take stock out at the
+    weighted average cost and from the oldest FIFO layers. Stock going
+    below zero is valued at the last cost, as a negative layer that the
+    next incoming movements cover first.
+    """
+
+    __slots__ = ('last_date', 'quantity', 'average_value', 'last_cost', 'layers')
+
+    def __init__(self, last_date=None, quantity=0.0, average_value=0.0,
+                 last_cost=0.0, layers=None):
+        self.last_date = last_date
+        self.quantity = quantity
+        self.average_value = average_value
+        self.last_cost = last_cost
+        if layers is None:
+            layers = []
+        self.layers = layers
+
+    def average_cost(self):
+        if self.quantity != 0:
+            return self.average_value / self.quantity
+        return self.last_cost
+
+    def fifo_value(self):
+        return sum(quantity * rate for quantity, rate in self.layers)
+
+    def receive(self, quantity, rate):
+        if self.quantity > 0:
+            self.average_value += quantity * rate
+            self.quantity += quantity
+        else:
+            # Start again from the new rate once the stock is back.
+            self.quantity += quantity
+            self.average_value = self.quantity * rate
+        self.last_cost = rate
+        while quantity > 0 and self.layers and self.layers[0][0] < 0:
+            covered = min(quantity, -self.layers[0][0])
+            self.layers[0][0] += covered
+            quantity -= covered
+            if self.layers[0][0] == 0:
+                self.layers.pop(0)
+        if quantity > 0:
+            self.layers.append([quantity, rate])
+
+    def issue(self, quantity):
+        cost = self.average_cost()
+        self.quantity -= quantity
+        self.average_value = self.quantity * cost
+        while quantity > 0 and self.layers and self.layers[0][0] > 0:
+            taken = min(quantity, self.layers[0][0])
+            self.layers[0][0] -= taken
+            quantity -= taken
+            if self.layers[0][0] == 0:
+                self.layers.pop(0)
+        if quantity > 0:
+            if self.layers:
+                self.layers[0][0] -= quantity
+            else:
+                self.layers.append([-quantity, self.last_cost])
+
+    def move(self, tdate, kind, quantity, rate):
+        """
+        Apply one movement, kind is 0 for incoming and 1 for outgoing.
+        """
+        quantity = quantity or 0.0
+        if kind == 1:
+            # Outgoing quantities are stored as negative numbers, a
+            # positive one is a return at the current cost.
+            if quantity <= 0:
+                self.issue(-quantity)
+            else:
+                self.receive(quantity, self.average_cost())
+        elif quantity >= 0:
+            self.receive(quantity, rate or 0.0)
+        else:
+            # Without stock to take the cost from, like the carried
+            # forward row of an archived stock below zero, a negative
+            # incoming quantity is taken out at its own rate.
+            if self.quantity == 0 and rate:
+                self.last_cost = rate
+            self.issue(-quantity)
+        if tdate is not None:
+            self.last_date = tdate
+
+    def row(self, itemcode):
+        return (itemcode, self.last_date, self.quantity, self.average_value,
+                self.last_cost, self.fifo_value(), json.dumps(self.layers))
+
+
+def create_valuation_tables(cursor):
+    """
+    Create the valuation tables and the triggers on the incoming and
+    outgoing tables that mark the items to value again.
+    """
+    for table in VALUATION_TABLES:
+        cursor.execute(table)
+    for trigger in VALUATION_TRIGGERS:
+        cursor.execute(trigger.format(table='incoming'))
+        cursor.execute(trigger.format(table='outgoing'))
+
+
+def load_cost(cursor, itemcode):
+    row = cursor.execute("""
+        SELECT last_date, quantity, average_value, last_cost, fifo_layers
+        FROM valuation_state WHERE itemcode = ?
+        """, (itemcode,)).fetchone()
+    if row is None:
+        return ItemCost()
+    return ItemCost(row[0], row[1], row[2], row[3], json.loads(row[4]))
+
+
+def value_stream(rows, costs, skip=()):
+    """
+    Apply the ordered movements to the costs of their items and return
+    the costs that have changed.
+    """
+    changed = {}
+    for itemcode, tdate, kind, rowid, quantity, rate in rows:
+        if itemcode in skip:
+            continue
+        cost = changed.get(itemcode)
+        if cost is None:
+            cost = costs(itemcode)
+            changed[itemcode] = cost
+        cost.move(tdate, kind, quantity, rate)
+    return changed
+
+
+def update_valuation(cursor):
+    """
+    Bring the valuation up to date. The marked items are valued again
+    from their first movement, the others only apply the movements added
+    since the last valuation. Return the number of items valued.
+    """
+    dirty = set(row[0] for row in cursor.execute("SELECT itemcode FROM valuation_dirty"))
+    changed = {}
+    for itemcode in dirty:
+        rows = cursor.execute(ITEM_MOVEMENTS, {'itemcode': itemcode}).fetchall()
+        changed.update(value_stream(rows, lambda code: ItemCost()))
+        cursor.execute("DELETE FROM valuation_state WHERE itemcode = ?", (itemcode,))
+
+    # The new rows of the other items are all dated after their last
+    # valued date, else the trigger would have marked the item.
+    marks = {}
+    for table in ('incoming', 'outgoing'):
+        row = cursor.execute("SELECT last_rowid FROM valuation_mark WHERE tablename = ?",
+                             (table,)).fetchone()
+        marks[table] = 0 if row is None else row[0]
+    states = cursor.connection.cursor()
+    rows = cursor.execute(NEW_MOVEMENTS, marks)
+    changed.update(value_stream(rows, lambda code: load_cost(states, code), skip=dirty))
+    states.close()
+
+    cursor.executemany("INSERT OR REPLACE INTO valuation_state VALUES(?, ?, ?, ?, ?, ?, ?)",
+                       [cost.row(itemcode) for itemcode, cost in changed.items()])
+    for table in ('incoming', 'outgoing'):
+        cursor.execute("""
+            INSERT OR REPLACE INTO valuation_mark
+            SELECT ?, IFNULL(MAX(rowid), 0) FROM """ + table, (table,))
+    cursor.execute("DELETE FROM valuation_dirty")
+    return len(changed)
+
+
+def reset_valuation(cursor):
+    cursor.execute("DELETE FROM valuation_state")
+    cursor.execute("DELETE FROM valuation_mark")
+    cursor.execute("DELETE FROM valuation_dirty")
+
+
+def stock_valuation(cursor):
+    """
+    Execute the valuation query on the given cursor and return it. Each
+    row is (rowid, itemcode, description, unit, quantity, average cost,
+    average value, fifo value).
+    """
+    return cursor.execute(VALUATION_QUERY)
+
+
+def main():
+    """
+    Value the stock of a database from the command line:
+    python3 -m application.valuation [inv_database.db]
+    """
+    # The schema module imports this one.
+    from application.schema import migrate
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = None
+    database = Database(filename)
+    try:
+        migrate(database.connect())
+        count = database.write(update_valuation)
+    except sqlite3.Error as error:
+        print('Valuing the stock failed:', error)
+        return 1
+    finally:
+        database.close()
+    print('%d item(s) valued.' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
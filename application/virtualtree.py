@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# virtualtree.py - Virtual list mode for the tkinter treeview.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import time
+from collections import OrderedDict
+from tkinter import ttk
+
+from application.trace import get_tracer
+
+
+class VirtualTree:
+    """
+    Show a table of any size in a ttk.Treeview while only keeping the
+    rows in the viewport inside the widget. The rows are read from the
+    database one page at a time as the user scrolls, and only the last
+    few pages are kept in memory.
+
+    The window provides three callables:
+        count() returns the number of rows of the table.
+        fetch(offset, limit, after) returns a list of rows, after is the
+            last row of the previous page when it is known so the query
+            can continue from its key instead of skipping offset rows.
+        render(row) returns (iid, text, values) for the treeview.
+    """
+
+    def __init__(self, tree, scrollbar, count, fetch, render,
+                 page_size=200, max_pages=5):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.count = count
+        self.fetch = fetch
+        self.render = render
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.total = 0
+        self.offset = 0
+        self.visible = int(self.tree.cget('height'))
+
+        # The treeview never scrolls by itself, the scrollbar represents
+        # the position of the viewport inside the whole table.
+        self.tree.config(yscrollcommand='')
+        self.scrollbar.config(command=self.yview)
+        self.tree.bind('<Configure>', self.resize)
+        self.tree.bind('<MouseWheel>', self.wheel)
+        self.tree.bind('<Button-4>', self.wheel)
+        self.tree.bind('<Button-5>', self.wheel)
+        self.tree.bind('<Prior>', lambda event: self.scroll(-1, 'pages'))
+        self.tree.bind('<Next>', lambda event: self.scroll(1, 'pages'))
+
+    def refresh(self):
+        """
+        Forget the loaded pages, count the rows again and redraw.
+        """
+        self.pages.clear()
+        self.total = self.count()
+        self.draw()
+
+    def page(self, number):
+        """
+        Return the rows of the given page, reading it from the database
+        if it is not loaded yet.
+        """
+        if number in self.pages:
+            self.pages.move_to_end(number)
+            return self.pages[number]
+        after = None
+        previous = self.pages.get(number - 1)
+        if previous:
+            after = previous[-1]
+        rows = list(self.fetch(number * self.page_size, self.page_size, after))
+        self.pages[number] = rows
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return rows
+
+    def rows(self, offset, limit):
+        """
+        Return the rows from offset up to limit rows long.
+        """
+        result = []
+        number = offset // self.page_size
+        start = offset % self.page_size
+        while len(result) < limit:
+            rows = self.page(number)
+            result.extend(rows[start:start + limit - len(result)])
+            if len(rows) < self.page_size:
+                break
+            number += 1
+            start = 0
+        return result
+
+    def append(self, row):
+        """
+        Add a row saved at the end of the table without reading the
+        table again. It is only drawn when the end of the table is in
+        the viewport, the first row is then dropped to keep the view
+        the same size so the cost does not depend on the table size.
+        """
+        index = self.total
+        at_end = self.offset + self.visible >= self.total
+        self.total += 1
+        number = index // self.page_size
+        if number in self.pages:
+            self.pages[number].append(row)
+        if at_end:
+            children = self.tree.get_children()
+            if len(children) >= self.visible:
+                self.tree.delete(children[0])
+                self.offset += 1
+            iid, text, values = self.render(row)
+            self.tree.insert('', 'end', iid, text=text,
+                             values=values, tag=self.tag(index))
+            self.tree.see(iid)
+        self.update_scrollbar()
+
+    def tag(self, index):
+        # Keep the striping of the whole table, the first row is odd.
+        if (index + 1) % 2 == 0:
+            return ('evenrow',)
+        return ('oddrow',)
+
+    def draw(self):
+        """
+        Replace the rows of the treeview with the rows of the viewport.
+        """
+        self.offset = max(0, min(self.offset, self.total - self.visible))
+        rows = self.rows(self.offset, self.visible)
+        start = time.perf_counter()
+        selection = self.tree.selection()
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+        index = self.offset
+        for row in rows:
+            iid, text, values = self.render(row)
+            self.tree.insert('', 'end', iid, text=text,
+                             values=values, tag=self.tag(index))
+            index += 1
+        kept = [iid for iid in selection if self.tree.exists(iid)]
+        if kept:
+            self.tree.selection_set(kept)
+        self.update_scrollbar()
+        get_tracer().record_render(type(self.tree.winfo_toplevel()).__name__,
+                                   time.perf_counter() - start, len(rows))
+
+    def update_scrollbar(self):
+        if self.total == 0:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.offset / self.total,
+                               min(1.0, (self.offset + self.visible) / self.total))
+
+    def yview(self, *args):
+        """
+        Command of the scrollbar, moves the viewport the same way as the
+        yview method of the treeview would.
+        """
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * self.total)
+            self.draw()
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]), args[2])
+
+    def scroll(self, number, what='units'):
+        if what == 'pages':
+            number *= max(1, self.visible - 1)
+        self.offset += number
+        self.draw()
+
+    def scroll_to_end(self):
+        self.offset = self.total
+        self.draw()
+
+    def wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll(-3)
+        else:
+            self.scroll(3)
+        return 'break'
+
+    def resize(self, event):
+        """
+        Compute how many rows fit in the treeview when it is resized.
+        """
+        rowheight = ttk.Style().lookup('Treeview', 'rowheight')
+        try:
+            rowheight = int(rowheight)
+        except (TypeError, ValueError):
+            rowheight = 20
+        # Leave room for the heading of the columns.
+        visible = max(1, (event.height - rowheight - 4) // rowheight)
+        if visible != self.visible:
+            self.visible = visible
+            self.draw()
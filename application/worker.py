@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# worker.py - Background database worker of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import queue
+import sqlite3
+import threading
+import time
+
+from application.database import Database
+from application.store import InventoryStore
+
+# Milliseconds between two reads of the results while jobs are pending,
+# and rows inserted into a treeview between two updates of the window.
+POLL_DELAY = 50
+BATCH_SIZE = 500
+
+
+class Job:
+    """
+    A request made to the worker. function(store, *args) runs on the
+    worker thread, then callback(result) or error(message) is called on
+    the tkinter thread unless the job has been cancelled.
+    """
+
+    def __init__(self, function, args, callback=None, error=None):
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.error = error
+        self.cancelled = False
+
+
+class DatabaseWorker(threading.Thread):
+    """
+    Run the slow reads on a thread with its own connection to the
+    database so the windows keep responding. The jobs are queued and run
+    one after the other, their results are read back on the tkinter
+    thread by polling with the after method of the given widget.
+    """
+
+    def __init__(self, filename, widget, traced=False):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.traced = traced
+        self.widget = widget
+        self.requests = queue.Queue()
+        self.responses = queue.Queue()
+        self.lock = threading.Lock()
+        self.current = None
+        self.connection = None
+        self.pending = 0
+        self.poll_job = None
+
+    def run(self):
+        # sqlite3 connections belong to the thread that opens them.
+        database = Database(self.filename, traced=self.traced)
+        store = InventoryStore(database)
+        while True:
+            job = self.requests.get()
+            if job is None:
+                break
+            # Connect on the first job, the database may not have been
+            # created yet when the worker starts.
+            connection = database.connect()
+            with self.lock:
+                self.connection = connection
+                if job.cancelled:
+                    self.responses.put((job, 'cancelled', None))
+                    continue
+                self.current = job
+            try:
+                result = job.function(store, *job.args)
+                self.responses.put((job, 'done', result))
+            except sqlite3.OperationalError as error:
+                if job.cancelled:
+                    self.responses.put((job, 'cancelled', None))
+                else:
+                    self.responses.put((job, 'error', str(error)))
+            except Exception as error:
+                self.responses.put((job, 'error', str(error)))
+            finally:
+                with self.lock:
+                    self.current = None
+                # Don't keep a read transaction open between the jobs.
+                if connection.in_transaction:
+                    connection.rollback()
+        database.close()
+
+    def submit(self, function, *args, callback=None, error=None):
+        """
+        Queue function(store, *args) and return its job, to be called
+        from the tkinter thread.
+        """
+        job = Job(function, args, callback, error)
+        self.pending += 1
+        self.requests.put(job)
+        if self.poll_job is None:
+            self.poll_job = self.widget.after(POLL_DELAY, self.poll)
+        return job
+
+    def cancel(self, job):
+        """
+        Cancel a job, interrupting its query if it is already running.
+        """
+        if job is None:
+            return
+        with self.lock:
+            job.cancelled = True
+            if self.current is job:
+                self.connection.interrupt()
+
+    def poll(self):
+        """
+        Deliver the results of the finished jobs on the tkinter thread.
+        """
+        self.poll_job = None
+        while True:
+            try:
+                job, status, result = self.responses.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if job.cancelled:
+                continue
+            if status == 'done' and job.callback is not None:
+                job.callback(result)
+            elif status == 'error' and job.error is not None:
+                job.error(result)
+        if self.pending > 0:
+            self.poll_job = self.widget.after(POLL_DELAY, self.poll)
+
+    def stop(self):
+        if self.poll_job is not None:
+            self.widget.after_cancel(self.poll_job)
+            self.poll_job = None
+        with self.lock:
+            if self.current is not None:
+                self.current.cancelled = True
+                self.connection.interrupt()
+        self.requests.put(None)
+
+
+class BatchInserter:
+    """
+    Insert a long list of rows into a widget a batch at a time so the
+    window is redrawn and keeps answering between the batches.
+    """
+
+    def __init__(self, widget, rows, insert, done=None, size=BATCH_SIZE):
+        self.widget = widget
+        self.rows = rows
+        self.insert = insert
+        self.done = done
+        self.size = size
+        self.position = 0
+        self.job = None
+
+    def start(self):
+        self.next()
+        return self
+
+    def next(self):
+        from application.trace import get_tracer
+        self.job = None
+        start = time.perf_counter()
+        end = self.position + self.size
+        batch = self.rows[self.position:end]
+        for row in batch:
+            self.insert(row)
+        get_tracer().record_render(type(self.widget.winfo_toplevel()).__name__,
+                                   time.perf_counter() - start, len(batch))
+        self.position = end
+        if self.position < len(self.rows):
+            self.job = self.widget.after(1, self.next)
+        elif self.done is not None:
+            self.done()
+
+    def cancel(self):
+        if self.job is not None:
+            self.widget.after_cancel(self.job)
+            self.job = None
+
+
+_worker = None
+
+
+def start_worker(widget, filename, traced=False):
+    """
+    Start the worker of the application, polling with the given widget.
+    """
+    global _worker
+    if _worker is None:
+        _worker = DatabaseWorker(filename, widget, traced)
+        _worker.start()
+    return _worker
+
+
+def get_worker():
+    return _worker
+
+
+def stop_worker():
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
@@ -19,7 +19,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+import sys
+import time
+
+# Taken before the imports so the startup profile includes them.
+STARTED = time.perf_counter()
+
 from application.application import main
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main(started=STARTED))
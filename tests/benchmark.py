@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# benchmark.py - Benchmarks of the tarsierstock hot paths.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+#
+# Usage:
+#   python3 -m tests.benchmark --scale small --output results.json
+#   python3 -m tests.benchmark --database existing.db
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from application.database import Database
+from application.schema import migrate
+from application.store import InventoryStore
+from application.valuation import reset_valuation
+from tests.datagen import SCALES
+from tests.datagen import WORDS
+from tests.datagen import generate
+from tests.datagen import itemcode
+
+
+def balance_report(store):
+    # What Reports.insertDetails reads.
+    for row in store.balances():
+        pass
+
+
+def month_report(store, start, end):
+    # What Reports.showRange reads for a month end report.
+    for row in store.period_balances(start, end):
+        pass
+
+
+def as_of_report(store, day):
+    # What Reports.showRange reads with only the To date.
+    for row in store.balances_as_of(day):
+        pass
+
+
+def valuation_report(store):
+    # What Reports.showValuation reads.
+    store.update_valuation()
+    for row in store.valuation():
+        pass
+
+
+def forget_valuation(store):
+    # The saved cost state is dropped so the next valuation values
+    # every item from its first movement.
+    store.database.write(reset_valuation)
+
+
+def balance_pages(store, limit=1000):
+    # What a client of the server reads walking the /balances pages.
+    after = 0
+    while True:
+        rows = store.list_balances(after, limit)
+        if len(rows) < limit:
+            break
+        after = rows[-1].rowid
+
+
+def export_report(store, filename):
+    # What Reports.exportFile writes.
+    store.export_balances(filename, 'Stock Report - Benchmark')
+
+
+def item_list(store):
+    # What ItemMaster.displayitem reads.
+    for item in store.items():
+        pass
+
+
+def item_lookup(store, codes):
+    # What selectitem does for each double-click.
+    for code in codes:
+        store.find_item(code)
+
+
+def rebuild_index(store):
+    # What the first keystroke in the Select Item box costs.
+    store.forget_items()
+    store.item_index()
+
+
+def item_search(store, words):
+    # What the Select Item search box does for each search.
+    for word in words:
+        store.search_items(word)
+
+
+def item_typeahead(store, words):
+    # What the type-ahead filter does once the user stops typing, the
+    # index is built on the first call.
+    index = store.item_index()
+    for word in words:
+        index.match(word)
+
+
+def transaction_insert(store, codes):
+    # What saveentry does for each line.
+    for code in codes:
+        store.record_incoming(code, 'BENCHMARK', 'PCS', 1, 1.0,
+                              '2020-01-01', 'BENCHMARK')
+
+
+def measure(function, repeat, *args, setup=None):
+    """
+    Run the function repeat times and return the timings in seconds.
+    The setup function, called with the same arguments before each
+    run, is not timed.
+    """
+    runs = []
+    for number in range(repeat):
+        if setup is not None:
+            setup(*args)
+        start = time.perf_counter()
+        function(*args)
+        runs.append(time.perf_counter() - start)
+    return {'runs': runs,
+            'min': min(runs),
+            'median': statistics.median(runs),
+            'max': max(runs)
+            }
+
+
+def run(filename, repeat=3, lookups=1000, inserts=1000, seed=0):
+    """
+    Time the operations on the given database and return the results.
+    """
+    # The statements are never traced, the tracer would be timed too.
+    database = Database(filename, traced=False)
+    migrate(database.connect())
+    store = InventoryStore(database)
+    items = database.cursor().execute("SELECT COUNT(*) FROM item").fetchone()[0]
+    rand = random.Random(seed)
+    codes = [itemcode(rand.randrange(max(1, items))) for number in range(lookups)]
+    insert_codes = [itemcode(rand.randrange(max(1, items))) for number in range(inserts)]
+    export_file = os.path.join(tempfile.gettempdir(), 'tarsierstock-benchmark.csv')
+
+    results = {}
+    results['balance_report'] = measure(balance_report, repeat, store)
+    last = database.cursor().execute(
+        "SELECT MAX(date) FROM incoming").fetchone()[0] or '2020-12-31'
+    end = datetime.strptime(last[:10], '%Y-%m-%d').date()
+    start = end.replace(day=1)
+    results['month_report'] = measure(month_report, repeat, store, start, end)
+    results['as_of_report'] = measure(as_of_report, repeat, store, start - timedelta(days=1))
+    results['balance_pages'] = measure(balance_pages, repeat, store)
+    results['export_report'] = measure(export_report, repeat, store, export_file)
+    # The first valuation of a database values every item, the later
+    # ones only read the new transactions, they are measured apart.
+    results['valuation_full'] = measure(valuation_report, repeat, store,
+                                        setup=forget_valuation)
+    results['item_list'] = measure(item_list, repeat, store)
+    results['item_lookup'] = measure(item_lookup, repeat, store, codes)
+    results['item_lookup']['operations'] = lookups
+    words = [rand.choice(WORDS)[:rand.randint(2, 5)] for number in range(lookups)]
+    results['item_search'] = measure(item_search, repeat, store, words)
+    results['item_search']['operations'] = lookups
+    results['item_index_build'] = measure(rebuild_index, repeat, store)
+    results['item_typeahead'] = measure(item_typeahead, repeat, store, words)
+    results['item_typeahead']['operations'] = lookups
+    results['transaction_insert'] = measure(transaction_insert, 1, store, insert_codes)
+    results['transaction_insert']['operations'] = inserts
+    # Only the inserted transactions are valued.
+    results['valuation_update'] = measure(valuation_report, 1, store)
+    results['valuation_update']['operations'] = inserts
+    database.close()
+    if os.path.exists(export_file):
+        os.remove(export_file)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tarsierstock hot paths.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--items', type=int, help='number of generated items')
+    parser.add_argument('--transactions', type=int,
+                        help='number of generated transactions')
+    parser.add_argument('--database',
+                        help='benchmark a copy of this database instead of generating one')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--inserts', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this json file')
+    args = parser.parse_args()
+
+    items, transactions = SCALES[args.scale]
+    if args.items is not None:
+        items = args.items
+    if args.transactions is not None:
+        transactions = args.transactions
+
+    workdir = tempfile.mkdtemp(prefix='tarsierstock-')
+    filename = os.path.join(workdir, 'inv_database.db')
+    start = time.perf_counter()
+    if args.database:
+        source = sqlite3.connect(args.database)
+        target = sqlite3.connect(filename)
+        source.backup(target)
+        source.close()
+        target.close()
+    else:
+        generate(filename, items, transactions, args.seed)
+    setup = time.perf_counter() - start
+
+    counts = sqlite3.connect(filename)
+    items = counts.execute("SELECT COUNT(*) FROM item").fetchone()[0]
+    transactions = (counts.execute("SELECT COUNT(*) FROM incoming").fetchone()[0] +
+                    counts.execute("SELECT COUNT(*) FROM outgoing").fetchone()[0])
+    counts.close()
+
+    report = {'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'items': items,
+              'transactions': transactions,
+              'setup': setup,
+              'results': run(filename, args.repeat, args.lookups,
+                             args.inserts, args.seed)
+              }
+    shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as jsonfile:
+            jsonfile.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# datagen.py - Synthetic inventory databases for the benchmarks.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import argparse
+import os
+import random
+import sys
+from datetime import datetime
+from datetime import timedelta
+
+from application.balance import create_balance_table
+from application.balance import rebuild_balances
+from application.database import Database
+from application.schema import create_date_indexes
+from application.schema import create_indexes
+from application.schema import migrate
+from application.search import create_item_search
+
+# Number of items and transactions of the predefined scales.
+SCALES = {
+    'small': (1000, 100000),
+    'medium': (50000, 1000000),
+    'large': (500000, 10000000),
+}
+
+UNITS = ('PCS', 'BOX', 'TIN', 'BOT', 'PKT', 'KG', 'LTR', 'SET')
+WORDS = ('MILK', 'COFFEE', 'TEA', 'SUGAR', 'RICE', 'FLOUR', 'SOAP', 'OIL',
+         'WATER', 'JUICE', 'BISCUIT', 'NOODLES', 'POWDER', 'BRAND', 'PACK',
+         'BLUE', 'RED', 'GREEN', 'LARGE', 'SMALL', 'BULB', 'CABLE', 'PIPE')
+
+# Rows inserted per executemany call.
+CHUNK_SIZE = 50000
+
+
+def itemcode(number):
+    return '%07d' % (1000000 + number)
+
+
+def generate(filename, items, transactions, seed=0, start=None, days=5 * 365):
+    """
+    Create a database with the given number of items and transactions,
+    about two thirds of the transactions are incoming. The dates are
+    spread over the given number of days before start.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    rand = random.Random(seed)
+    if start is None:
+        start = datetime(2016, 1, 1)
+    database = Database(filename)
+    connection = database.connect()
+    migrate(connection)
+    cur = connection.cursor()
+
+    # The triggers and indexes are dropped during the load and created
+    # again at the end, that's much faster than maintaining them per row.
+    for table in ('incoming', 'outgoing'):
+        for action in ('insert', 'delete', 'update'):
+            cur.execute("DROP TRIGGER IF EXISTS %s_balance_%s" % (table, action))
+    for action in ('insert', 'delete', 'update'):
+        cur.execute("DROP TRIGGER IF EXISTS item_fts_" + action)
+    for index in ('item_itemcode', 'incoming_itemcode_date', 'outgoing_itemcode_date',
+                  'incoming_date', 'outgoing_date'):
+        cur.execute("DROP INDEX IF EXISTS " + index)
+
+    cur.execute("BEGIN")
+    cur.execute("INSERT INTO company VALUES(?, ?, ?, ?, ?)",
+                ('BENCHMARK COMPANY', 'NOWHERE', '000-0000', '000-0000',
+                 'BENCH@EXAMPLE.COM'))
+    rows = []
+    for number in range(items):
+        description = ' '.join(rand.choice(WORDS) for word in range(4))
+        rows.append((itemcode(number), description, rand.choice(UNITS)))
+        if len(rows) >= CHUNK_SIZE:
+            cur.executemany("INSERT INTO item VALUES(null, ?, ?, ?)", rows)
+            rows = []
+    cur.executemany("INSERT INTO item VALUES(null, ?, ?, ?)", rows)
+
+    incoming = []
+    outgoing = []
+    for number in range(transactions):
+        code = itemcode(rand.randrange(items))
+        tdate = str(start + timedelta(days=rand.randrange(days)))
+        rate = round(rand.uniform(0.5, 100.0), 2)
+        if rand.random() < 0.66:
+            incoming.append((code, 'ITEM ' + code, 'PCS',
+                             float(rand.randint(1, 100)), rate, tdate, 'DN#%d' % number))
+        else:
+            outgoing.append((code, 'ITEM ' + code, 'PCS',
+                             -float(rand.randint(1, 50)), rate, tdate, 'ISSUE#%d' % number))
+        if len(incoming) >= CHUNK_SIZE:
+            cur.executemany("INSERT INTO incoming VALUES(null, ?, ?, ?, ?, ?, ?, ?)", incoming)
+            incoming = []
+        if len(outgoing) >= CHUNK_SIZE:
+            cur.executemany("INSERT INTO outgoing VALUES(null, ?, ?, ?, ?, ?, ?, ?)", outgoing)
+            outgoing = []
+    cur.executemany("INSERT INTO incoming VALUES(null, ?, ?, ?, ?, ?, ?, ?)", incoming)
+    cur.executemany("INSERT INTO outgoing VALUES(null, ?, ?, ?, ?, ?, ?, ?)", outgoing)
+
+    create_indexes(cur)
+    create_date_indexes(cur)
+    create_balance_table(cur)
+    rebuild_balances(cur)
+    create_item_search(cur)
+    connection.commit()
+    cur.execute("ANALYZE")
+    cur.close()
+    database.close()
+    return filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic inventory database.')
+    parser.add_argument('filename', help='database file to create')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--items', type=int, help='number of items')
+    parser.add_argument('--transactions', type=int, help='number of transactions')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    items, transactions = SCALES[args.scale]
+    if args.items is not None:
+        items = args.items
+    if args.transactions is not None:
+        transactions = args.transactions
+    generate(args.filename, items, transactions, args.seed)
+    print('Created %s with %d items and %d transactions.'
+          % (args.filename, items, transactions))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+#
+# tarsierstock_tests.py - Tests of the tarsierstock application.
+#
+# Copyright (c) 2015 - Jesus Vedasto Olazo <jessie@jestoy.frihost.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+#
+# Usage:
+#   python3 -m pytest tests/tarsierstock_tests.py
+
+import shutil
+import sqlite3
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from application.archive import CARRIED_FORWARD
+from application.database import Database
+from application.schema import MIGRATIONS
+from application.schema import SCHEMA_VERSION
+from application.schema import migrate
+from application.schema import schema_version
+from application.search import TOKEN
+from application.search import search_items
+from application.snapshot import MONTHLY
+from application.snapshot import YEARLY
+from application.snapshot import close_periods
+from application.store import INCOMING
+from application.store import InventoryStore
+from application.store import TRANSACTION_TABLES
+from application.valuation import reset_valuation
+from tests.datagen import generate
+from tests.datagen import itemcode
+
+ITEMS = 40
+TRANSACTIONS = 3000
+START = datetime(2016, 1, 1)
+DAYS = 3 * 365
+CUTOFF = date(2018, 1, 1)
+
+
+@pytest.fixture
+def store(tmp_path):
+    filename = generate(str(tmp_path / 'stock.db'), ITEMS, TRANSACTIONS,
+                        start=START, days=DAYS)
+    store = InventoryStore(Database(filename))
+    yield store
+    store.database.close()
+
+
+def valuation(store):
+    return {row.itemcode: (row.quantity, row.average_value, row.fifo_value)
+            for row in store.valuation()}
+
+
+def assert_same_valuation(store):
+    """
+    Compare the incremental valuation with a valuation of every item
+    from its first movement.
+    """
+    store.update_valuation()
+    incremental = valuation(store)
+    store.database.write(reset_valuation)
+    store.update_valuation()
+    replayed = valuation(store)
+    assert incremental.keys() == replayed.keys()
+    for code, values in replayed.items():
+        assert incremental[code] == pytest.approx(values), code
+
+
+def execute(store, sql, parameters=()):
+    store.database.write(lambda cur: cur.execute(sql, parameters))
+
+
+def test_valuation_new_transactions(store):
+    store.update_valuation()
+    store.record_incoming(itemcode(1), 'ITEM', 'PCS', 30, 12.5, '2019-06-01')
+    store.record_outgoing(itemcode(1), 'ITEM', 'PCS', 20, 0, '2019-06-02')
+    store.record_outgoing(itemcode(2), 'ITEM', 'PCS', 500, 0, '2019-06-02')
+    store.record_incoming(itemcode(2), 'ITEM', 'PCS', 800, 3.0, '2019-06-03')
+    assert_same_valuation(store)
+
+
+def test_valuation_back_dated_inserts(store):
+    store.update_valuation()
+    store.record_incoming(itemcode(3), 'ITEM', 'PCS', 40, 99.0, '2016-02-01')
+    store.record_outgoing(itemcode(4), 'ITEM', 'PCS', 15, 0, '2016-03-15')
+    # Same day as the first movements of the item.
+    store.record_outgoing(itemcode(5), 'ITEM', 'PCS', 1000, 0, str(START.date()))
+    store.record_incoming(itemcode(6), 'ITEM', 'PCS', 10, 1.0, '2019-06-01')
+    assert_same_valuation(store)
+
+
+def test_valuation_deletes(store):
+    store.update_valuation()
+    execute(store, "DELETE FROM incoming WHERE rowid IN (SELECT rowid FROM incoming "
+                   "WHERE itemcode = ? ORDER BY date LIMIT 3)", (itemcode(7),))
+    execute(store, "DELETE FROM outgoing WHERE itemcode = ?", (itemcode(8),))
+    # The rowid of the last movement is used again by the next insert.
+    execute(store, "DELETE FROM incoming WHERE rowid = (SELECT MAX(rowid) FROM incoming)")
+    store.record_incoming(itemcode(9), 'ITEM', 'PCS', 5, 7.0, '2019-06-01')
+    assert_same_valuation(store)
+
+
+def test_valuation_updates(store):
+    store.update_valuation()
+    execute(store, "UPDATE incoming SET rate = rate * 2 WHERE itemcode = ?",
+            (itemcode(10),))
+    execute(store, "UPDATE outgoing SET quantity = quantity - 5 WHERE itemcode = ?",
+            (itemcode(11),))
+    execute(store, "UPDATE incoming SET date = '2016-01-01 00:00:00' WHERE rowid = "
+                   "(SELECT MAX(rowid) FROM incoming WHERE itemcode = ?)", (itemcode(12),))
+    # A movement moved to another item changes both.
+    execute(store, "UPDATE outgoing SET itemcode = ? WHERE rowid = "
+                   "(SELECT MIN(rowid) FROM outgoing WHERE itemcode = ?)",
+            (itemcode(14), itemcode(13)))
+    assert_same_valuation(store)
+
+
+def test_valuation_repeated_changes(store):
+    # Value after each change, like a session with the window open.
+    store.update_valuation()
+    for number in range(5):
+        store.record_incoming(itemcode(number), 'ITEM', 'PCS', 10 + number, 2.0,
+                              '2017-0%d-10' % (number + 1))
+        store.update_valuation()
+        execute(store, "DELETE FROM outgoing WHERE rowid = (SELECT MIN(rowid) FROM outgoing "
+                       "WHERE itemcode = ?)", (itemcode(number + 20),))
+        store.update_valuation()
+    assert_same_valuation(store)
+
+
+@pytest.fixture
+def archived(tmp_path):
+    """
+    Return the store of a database archived before the cutoff and the
+    store of an unarchived copy of it.
+    """
+    filename = generate(str(tmp_path / 'stock.db'), ITEMS, TRANSACTIONS,
+                        start=START, days=DAYS)
+    store = InventoryStore(Database(filename))
+    # Items below zero and without stock at the cutoff.
+    for number, (incoming, outgoing) in enumerate(((10, 30), (10, 30), (10, 10))):
+        code = itemcode(ITEMS + number)
+        store.add_item(code, 'ITEM', 'PCS')
+        store.record_incoming(code, 'ITEM', 'PCS', incoming, 5.0, '2016-05-01')
+        store.record_outgoing(code, 'ITEM', 'PCS', outgoing, 0, '2017-05-01')
+    store.record_incoming(itemcode(ITEMS + 1), 'ITEM', 'PCS', 50, 8.0, '2018-05-01')
+    # A transaction whose remarks look like an archived balance.
+    store.record_incoming(itemcode(0), 'ITEM', 'PCS', 7, 3.0, '2016-12-31', CARRIED_FORWARD)
+    store.record_outgoing(itemcode(ITEMS + 2), 'ITEM', 'PCS', 5, 0, '2018-05-01')
+    store.database.close()
+    shutil.copy(filename, str(tmp_path / 'plain.db'))
+    plain = InventoryStore(Database(str(tmp_path / 'plain.db')))
+    assert store.archive(CUTOFF) > 0
+    yield store, plain
+    store.database.close()
+    plain.database.close()
+
+
+def test_archive_balances(archived):
+    store, plain = archived
+    # The in and out totals hold the carried forward rows.
+    assert [row.balance for row in store.balances()] == \
+        [row.balance for row in plain.balances()]
+
+
+@pytest.mark.parametrize('start, end', [
+    (date(2016, 3, 1), date(2016, 12, 31)),
+    (date(2017, 6, 1), date(2018, 6, 30)),
+    (date(2018, 2, 1), date(2018, 12, 31)),
+    (None, date(2017, 3, 31)),
+    (None, date(2018, 3, 31)),
+])
+def test_archive_period_balances(archived, start, end):
+    store, plain = archived
+    # The quantities are whole numbers, the sums are exact.
+    assert list(store.period_balances(start, end)) == list(plain.period_balances(start, end))
+
+
+@pytest.mark.parametrize('day', [date(2016, 8, 31), date(2017, 12, 31), date(2018, 1, 1)])
+def test_archive_balances_as_of(archived, day):
+    store, plain = archived
+    assert [row.closing for row in store.balances_as_of(day)] == \
+        [row.closing for row in plain.balances_as_of(day)]
+
+
+def test_archive_valuation(archived):
+    store, plain = archived
+    for changed in (store, plain):
+        changed.update_valuation()
+        changed.record_incoming(itemcode(0), 'ITEM', 'PCS', 25, 4.0, '2018-03-01')
+        changed.record_outgoing(itemcode(1), 'ITEM', 'PCS', 25, 0, '2018-03-01')
+        changed.update_valuation()
+    # The FIFO layers of the archived stock are collapsed into the
+    # carried average cost, only the weighted average is kept.
+    for row, expected in zip(store.valuation(), plain.valuation()):
+        assert row.itemcode == expected.itemcode
+        assert row[4:7] == pytest.approx(expected[4:7]), row.itemcode
+
+
+def recomputed_balances(store):
+    """
+    Return the in total, the out total and the latest movement date of
+    each item code, summed from every transaction.
+    """
+    totals = {}
+    cur = store.database.cursor()
+    for table in TRANSACTION_TABLES:
+        for code, quantity, day in cur.execute(
+                "SELECT itemcode, quantity, date FROM " + table):
+            incoming, outgoing, last = totals.get(code, (0, 0, None))
+            if table == INCOMING:
+                incoming += quantity or 0
+            else:
+                outgoing += quantity or 0
+            if last is None or (day is not None and day > last):
+                last = day
+            totals[code] = (incoming, outgoing, last)
+    return totals
+
+
+def assert_same_balances(store):
+    """
+    Compare the running totals kept by the triggers with the totals of
+    the transactions.
+    """
+    totals = recomputed_balances(store)
+    for row in store.balances():
+        incoming, outgoing, last = totals.get(row.itemcode, (0, 0, None))
+        assert (row.incoming, row.outgoing, row.balance) == \
+            (incoming, outgoing, incoming + outgoing), row.itemcode
+    latest = dict(store.database.cursor().execute(
+        "SELECT itemcode, last_movement_date FROM stock_balance "
+        "WHERE last_movement_date IS NOT NULL"))
+    assert latest == {code: last for code, (incoming, outgoing, last) in totals.items()
+                      if last is not None}
+
+
+def test_balance_inserts(store):
+    store.record_incoming(itemcode(1), 'ITEM', 'PCS', 30, 12.5, '2019-06-01')
+    store.record_outgoing(itemcode(1), 'ITEM', 'PCS', 20, 0, '2016-02-01')
+    # The first movement of an item adds its row.
+    store.add_item('NEW-1', 'NEW ITEM', 'PCS')
+    store.record_outgoing('NEW-1', 'NEW ITEM', 'PCS', 5, 0, '2018-01-01')
+    store.post_batch(INCOMING, [(itemcode(number), 'ITEM', 'PCS', number + 1, 1.0,
+                                 '2018-07-0%d' % (number + 1), '')
+                                for number in range(5)])
+    assert_same_balances(store)
+
+
+def test_balance_updates(store):
+    execute(store, "UPDATE incoming SET quantity = quantity * 3 WHERE itemcode = ?",
+            (itemcode(2),))
+    # A movement moved to another item changes both.
+    execute(store, "UPDATE outgoing SET itemcode = ? WHERE rowid = "
+                   "(SELECT MIN(rowid) FROM outgoing WHERE itemcode = ?)",
+            (itemcode(4), itemcode(3)))
+    # The latest movement of an item moved back in time.
+    execute(store, "UPDATE incoming SET date = '2016-01-01 00:00:00' WHERE rowid = "
+                   "(SELECT rowid FROM incoming WHERE itemcode = ? "
+                   "ORDER BY date DESC LIMIT 1)", (itemcode(5),))
+    execute(store, "UPDATE outgoing SET date = '2020-01-01 00:00:00' WHERE rowid = "
+                   "(SELECT MIN(rowid) FROM outgoing WHERE itemcode = ?)", (itemcode(6),))
+    assert_same_balances(store)
+
+
+def test_balance_deletes(store):
+    # The latest movement of an item, its date is searched again.
+    for table in TRANSACTION_TABLES:
+        execute(store, "DELETE FROM " + table + " WHERE rowid IN "
+                       "(SELECT rowid FROM " + table + " WHERE itemcode = ? "
+                       "ORDER BY date DESC LIMIT 2)", (itemcode(7),))
+    # Every movement of an item.
+    for table in TRANSACTION_TABLES:
+        execute(store, "DELETE FROM " + table + " WHERE itemcode = ?", (itemcode(8),))
+    assert_same_balances(store)
+
+
+def legacy_database(tmp_path, version):
+    """
+    Return the file of a database at the given schema version holding
+    the rows of a generated database and an item code used twice.
+    """
+    source = generate(str(tmp_path / 'source.db'), ITEMS, TRANSACTIONS,
+                      start=START, days=DAYS)
+    filename = str(tmp_path / 'legacy.db')
+    connection = sqlite3.connect(filename)
+    cur = connection.cursor()
+    # The first release created the tables of version 1 without setting
+    # user_version.
+    for migration in MIGRATIONS[:max(version, 1)]:
+        migration(cur)
+    cur.execute("PRAGMA user_version = %d" % version)
+    connection.commit()
+    cur.execute("ATTACH ? AS source", (source,))
+    for table in ('company', 'item', 'incoming', 'outgoing'):
+        cur.execute("INSERT INTO main.%s SELECT * FROM source.%s" % (table, table))
+    if version < 3:
+        cur.execute("INSERT INTO item VALUES(null, ?, 'DUPLICATE', 'PCS')", (itemcode(0),))
+    connection.commit()
+    cur.execute("DETACH source")
+    connection.close()
+    return filename
+
+
+@pytest.mark.parametrize('version', range(SCHEMA_VERSION))
+def test_migrations(tmp_path, version):
+    store = InventoryStore(Database(legacy_database(tmp_path, version)))
+    connection = store.database.connect()
+    assert migrate(connection) == list(range(version + 1, SCHEMA_VERSION + 1))
+    assert schema_version(connection) == SCHEMA_VERSION
+    assert migrate(connection) == []
+    # The tables of each version work on the existing rows.
+    assert_same_balances(store)
+    assert store.search_items(itemcode(3))[0].itemcode == itemcode(3)
+    assert store.update_valuation() > 0
+    assert_same_valuation(store)
+    store.record_incoming(itemcode(1), 'ITEM', 'PCS', 30, 12.5, '2019-06-01')
+    assert_same_balances(store)
+    unique = connection.execute("SELECT sql LIKE 'CREATE UNIQUE%' FROM sqlite_master "
+                                "WHERE name = 'item_itemcode'").fetchone()[0]
+    assert unique == (version >= 3)
+    store.database.close()
+
+
+def test_migrate_newer_database(tmp_path):
+    filename = legacy_database(tmp_path, SCHEMA_VERSION)
+    connection = sqlite3.connect(filename)
+    connection.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION + 1))
+    with pytest.raises(sqlite3.DatabaseError):
+        migrate(connection)
+    connection.close()
+
+
+def matching_items(store, text):
+    """
+    Return the rowids of the items having every word of the text as the
+    start of a word of their item code or description.
+    """
+    words = TOKEN.findall(text.lower())
+    found = set()
+    for item in store.items():
+        tokens = TOKEN.findall((item.itemcode + ' ' + item.description).lower())
+        if all(any(token.startswith(word) for token in tokens) for word in words):
+            found.add(item.rowid)
+    return found
+
+
+@pytest.mark.parametrize('text', ['rice', 'ri', 'red rice', 'Powder b', 'COFFEE TEA MILK',
+                                  itemcode(1)[:5], 'ab-100', 'no such item'])
+def test_search_matches(store, text):
+    store.add_item('AB-100/2', 'SPARE RICE', 'PCS')
+    found = store.search_items(text, ITEMS + 10)
+    assert set(item.rowid for item in found) == matching_items(store, text)
+    # A shorter list keeps the best ranked items.
+    assert store.search_items(text, 5) == found[:5]
+
+
+def test_search_ranking(store):
+    store.add_item('RICE-1', 'TEA', 'PCS')
+    store.add_item('RICE', 'SUGAR', 'PCS')
+    # An exact item code comes first, then the matches of the item code.
+    assert [item.itemcode for item in store.search_items('RICE', 3)][:2] == ['RICE', 'RICE-1']
+    assert store.search_items(itemcode(3))[0].itemcode == itemcode(3)
+    assert store.search_items('"') == []
+
+
+def test_search_follows_the_items(store):
+    rowid = store.add_item('NEW-1', 'GOLDEN SYRUP', 'PCS')
+    assert [item.rowid for item in store.search_items('golden')] == [rowid]
+    execute(store, "UPDATE item SET description = 'AMBER SYRUP' WHERE rowid = ?", (rowid,))
+    assert store.search_items('golden') == []
+    assert [item.rowid for item in store.search_items('amber syr')] == [rowid]
+    store.delete_item(rowid)
+    assert store.search_items('syrup') == []
+
+
+@pytest.mark.parametrize('text', ['RICE', itemcode(1)[:5], '50%', 'no such item'])
+def test_search_without_full_text(store, text):
+    # sqlite3 built without FTS5 reads the item table.
+    found = search_items(store.cursor(), text, ITEMS + 10, fulltext=False)
+    expected = set(item.rowid for item in store.items()
+                   if item.itemcode.lower().startswith(text.lower())
+                   or text.lower() in item.description.lower())
+    assert set(row[0] for row in found) == expected
+
+
+def recomputed_period(store, start, end):
+    """
+    Return the opening balance, the in and out movements between the
+    dates, both included, of each item code, summed from every
+    transaction. A movement without a date is one of the oldest.
+    """
+    start = '' if start is None else str(start)
+    end = str(end + timedelta(days=1))
+    totals = {}
+    cur = store.database.cursor()
+    for table in TRANSACTION_TABLES:
+        for code, quantity, day in cur.execute(
+                "SELECT itemcode, quantity, date FROM " + table):
+            opening, incoming, outgoing = totals.get(code, (0, 0, 0))
+            if day is None or day < start:
+                opening += quantity or 0
+            elif day < end and table == INCOMING:
+                incoming += quantity or 0
+            elif day < end:
+                outgoing += quantity or 0
+            totals[code] = (opening, incoming, outgoing)
+    return totals
+
+
+def assert_same_period(rows, totals):
+    for row in rows:
+        opening, incoming, outgoing = totals.get(row.itemcode, (0, 0, 0))
+        assert row[4:] == (opening, incoming, outgoing,
+                           opening + incoming + outgoing), row.itemcode
+
+
+@pytest.fixture
+def undated(store):
+    # A transaction saved without a date by an old release.
+    execute(store, "INSERT INTO incoming VALUES(null, ?, 'ITEM', 'PCS', 9, 1.0, NULL, '')",
+            (itemcode(2),))
+    return store
+
+
+@pytest.mark.parametrize('start, end', [
+    (None, date(2016, 6, 30)),
+    (date(2016, 3, 1), date(2016, 3, 31)),
+    (date(2017, 1, 1), date(2017, 12, 31)),
+    (date(2018, 11, 1), date(2018, 11, 30)),
+    (date(2017, 5, 10), date(2017, 5, 10)),
+    (date(2015, 1, 1), date(2015, 12, 31)),
+    (date(2019, 1, 1), date(2019, 1, 31)),
+])
+def test_period_balances(undated, start, end):
+    # Both the movements before and after the range are read, whichever
+    # side is shorter.
+    assert_same_period(undated.period_balances(start, end),
+                       recomputed_period(undated, start, end))
+
+
+@pytest.mark.parametrize('day', [date(2015, 12, 31), date(2016, 1, 1), date(2016, 7, 15),
+                                 date(2018, 12, 31), date(2020, 1, 1)])
+def test_balances_as_of(undated, day):
+    assert_same_period(undated.balances_as_of(day), recomputed_period(undated, day, day))
+
+
+TODAY = date(2019, 3, 1)
+BACK_DATE = '2017-03-15'
+
+
+def assert_same_snapshots(store):
+    """
+    Compare the closing balances saved for each closed period with the
+    movements dated before the end of the period.
+    """
+    cur = store.database.cursor()
+    for until in [row[0] for row in cur.execute("SELECT until FROM balance_period")]:
+        saved = dict(cur.execute("SELECT itemcode, balance FROM balance_snapshot "
+                                 "WHERE until = ?", (until,)))
+        totals = recomputed_period(store, None, date.fromisoformat(until) - timedelta(days=1))
+        closing = {code: sum(values) for code, values in totals.items()}
+        for code in set(saved) | set(closing):
+            assert saved.get(code, 0) == closing.get(code, 0), (until, code)
+
+
+@pytest.mark.parametrize('period, count', [(MONTHLY, 38), (YEARLY, 3)])
+def test_snapshots_closed(store, period, count):
+    assert close_periods(store.database, period, TODAY) == count
+    assert close_periods(store.database, period, TODAY) == 0
+    assert_same_snapshots(store)
+    # A range starting at the end of a closed period reads its snapshot.
+    for start, end in ((date(2017, 1, 1), date(2017, 1, 31)),
+                       (date(2018, 1, 1), date(2018, 3, 31))):
+        assert_same_period(store.period_balances(start, end),
+                           recomputed_period(store, start, end))
+
+
+@pytest.mark.parametrize('change', [
+    lambda store: store.record_incoming(itemcode(1), 'ITEM', 'PCS', 40, 2.0, BACK_DATE),
+    lambda store: execute(store, "UPDATE outgoing SET date = ?, quantity = quantity - 7 "
+                                 "WHERE rowid = (SELECT MAX(rowid) FROM outgoing)",
+                          (BACK_DATE + ' 00:00:00',)),
+    lambda store: execute(store, "DELETE FROM incoming WHERE rowid = (SELECT rowid "
+                                 "FROM incoming WHERE date < ? ORDER BY date DESC LIMIT 1)",
+                          ('2017-03-16',)),
+    lambda store: execute(store, "INSERT INTO outgoing VALUES(null, ?, 'ITEM', 'PCS', "
+                                 "-3, 0, NULL, '')", (itemcode(4),)),
+], ids=['insert', 'update', 'delete', 'undated'])
+def test_snapshots_back_dated(store, change):
+    closed = close_periods(store.database, MONTHLY, TODAY)
+    change(store)
+    # The snapshots of the periods ending after the movement are gone,
+    # the earlier ones are still right.
+    cur = store.database.cursor()
+    assert cur.execute("SELECT COUNT(*) FROM balance_period WHERE until > ?",
+                       (BACK_DATE,)).fetchone()[0] == 0
+    assert cur.execute("SELECT COUNT(*) FROM balance_snapshot WHERE until > ?",
+                       (BACK_DATE,)).fetchone()[0] == 0
+    assert_same_snapshots(store)
+    for start, end in ((date(2017, 6, 1), date(2017, 6, 30)),
+                       (date(2018, 1, 1), date(2018, 1, 31))):
+        assert_same_period(store.period_balances(start, end),
+                           recomputed_period(store, start, end))
+    # They are closed again from the movements.
+    assert close_periods(store.database, MONTHLY, TODAY) > 0
+    assert cur.execute("SELECT COUNT(*) FROM balance_period").fetchone()[0] == closed
+    assert_same_snapshots(store)